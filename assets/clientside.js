@@ -0,0 +1,145 @@
+// Pure UI callbacks, run in the browser instead of a round trip to the server.
+// Each function mirrors the Python callback it replaced in countryGen_dash.py.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    countrygen: (function () {
+        const monthsFull = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"];
+
+        function monthOptions(first, last) {
+            const options = [];
+            for (let m = first; m <= last; m++) {
+                options.push({label: monthsFull[m - 1], value: m});
+            }
+            return options;
+        }
+
+        function withDisplay(style, display) {
+            return Object.assign({}, style || {}, {display: display});
+        }
+
+        // Edits made on this page, per row and in all (see stampEdit)
+        const rowEdits = {};
+        let pageEdits = 0;
+
+        // Sends a location history as the request body (a multi-GB file never goes through a
+        // callback), then hands the job to poll_location_import through the import_job store
+        function uploadFile(file) {
+            const setProps = window.dash_clientside.set_props;
+            const config = JSON.parse(document.getElementById("_dash-config").textContent);
+            const xhr = new XMLHttpRequest();
+            xhr.open("POST", (config.requests_pathname_prefix || "/") + "import/location-history?name=" + encodeURIComponent(file.name));
+            xhr.upload.onprogress = function (event) {
+                if (event.lengthComputable) {
+                    setProps("import_status", {children: "Uploading: " + Math.floor(100 * event.loaded / event.total) + "%"});
+                }
+            };
+            xhr.onload = function () {
+                if (xhr.status === 202) {
+                    setProps("import_job", {data: JSON.parse(xhr.responseText).job});
+                } else {
+                    setProps("import_status", {children: xhr.responseText || "The upload failed (" + xhr.status + ")."});
+                }
+            };
+            xhr.onerror = function () {
+                setProps("import_status", {children: "The upload failed, check your connection and try again."});
+            };
+            setProps("import_status", {children: "Uploading: 0%"});
+            xhr.send(file);
+        }
+
+        return {
+            visitMonthOptions: function (selectedYear, dobMonth, dobYear, selectedMonth, yearId) {
+                const today = new Date();
+                const currentYear = today.getFullYear();
+                const currentMonth = today.getMonth() + 1;
+                const defaultMonth = dobMonth || 1;
+                const defaultYear = dobYear || 1990;
+                let options;
+                if (selectedYear === defaultYear && selectedYear === currentYear) {
+                    options = monthOptions(defaultMonth, currentMonth);
+                } else if (selectedYear === defaultYear) {
+                    options = monthOptions(defaultMonth, 12);
+                } else if (selectedYear === currentYear) {
+                    options = monthOptions(1, currentMonth);
+                } else {
+                    options = monthOptions(1, 12);
+                }
+                const validValues = options.map(o => o.value);
+                if (!validValues.includes(selectedMonth)) {
+                    selectedMonth = validValues[0];
+                }
+                return [options, selectedMonth];
+            },
+
+            dobMonthOptions: function (selectedYear) {
+                const today = new Date();
+                if (selectedYear === today.getFullYear()) {
+                    return monthOptions(1, today.getMonth() + 1);
+                }
+                return monthOptions(1, 12);
+            },
+
+            toggleResidenceSection: function (nClicks, currentStyle) {
+                return withDisplay(currentStyle, !nClicks || nClicks % 2 === 0 ? "none" : "block");
+            },
+
+            hideToggleResidenceBtn: function (resSectionStyle, btnStyle) {
+                const shown = resSectionStyle && resSectionStyle.display === "block";
+                return withDisplay(btnStyle, shown ? "none" : "");
+            },
+
+            autocorrectFromUntil: function (fromYear, fromMonth, untilYear, untilMonth, dobYear, dobMonth) {
+                if (fromYear == null || fromMonth == null || untilYear == null || untilMonth == null) {
+                    return [fromYear, fromMonth, untilYear, untilMonth];
+                }
+                // If until is before from, set from = until
+                if (untilYear < fromYear || (untilYear === fromYear && untilMonth < fromMonth)) {
+                    return [untilYear, untilMonth, untilYear, untilMonth];
+                }
+                return [fromYear, fromMonth, untilYear, untilMonth];
+            },
+
+            showVisitLabel: function (selectedCountries) {
+                const display = selectedCountries && selectedCountries.length > 0 ? "block" : "none";
+                return {fontSize: 14, marginBottom: "18px", display: display};
+            },
+
+            // Numbers an edit of a row for the session: the values go to the server with the row's
+            // count of edits, and the page's total is kept in edit_version for Generate! to send
+            // (see record_edit in sessions.py). The last argument is the row's id.
+            stampEdit: function () {
+                const values = Array.prototype.slice.call(arguments, 0, -1);
+                const row = JSON.stringify(arguments[arguments.length - 1]);
+                rowEdits[row] = (rowEdits[row] || 0) + 1;
+                pageEdits += 1;
+                window.dash_clientside.set_props("edit_version", {data: pageEdits});
+                return {values: values, count: rowEdits[row]};
+            },
+
+            // What Generate! sends instead of the selection and the residence rows: the same
+            // hash as page_digest in sessions.py
+            pageDigest: function (selectedLabels, residenceIds) {
+                const indexes = (residenceIds || []).map(function (rowId) { return rowId.index; });
+                const text = (selectedLabels || []).join("\n") + "\n" + indexes.join(",");
+                let digest = 0x811c9dc5;
+                for (const ch of text) {
+                    digest = Math.imul(digest ^ ch.codePointAt(0), 0x01000193) >>> 0;
+                }
+                return digest;
+            },
+
+            // Asks for a file; it is uploaded as the request body (see uploadFile)
+            uploadLocationHistory: function (nClicks) {
+                const input = document.createElement("input");
+                input.type = "file";
+                input.accept = ".json,.gpx,.csv";
+                input.onchange = function () {
+                    if (input.files[0]) {
+                        uploadFile(input.files[0]);
+                    }
+                };
+                input.click();
+                return window.dash_clientside.no_update;
+            }
+        };
+    })()
+});
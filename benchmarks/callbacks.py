@@ -0,0 +1,225 @@
+"""Wall time, allocations and output size of the app's server callbacks on synthetic travellers.
+
+Every combination of countries visited, residence periods and year of birth is run through
+the callbacks the page would call for it: building the visit and residence tables, the
+residence date options of every row, the flag URLs, and generating the chart (with an empty
+and with a warm figure cache). For the chart it also reports the figure's JSON size and its
+trace, shape, annotation and layout image counts.
+
+Callbacks are called directly, except update_residence_periods, which needs a callback
+context and goes through Dash's update endpoint (Flask test client). The visits and periods
+are put in a session first, as the page's edits would have recorded them. Flag downloads are off.
+
+    python benchmarks/callbacks.py [--countries 1 50 150 193] [--periods 0 10 50] [--dob 1930 1975 2025]
+                                   [--repeat 3] [--save results.json] [--compare baseline.json]
+
+--save writes the results as a baseline; --compare prints them next to a saved baseline and
+exits with status 1 if any time or size grew by more than --tolerance.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("COUNTRYGEN_FLAGS_OFFLINE", "1")
+
+import countryGen_dash  # noqa: E402
+from dash_client import Endpoint, encode  # noqa: E402
+from figure_cache import make_figure_cache  # noqa: E402
+from intervals import month_index  # noqa: E402
+from sessions import new_session_key, page_digest  # noqa: E402
+
+RESIDENCES = "residence_periods_container.children"
+COMPARED = ("seconds", "peak_kib", "response_bytes", "figure_bytes")
+
+def from_index(index):
+    year, month_0 = divmod(index, 12)
+    return year, month_0 + 1
+
+def synthetic_profile(n_countries, n_periods, dob_year, seed=0):
+    # A traveller born in dob_year with first visits spread from birth to now, and up to
+    # n_periods back-to-back residence periods (fewer if they haven't lived that many months)
+    rnd = random.Random(f"{n_countries}/{n_periods}/{dob_year}/{seed}")
+    today = datetime.date.today()
+    dob_month = rnd.randint(1, today.month if dob_year == today.year else 12)
+    born, now = month_index(dob_year, dob_month), month_index(today.year, today.month)
+    labels = rnd.sample(countryGen_dash.country_options, min(n_countries, len(countryGen_dash.country_options)))
+    visits = [from_index(rnd.randint(born, now)) for _ in labels]
+    codes = [countryGen_dash.COUNTRY_REGISTRY.by_label(label).alpha_2 for label in labels]
+    bounds = sorted(rnd.sample(range(born, now + 1), min(2 * n_periods, now - born + 1) // 2 * 2))
+    residences = [(rnd.choice(labels), *from_index(start), *from_index(end)) for start, end in zip(bounds[::2], bounds[1::2])]
+    return {
+        "dob": (dob_year, dob_month),
+        "labels": labels,
+        "visit_ids": [{"type": "visit_month", "code": code} for code in codes],
+        "visit_years": [year for year, _ in visits],
+        "visit_months": [month for _, month in visits],
+        "residences": residences,
+    }
+
+def profile_session(profile):
+    # A new session holding the profile's visit and residence tables
+    codes = [visit_id["code"] for visit_id in profile["visit_ids"]]
+    def fill(session):
+        session["selected"] = codes
+        session["visits"] = {code: [year, month] for code, year, month in zip(codes, profile["visit_years"], profile["visit_months"])}
+        session["residences"] = {str(i): list(period) for i, period in enumerate(profile["residences"])}
+    key = new_session_key()
+    countryGen_dash.SESSIONS.create(key)
+    countryGen_dash.SESSIONS.update(key, fill)
+    return key
+
+def run_generate_plot(profile, session_key, cold):
+    if cold:
+        countryGen_dash.FIGURE_CACHE = make_figure_cache()
+    dob_year, dob_month = profile["dob"]
+    digest = page_digest(profile["labels"], range(len(profile["residences"])))
+    return countryGen_dash.generate_plot(1, 0, dob_month, dob_year, session_key, 0, digest, None)
+
+def run_update_visit_inputs(profile):
+    # A page without the table yet, so the whole table is built
+    dob_year, dob_month = profile["dob"]
+    session_key = new_session_key()
+    countryGen_dash.SESSIONS.create(session_key)
+    return countryGen_dash.update_visit_inputs(profile["labels"], dob_month, dob_year, [], session_key)
+
+def run_flag_urls(profile):
+    return [countryGen_dash.get_flag_url(visit_id["code"]) for visit_id in profile["visit_ids"]]
+
+def run_restrict_options(profile, session_key):
+    # What a full table refresh costs: both MATCH callbacks once per row
+    dob_year, dob_month = profile["dob"]
+    results = []
+    for i, (country, from_year, from_month, until_year, until_month) in enumerate(profile["residences"]):
+        row_id = {"type": "res_country", "index": i}
+        results.append(countryGen_dash.restrict_until_options(from_year, from_month, country, until_year, until_month, row_id, session_key, dob_year, dob_month))
+        results.append(countryGen_dash.restrict_from_options(country, until_year, until_month, from_year, from_month, row_id, session_key, dob_year, dob_month))
+    return results
+
+def run_add_residence_row(endpoint, profile):
+    # The residence table with all periods in it, then "Add residence period" clicked
+    dob_year, dob_month = profile["dob"]
+    values = {
+        "add_residence_period_btn.n_clicks": 1,
+        "residence_section.style": {"display": "block"},
+        "country_select.value": profile["labels"],
+        "session_key.data": profile_session(profile),
+        "dob_year.value": dob_year,
+        "dob_month.value": dob_month,
+        "remove_residence_period": [0] * len(profile["residences"]),
+        "res_country": [period[0] for period in profile["residences"]],
+    }
+    return endpoint(values, ["add_residence_period_btn.n_clicks"])
+
+def figure_stats(result):
+    # Size and counts of the chart as built (the cached figure, not the window the page shows)
+    key = next(child.data for child in result[1].children if getattr(child, "id", None) == "chart_key")
+    figure_json = countryGen_dash.FIGURE_CACHE.get(key)["figure"]
+    figure = json.loads(figure_json)
+    layout = figure.get("layout", {})
+    return {
+        "figure_bytes": len(figure_json),
+        "traces": len(figure.get("data", [])),
+        "shapes": len(layout.get("shapes", [])),
+        "annotations": len(layout.get("annotations", [])),
+        "images": len(layout.get("images", [])),
+    }
+
+def measure(run, repeat):
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - started)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    response = result if isinstance(result, bytes) else encode(result).encode()
+    return result, {"seconds": min(seconds), "peak_kib": peak / 1024, "response_bytes": len(response)}
+
+def profile_cases(profile):
+    endpoint = Endpoint(countryGen_dash.app, RESIDENCES)
+    session_key = profile_session(profile)
+    yield "update_visit_inputs", lambda: run_update_visit_inputs(profile), None
+    yield "flag urls", lambda: run_flag_urls(profile), None
+    yield "update_residence_periods (add row)", lambda: run_add_residence_row(endpoint, profile), None
+    if profile["residences"]:
+        yield "restrict_*_options (every row)", lambda: run_restrict_options(profile, session_key), None
+    yield "generate_plot (cold)", lambda: run_generate_plot(profile, session_key, cold=True), figure_stats
+    yield "generate_plot (cached)", lambda: run_generate_plot(profile, session_key, cold=False), None
+
+def run_suite(countries, periods, dobs, repeat):
+    results = {}
+    print(f"{'callback':36} {'ms':>9} {'peak KiB':>9} {'response':>10} {'figure':>10}  traces/shapes/annotations/images")
+    for n_countries in countries:
+        for n_periods in periods:
+            for dob_year in dobs:
+                profile = synthetic_profile(n_countries, n_periods, dob_year)
+                name = f"{len(profile['labels'])} countries, {len(profile['residences'])} periods, born {dob_year}"
+                print(name)
+                for callback, run, stats in profile_cases(profile):
+                    result, metrics = measure(run, repeat)
+                    if stats:
+                        metrics.update(stats(result))
+                    results[f"{name}: {callback}"] = metrics
+                    counts = "/".join(str(metrics[k]) for k in ("traces", "shapes", "annotations", "images")) if stats else ""
+                    figure = f"{metrics['figure_bytes']:>10,}" if stats else f"{'':>10}"
+                    print(f"  {callback:34} {metrics['seconds'] * 1e3:>9.2f} {metrics['peak_kib']:>9.0f} {metrics['response_bytes']:>10,} {figure}  {counts}")
+    return results
+
+def compare(results, baseline, tolerance):
+    # Prints every metric that moved by more than the tolerance; returns how many got worse
+    regressions = 0
+    for case, metrics in results.items():
+        before = baseline.get(case)
+        if before is None:
+            continue
+        for key in COMPARED:
+            if key not in metrics or not before.get(key):
+                continue
+            ratio = metrics[key] / before[key]
+            if ratio > tolerance or ratio < 1 / tolerance:
+                worse = ratio > tolerance
+                regressions += worse
+                print(f"{'WORSE' if worse else 'better':6} {case}: {key} {before[key]:,.4g} -> {metrics[key]:,.4g} ({ratio:.2f}x)")
+    missing = set(baseline) - set(results)
+    if missing:
+        print(f"{len(missing)} baseline cases were not run")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, nargs="+", default=[1, 50, 150, 193])
+    parser.add_argument("--periods", type=int, nargs="+", default=[0, 10, 50])
+    parser.add_argument("--dob", type=int, nargs="+", default=[1930, 1975, datetime.date.today().year - 1])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is reported (default: 3)")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare the results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="ratio counted as a change (default: 1.25)")
+    args = parser.parse_args(argv)
+    # Load the flag pack now rather than while the first cases run
+    countryGen_dash.FLAG_CACHE.warm(background=False)
+    results = run_suite(args.countries, args.periods, args.dob, args.repeat)
+    if args.save:
+        tmp_path = f"{args.save}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, args.save)
+        print(f"Saved {len(results)} cases to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"{regressions} regressions against {args.compare}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
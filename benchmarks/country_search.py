@@ -0,0 +1,59 @@
+"""Country search: index build time and per-query latency.
+
+Times every prefix of every country name and alias (what typing them produces), plus
+queries that miss the precomputed prefixes: several partial words, text from the middle
+of a word and text that matches nothing. Reports the median, 99th percentile and worst
+time per kind of query.
+
+    python benchmarks/country_search.py [--repeat 20]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from country_search import COUNTRY_ALIASES, CountrySearchIndex  # noqa: E402
+from engine import get_registry  # noqa: E402
+
+OTHER_QUERIES = {
+    "several words": ["united k", "bos her", "st luc", "rep of ko", "new gu", "south su", "dem rep con"],
+    "middle of a word": ["many", "land", "stan", "ague", "ivoi", "zeala", "bwe"],
+    "no match": ["xyzzy", "qqq", "zz top", "ger xyz"],
+}
+
+def typed_queries(registry):
+    # Every prefix of every name and alias, as typed
+    texts = [c.name for c in registry.countries] + [alias for aliases in COUNTRY_ALIASES.values() for alias in aliases]
+    return sorted({text[:end] for text in texts for end in range(1, len(text) + 1)})
+
+def time_queries(index, queries, repeat):
+    # Best of repeat runs per query, in microseconds
+    times = []
+    for query in queries:
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            index.search(query)
+            best = min(best, time.perf_counter() - started)
+        times.append(best * 1e6)
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query, the fastest is reported (default: 20)")
+    args = parser.parse_args(argv)
+    registry = get_registry()
+    started = time.perf_counter()
+    index = CountrySearchIndex(registry)
+    print(f"index built in {(time.perf_counter() - started) * 1e3:.1f} ms")
+    print(f"{'queries':18} {'count':>6} {'median us':>10} {'p99 us':>8} {'max us':>8}")
+    for kind, queries in [("typed prefixes", typed_queries(registry))] + list(OTHER_QUERIES.items()):
+        times = sorted(time_queries(index, queries, args.repeat))
+        p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+        print(f"{kind:18} {len(times):>6} {statistics.median(times):>10.1f} {p99:>8.1f} {times[-1]:>8.1f}")
+
+if __name__ == "__main__":
+    main()
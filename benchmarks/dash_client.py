@@ -0,0 +1,164 @@
+"""Calls the app's server callbacks through Dash's update endpoint, the way the page does.
+
+Shared by the benchmarks: Endpoint sends one callback's inputs from a dict of values, and
+Client also keeps the component tree a callback returns, like the browser, so patches can
+be applied to it and MATCH callbacks fired for its rows. Requests go to the Flask test client.
+"""
+import json
+
+import plotly
+
+def encode(obj):
+    return json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder)
+
+def walk(node):
+    if isinstance(node, list):
+        for child in node:
+            yield from walk(child)
+    elif isinstance(node, dict):
+        if "props" in node:
+            yield node
+            yield from walk(node["props"].get("children"))
+
+def post(http, body):
+    response = http.post("/_dash-update-component", data=encode(body), content_type="application/json")
+    if response.status_code not in (200, 204):
+        raise RuntimeError(f"{body['output']}: HTTP {response.status_code}")
+    return response
+
+class Endpoint:
+    """Calls one server callback with values given as {"component.property": value}."""
+
+    def __init__(self, app, output):
+        self.http = app.server.test_client()
+        self.output = output
+        self.callback = app.callback_map[output]
+
+    def value(self, dep, values):
+        dep_id = json.loads(dep["id"]) if dep["id"].startswith("{") else dep["id"]
+        if isinstance(dep_id, dict):
+            # ALL wildcard: one entry per row, values[type] holding the rows' values
+            ids = [{"type": dep_id["type"], "index": i} for i in range(len(values.get(dep_id["type"], [])))]
+            return [{"id": row_id, "property": dep["property"], "value": row_id if dep["property"] == "id" else value}
+                    for row_id, value in zip(ids, values.get(dep_id["type"], []))]
+        return {"id": dep_id, "property": dep["property"], "value": values.get(f"{dep_id}.{dep['property']}")}
+
+    def __call__(self, values, changed):
+        component, prop = self.output.split(".")
+        return post(self.http, {
+            "output": self.output,
+            "outputs": {"id": component, "property": prop},
+            "inputs": [self.value(dep, values) for dep in self.callback["inputs"]],
+            "changedPropIds": changed,
+            "state": [self.value(dep, values) for dep in self.callback["state"]],
+        }).data
+
+class Client:
+    """Just enough of the browser: the component tree under one container, and the other inputs."""
+
+    def __init__(self, app, output, values):
+        self.http = app.server.test_client()
+        self.output = output
+        self.callback = app.callback_map[output]
+        self.children = None
+        self.values = values
+        # Server callbacks fired for a new row component, by component type
+        self.match_callbacks = {}
+        self.specs = {}
+        for spec in app._callback_list:
+            if spec.get("clientside_function"):
+                continue
+            self.specs[spec["output"]] = spec
+            for dep in spec["inputs"]:
+                dep_id = json.loads(dep["id"]) if dep["id"].startswith("{") else None
+                if dep_id and dep_id.get("index") == ["MATCH"]:
+                    self.match_callbacks.setdefault(dep_id["type"], set()).add(spec["output"])
+
+    def components(self):
+        return {json.dumps(node["props"]["id"], sort_keys=True): node for node in walk(self.children or [])
+                if isinstance(node["props"].get("id"), dict)}
+
+    def rows(self, row_type):
+        return [node for node in walk(self.children or []) if isinstance(node["props"].get("id"), dict)
+                and node["props"]["id"]["type"] == row_type]
+
+    def value(self, dep, index=None):
+        dep_id = json.loads(dep["id"]) if dep["id"].startswith("{") else dep["id"]
+        if isinstance(dep_id, dict) and dep_id.get("index") == ["MATCH"]:
+            # MATCH wildcard: the component of the row the callback runs for
+            row_id = {"type": dep_id["type"], "index": index}
+            node = self.components()[json.dumps(row_id, sort_keys=True)]
+            return {"id": row_id, "property": dep["property"], "value": node["props"].get(dep["property"])}
+        if isinstance(dep_id, dict):
+            # ALL wildcard: one entry per matching component, in layout order
+            return [{"id": node["props"]["id"], "property": dep["property"], "value": node["props"].get(dep["property"])}
+                    for node in self.rows(dep_id["type"])]
+        prop_id = f"{dep_id}.{dep['property']}"
+        value = self.children if prop_id == self.output else self.values.get(prop_id)
+        return {"id": dep_id, "property": dep["property"], "value": value}
+
+    def fire(self, changed):
+        # The container's callback; returns the bytes sent and received, and the requests it
+        # causes: itself and the MATCH callbacks of every row component it (re)created
+        component, prop = self.output.split(".")
+        body = {
+            "output": self.output,
+            "outputs": {"id": component, "property": prop},
+            "inputs": [self.value(dep) for dep in self.callback["inputs"]],
+            "changedPropIds": changed,
+            "state": [self.value(dep) for dep in self.callback["state"]],
+        }
+        request_bytes = len(encode(body))
+        before = set(self.components())
+        response = post(self.http, body)
+        if response.status_code == 204:
+            return request_bytes, 0, 1
+        result = response.get_json()["response"][component][prop]
+        self.apply(result)
+        created = [node for key, node in self.components().items() if key not in before or not isinstance(result, dict)]
+        # Each MATCH callback runs once per row that got new components, however many of them it listens to
+        followups = {(callback, node["props"]["id"]["index"]) for node in created
+                     for callback in self.match_callbacks.get(node["props"]["id"]["type"], ())
+                     if not self.specs[callback].get("prevent_initial_call")}
+        return request_bytes, len(response.data), 1 + len(followups)
+
+    def fire_row(self, output, index, changed):
+        # One MATCH callback for the row with this index; its outputs aren't tracked
+        spec = self.specs[output]
+        outputs = [{"id": {"type": json.loads(dep_id)["type"], "index": index}, "property": prop}
+                   for dep_id, prop in (part.rsplit(".", 1) for part in output.strip(".").split("..."))]
+        body = {
+            "output": output,
+            "outputs": outputs,
+            "inputs": [self.value(dep, index) for dep in spec["inputs"]],
+            "changedPropIds": changed,
+            "state": [self.value(dep, index) for dep in spec["state"]],
+        }
+        return len(encode(body)), len(post(self.http, body).data)
+
+    def fire_row_callbacks(self, row_type, index, changed):
+        # Every MATCH callback listening to the row's component of this type; returns the bytes
+        # sent and received and the number of requests
+        totals = [0, 0, 0]
+        for output in sorted(self.match_callbacks.get(row_type, ())):
+            request_bytes, response_bytes = self.fire_row(output, index, changed)
+            totals = [totals[0] + request_bytes, totals[1] + response_bytes, totals[2] + 1]
+        return totals
+
+    def apply(self, result):
+        if not (isinstance(result, dict) and "__dash_patch_update" in result):
+            self.children = result
+            return
+        for op in result["operations"]:
+            *path, last = op["location"] or [None]
+            target = self.children
+            for key in path:
+                target = target[key]
+            if op["operation"] == "Append":
+                (target[last] if last is not None else target).append(op["params"]["value"])
+            elif op["operation"] == "Delete":
+                del target[last]
+            elif op["operation"] == "Assign":
+                target[last] = op["params"]["value"]
+            else:
+                raise NotImplementedError(op["operation"])
@@ -0,0 +1,136 @@
+"""Location history import: reading, geocoding and end-to-end throughput on synthetic data.
+
+No boundary data ships with the app, so this draws its own: one jagged polygon (a few
+thousand vertices, some with a hole) per country on a grid, written as GeoJSON. It then
+writes a wandering traveller's history as Records.json, GPX and CSV, and reports points
+per minute for reading each format, for geocoding in one process, and for a whole import
+through the worker pool. Geocoded answers are checked against a brute-force ray cast.
+
+    python benchmarks/location_import.py [--points 1000000] [--countries 60] [--vertices 2000]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from country_catalogue import UN_MEMBER_ALPHA2  # noqa: E402
+from location_import import READERS, BoundaryIndex, LocationImporter, feature_rings, locate_batch  # noqa: E402
+
+def synthetic_boundaries(n_countries, n_vertices, seed=0):
+    # Countries on a 10-degree grid, each a wobbly star inside its square
+    rnd = random.Random(seed)
+    codes = sorted(UN_MEMBER_ALPHA2)[:n_countries]
+    features = []
+    for i, code in enumerate(codes):
+        cx, cy = -175 + 10 * (i % 34) + 5, -60 + 10 * (i // 34) + 5
+        ring = []
+        for k in range(n_vertices):
+            angle = 2 * math.pi * k / n_vertices
+            radius = 3.5 + 1.2 * math.sin(7 * angle) + rnd.uniform(-0.2, 0.2)
+            ring.append([cx + radius * math.cos(angle), cy + radius * math.sin(angle)])
+        rings = [ring + [ring[0]]]
+        if i % 3 == 0:
+            # A lake
+            rings.append([[cx + 0.5 * math.cos(a / 8 * 2 * math.pi), cy + 0.5 * math.sin(a / 8 * 2 * math.pi)] for a in range(9)])
+        features.append({"type": "Feature", "properties": {"ISO_A2": code}, "geometry": {"type": "Polygon", "coordinates": rings}})
+    return {"type": "FeatureCollection", "features": features}
+
+def synthetic_track(n_points, seed=0):
+    # (lat, lon, epoch ms): stays around a place, then jumps somewhere else
+    rnd = random.Random(seed)
+    ms = 1262304000000  # 2010-01-01
+    lat, lon = 0.0, 0.0
+    for i in range(n_points):
+        if i % 5000 == 0:
+            lat, lon = rnd.uniform(-60, 20), rnd.uniform(-175, 165)
+        lat = max(-89.9, min(89.9, lat + rnd.uniform(-0.01, 0.01)))
+        lon = max(-179.9, min(179.9, lon + rnd.uniform(-0.01, 0.01)))
+        ms += 60000
+        yield lat, lon, ms
+
+def write_histories(directory, n_points):
+    paths = {fmt: os.path.join(directory, f"history.{fmt}") for fmt in READERS}
+    with open(paths["json"], "w") as records, open(paths["gpx"], "w") as gpx, open(paths["csv"], "w") as csv_file:
+        records.write('{"locations": [')
+        gpx.write('<?xml version="1.0"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+        csv_file.write("timestamp,latitude,longitude\n")
+        for i, (lat, lon, ms) in enumerate(synthetic_track(n_points)):
+            iso = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ms / 1000))
+            records.write(("," if i else "") + json.dumps({
+                "latitudeE7": round(lat * 1e7), "longitudeE7": round(lon * 1e7), "accuracy": 12, "source": "WIFI",
+                "activity": [{"activity": [{"type": "STILL", "confidence": 80}], "timestamp": iso}],
+                "timestamp": iso}))
+            gpx.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>12</ele><time>{iso}</time></trkpt>\n')
+            csv_file.write(f"{iso},{lat:.7f},{lon:.7f}\n")
+        records.write("]}")
+        gpx.write("</trkseg></trk></gpx>\n")
+    return paths
+
+def brute_force(features, lat, lon):
+    for feature in features:
+        inside = False
+        for ring in feature_rings(feature["geometry"]):
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+        if inside:
+            return feature["properties"]["ISO_A2"]
+    return None
+
+def per_minute(count, seconds):
+    return count / seconds * 60 if seconds else float("inf")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--countries", type=int, default=60)
+    parser.add_argument("--vertices", type=int, default=2000)
+    parser.add_argument("--check", type=int, default=2000, help="points checked against a brute-force ray cast (default: 2000)")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        boundaries = synthetic_boundaries(args.countries, args.vertices)
+        boundaries_path = os.path.join(directory, "boundaries.geojson")
+        with open(boundaries_path, "w") as f:
+            json.dump(boundaries, f)
+        started = time.perf_counter()
+        index = BoundaryIndex.load(boundaries_path)
+        print(f"boundaries: {args.countries} countries x {args.vertices} vertices, index built in {time.perf_counter() - started:.2f}s")
+        rnd = random.Random(1)
+        sample = [(rnd.uniform(-62, 32), rnd.uniform(-178, 178)) for _ in range(args.check)]
+        wrong = sum(index.locate(lat, lon) != brute_force(boundaries["features"], lat, lon) for lat, lon in sample)
+        print(f"check: {wrong} of {len(sample)} random points disagree with a brute-force ray cast")
+        paths = write_histories(directory, args.points)
+        print(f"{'step':28} {'MB':>8} {'seconds':>8} {'points/min':>12}")
+        points = None
+        for fmt, path in paths.items():
+            started = time.perf_counter()
+            with open(path, "rb") as f:
+                points = list(READERS[fmt](f))
+            seconds = time.perf_counter() - started
+            print(f"{'read ' + fmt:28} {os.path.getsize(path) / 1e6:>8.1f} {seconds:>8.2f} {per_minute(len(points), seconds):>12,.0f}")
+        lats, lons, months = zip(*points)
+        started = time.perf_counter()
+        locate_batch(boundaries_path, lats, lons, months)
+        seconds = time.perf_counter() - started
+        print(f"{'geocode (one process)':28} {'':>8} {seconds:>8.2f} {per_minute(len(points), seconds):>12,.0f}")
+        importer = LocationImporter(boundaries_path)
+        for fmt, path in paths.items():
+            # The importer deletes its upload when done, so give it a copy
+            upload = f"{path}.upload"
+            os.link(path, upload)
+            started = time.perf_counter()
+            importer.reserve()
+            job = importer.start(upload, fmt)
+            while job.state in ("queued", "running"):
+                time.sleep(0.05)
+            seconds = time.perf_counter() - started
+            print(f"{'import ' + fmt + f' ({importer.workers} workers)':28} {'':>8} {seconds:>8.2f} {per_minute(job.points, seconds):>12,.0f}  {len(job.earliest)} countries {job.error or ''}")
+
+if __name__ == "__main__":
+    main()
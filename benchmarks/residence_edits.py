@@ -0,0 +1,93 @@
+"""Request count and payload size per residence-table edit.
+
+Replays a series of edits against the residence rows callback through Dash's real
+update endpoint (Flask test client) and tracks the rows like the browser would.
+For each edit it reports the bytes sent and received, and how many server requests
+the edit causes: the callback itself plus one per server-side MATCH callback on
+every row component that was (re)created. Editing a value in a row only runs that
+row's MATCH callbacks: the ones that update its date options, and the one that records
+the edit (numbered in the browser, as stampEdit does) in the session.
+
+    python benchmarks/residence_edits.py [--rows 6]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import countryGen_dash  # noqa: E402
+from dash_client import Client  # noqa: E402
+from sessions import new_session_key  # noqa: E402
+
+OUTPUT = "residence_periods_container.children"
+
+class ResidenceTable(Client):
+    """The residence table of a new page, and the edits made to it."""
+
+    def __init__(self, app, countries, dob):
+        session_key = new_session_key()
+        countryGen_dash.SESSIONS.create(session_key)
+        super().__init__(app, OUTPUT, {
+            "country_select.value": countries,
+            "dob_year.value": dob[0],
+            "dob_month.value": dob[1],
+            "residence_section.style": {"display": "block"},
+            "add_residence_period_btn.n_clicks": 0,
+            "session_key.data": session_key,
+        })
+        self.edit_counts = {}
+
+    def set_row_value(self, position, row_type, value):
+        # Runs the row's MATCH callbacks that listen to the value, as the browser would
+        node = self.rows(row_type)[position]
+        node["props"]["value"] = value
+        changed = [json.dumps(node["props"]["id"], separators=(",", ":"), sort_keys=True) + ".value"]
+        index = node["props"]["id"]["index"]
+        totals = self.fire_row_callbacks(row_type, index, changed)
+        # The edit, numbered in the browser, then recorded
+        components = self.components()
+        values = [components[json.dumps({"type": value_type, "index": index}, sort_keys=True)]["props"].get("value")
+                  for value_type in ("res_country", "res_from_year", "res_from_month", "res_until_year", "res_until_month")]
+        self.edit_counts[index] = self.edit_counts.get(index, 0) + 1
+        stamp_id = {"type": "res_edit", "index": index}
+        components[json.dumps(stamp_id, sort_keys=True)]["props"]["data"] = {"values": values, "count": self.edit_counts[index]}
+        changed = [json.dumps(stamp_id, separators=(",", ":"), sort_keys=True) + ".data"]
+        recorded = self.fire_row_callbacks("res_edit", index, changed)
+        return tuple(total + more for total, more in zip(totals, recorded))
+
+    def click_remove(self, position):
+        node = self.rows("remove_residence_period")[position]
+        node["props"]["n_clicks"] = (node["props"].get("n_clicks") or 0) + 1
+        return [json.dumps(node["props"]["id"], separators=(",", ":"), sort_keys=True) + ".n_clicks"]
+
+    def click_add(self):
+        self.values["add_residence_period_btn.n_clicks"] += 1
+        return ["add_residence_period_btn.n_clicks"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=6, help="rows to build before editing (default: 6)")
+    args = parser.parse_args(argv)
+    labels = countryGen_dash.country_options[:args.rows + 2]
+    client = ResidenceTable(countryGen_dash.app, labels, (1950, 1))
+    edits = [("initial render", lambda: client.fire(["residence_section.style"]))]
+    edits += [(f"add row {i + 2}", lambda: client.fire(client.click_add())) for i in range(args.rows - 1)]
+    edits += [
+        ("change country of row 2", lambda: client.set_row_value(1, "res_country", labels[-1])),
+        ("change 'from' month of row 3", lambda: client.set_row_value(2, "res_from_month", 6)),
+        ("move last row's 'until' before 'from'", lambda: client.set_row_value(-1, "res_until_year", datetime.date.today().year - 2)),
+        ("remove row 2", lambda: client.fire(client.click_remove(1))),
+    ]
+    print(f"{'edit':38} {'requests':>8} {'sent':>9} {'received':>9}")
+    totals = [0, 0, 0]
+    for name, edit in edits:
+        request_bytes, response_bytes, requests = edit()
+        totals = [totals[0] + requests, totals[1] + request_bytes, totals[2] + response_bytes]
+        print(f"{name:38} {requests:>8} {request_bytes:>9,} {response_bytes:>9,}")
+    print(f"{'total':38} {totals[0]:>8} {totals[1]:>9,} {totals[2]:>9,}")
+
+if __name__ == "__main__":
+    main()
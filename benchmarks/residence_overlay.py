@@ -0,0 +1,80 @@
+"""Residence overlay clipping: nested visit x period loop vs. the Timeline arrays.
+
+Builds a synthetic profile (by default 200 visited countries and 50 residence
+periods), checks both ways produce the same gold segments and times them.
+
+    python benchmarks/residence_overlay.py [--countries 200] [--periods 50] [--repeat 200]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+from engine import get_registry, make_inputs  # noqa: E402
+from timeline import Timeline  # noqa: E402
+
+def synthetic_inputs(registry, n_countries, n_periods, seed=0):
+    rnd = random.Random(seed)
+    dob_year, dob_month = 1950, 3
+    codes = [c.alpha_2 for c in registry.countries]
+    # A country is visited for the first time once, so the registry size caps the count
+    picked = rnd.sample(codes, min(n_countries, len(codes)))
+    visits = [(code, rnd.randint(dob_year, 2025), rnd.randint(1, 12)) for code in picked]
+    residences = []
+    for _ in range(n_periods):
+        from_year = rnd.randint(dob_year, 2024)
+        until_year = rnd.randint(from_year, 2025)
+        residences.append((rnd.choice(picked), from_year, rnd.randint(1, 12), until_year, rnd.randint(1, 12)))
+    return make_inputs(dob_year, dob_month, visits, residences, datetime.date(2025, 6, 1))
+
+def nested_loop_segments(inputs):
+    # The builder's original approach: for every bar, scan every period
+    dob_year, dob_month = inputs["dob"]
+    today_year, today_month = inputs["today"]
+    visited = sorted(
+        ({"code": code, "age": (y - dob_year) + (m - dob_month) / 12} for code, y, m in inputs["visits"]),
+        key=lambda v: v["age"],
+    )[::-1]
+    current_age = (today_year - dob_year) + (today_month - dob_month) / 12
+    periods = [{"code": code, "from_age": (fy - dob_year) + (fm - dob_month) / 12, "until_age": (uy - dob_year) + (um - dob_month) / 12}
+               for code, fy, fm, uy, um in inputs["residences"]]
+    rows, starts, ends = [], [], []
+    for i, v in enumerate(visited):
+        for period in periods:
+            if period["code"] == v["code"]:
+                start = max(period["from_age"], v["age"])
+                end = min(period["until_age"], current_age)
+                if end > start:
+                    rows.append(i)
+                    starts.append(start)
+                    ends.append(end)
+    return np.array(rows), np.array(starts), np.array(ends)
+
+def timeline_segments(inputs, registry):
+    return Timeline.from_inputs(inputs, registry).residence_segments()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, default=200)
+    parser.add_argument("--periods", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+    registry = get_registry()
+    inputs = synthetic_inputs(registry, args.countries, args.periods)
+    expected = nested_loop_segments(inputs)
+    got = timeline_segments(inputs, registry)
+    for a, b in zip(expected, got):
+        assert np.array_equal(a, b), "segments differ"
+    print(f"{len(inputs['visits'])} countries, {len(inputs['residences'])} periods, {len(got[0])} gold segments")
+    for name, run in (("nested loop", lambda: nested_loop_segments(inputs)),
+                      ("timeline arrays", lambda: timeline_segments(inputs, registry))):
+        seconds = min(timeit.repeat(run, number=args.repeat, repeat=5)) / args.repeat
+        print(f"{name:16} {seconds * 1e6:10.1f} us")
+
+if __name__ == "__main__":
+    main()
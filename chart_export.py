@@ -0,0 +1,137 @@
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# --- Server-side chart export: figures rendered to PNG/SVG/PDF in a bounded process pool ---
+# Rendering uses kaleido, which ships its own headless browser, so it works offline.
+EXPORT_FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+}
+EXPORT_WIDTH = 900
+EXPORT_SCALE = 2  # only affects raster output
+EXPORT_WORKERS = 2
+EXPORT_QUEUE = 8  # renders allowed to wait for a worker before we start refusing
+EXPORT_TIMEOUT = 60
+EXPORT_CACHE_BYTES = 128 * 1024 * 1024
+
+class ExportBusy(Exception):
+    pass
+
+class ExportTimeout(Exception):
+    pass
+
+def render_figure(figure_json, fmt, width=EXPORT_WIDTH, scale=EXPORT_SCALE):
+    # Runs in a pool worker; imported here so the web process never loads kaleido itself
+    import plotly.io as pio
+    fig = pio.from_json(figure_json, skip_invalid=True)
+    # Figures drawn at a fixed width (flag atlas mode) are exported at that width
+    return pio.to_image(fig, format=fmt, width=fig.layout.width or width, scale=scale, engine="kaleido")
+
+class ChartExporter:
+    """Renders figures in a process pool, refusing work beyond a bounded queue and caching output."""
+
+    def __init__(self, workers=EXPORT_WORKERS, queue=EXPORT_QUEUE, timeout=EXPORT_TIMEOUT, cache_bytes=EXPORT_CACHE_BYTES):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_bytes = cache_bytes
+        self.rendered = 0
+        self.cache_hits = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._pool = None
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Started on first use so importing the app never starts render workers. Workers are
+        # spawned rather than forked, so they don't inherit the web server's threads and locks.
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _restart(self, pool):
+        # A render that timed out can't be cancelled once it runs, and a hung one would keep its
+        # worker and slot for good. Kill the pool's workers: every render still on it fails (which
+        # frees its slot), and the next export starts a new pool.
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self.restarts += 1
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _cached(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return data
+
+    def _store(self, key, data):
+        with self._lock:
+            if key in self._cache or len(data) > self.cache_bytes:
+                return
+            self._cache[key] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+
+    def export(self, key, fmt, load_figure):
+        # key identifies the figure as it is drawn (flags included), so output is cached per figure and
+        # format; load_figure is only called on a miss and returns the figure JSON, or None if it is unknown
+        cache_key = (key, fmt)
+        data = self._cached(cache_key)
+        if data is not None:
+            return data
+        figure_json = load_figure()
+        if figure_json is None:
+            return None
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise ExportBusy(f"{self.workers} renders running and the queue is full")
+        try:
+            pool = self._executor()
+            future = pool.submit(render_figure, figure_json, fmt)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is freed when the render really finishes (or its worker is killed)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            data = future.result(timeout=self.timeout)
+        except TimeoutError:
+            if not future.cancel():
+                self._restart(pool)
+            self.timeouts += 1
+            raise ExportTimeout(f"render took longer than {self.timeout}s")
+        except BrokenProcessPool:
+            # Killed along with a render that timed out
+            raise ExportBusy("render workers were restarted")
+        self.rendered += 1
+        self._store(cache_key, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rendered": self.rendered,
+                "cache_hits": self.cache_hits,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "restarts": self.restarts,
+                "cached": len(self._cache),
+                "cached_bytes": self._cache_size,
+            }
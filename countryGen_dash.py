@@ -1,84 +1,53 @@
 import dash
 from dash import dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
-import plotly.graph_objs as go
-import os
-import requests
-import numpy as np
+import bisect
 import datetime
-import pycountry
-import pycountry_convert
-import country_converter as coco
-from PIL import Image
-import base64
-import io
-from dash.dependencies import ALL, MATCH
+import hashlib
+import json
+import os
+from dash.dependencies import ALL, MATCH, ClientsideFunction
 import dash_mantine_components as dmc
 from dash.exceptions import PreventUpdate
-from dash import ctx
+from dash import ctx, Patch
 from dash import callback_context
+from engine import DEFAULT_VISIT, WINDOW_ROWS, build_figure, get_registry, is_atlas_spec, is_windowed, make_inputs, visible_rows, window_contents, window_figure, window_height, window_rows
+from flags import FLAG_FETCH_TIMEOUT, FlagAtlasCache, FlagCache, atlas_enabled, atlas_spec, flag_key, parse_atlas_spec
+from intervals import PeriodIndex, free_options, month_index
+from dropdown_options import MONTH_OPTIONS, month_option, month_options, year_option, year_options
+from figure_cache import figure_cache_key, is_cache_key, make_figure_cache
+from chart_export import EXPORT_FORMATS, ChartExporter, ExportBusy, ExportTimeout
+from metrics import enabled as metrics_enabled, install as install_metrics
+from sessions import SessionExpired, make_session_store, new_session_key, page_digest, record_edit
+from country_search import SEARCH_LIMIT, CountrySearchIndex, search_text
+from location_import import IMPORT_MAX_BYTES, ImportBusy, LocationImporter, UploadTooLarge, detect_format, spool_upload
+from flask import Response, abort, jsonify, redirect, request
 
 # --- Data Preparation (same as Streamlit version) ---
-continent_map = {
-    'AF': 'Africa',
-    'AS': 'Asia',
-    'EU': 'Europe',
-    'NA': 'North America',
-    'OC': 'Oceania',
-    'SA': 'South America',
-    'AN': 'Antarctica'
-}
-UN_MEMBER_ALPHA2 = set([
-    'AF', 'AL', 'DZ', 'AD', 'AO', 'AG', 'AR', 'AM', 'AU', 'AT', 'AZ',
-    'BS', 'BH', 'BD', 'BB', 'BY', 'BE', 'BZ', 'BJ', 'BT', 'BO', 'BA', 'BW',
-    'BR', 'BN', 'BG', 'BF', 'BI', 'CV', 'KH', 'CM', 'CA', 'CF', 'TD', 'CL',
-    'CN', 'CO', 'KM', 'CD', 'CG', 'CR', 'CI', 'HR', 'CU', 'CY', 'CZ', 'DK',
-    'DJ', 'DM', 'DO', 'EC', 'EG', 'SV', 'GQ', 'ER', 'EE', 'SZ', 'ET', 'FJ',
-    'FI', 'FR', 'GA', 'GM', 'GE', 'DE', 'GH', 'GR', 'GD', 'GT', 'GN', 'GW',
-    'GY', 'HT', 'HN', 'HU', 'IS', 'IN', 'ID', 'IR', 'IQ', 'IE', 'IL', 'IT',
-    'JM', 'JP', 'JO', 'KZ', 'KE', 'KI', 'KP', 'KR', 'KW', 'KG', 'LA', 'LV',
-    'LB', 'LS', 'LR', 'LY', 'LI', 'LT', 'LU', 'MG', 'MW', 'MY', 'MV', 'ML',
-    'MT', 'MH', 'MR', 'MU', 'MX', 'FM', 'MD', 'MC', 'MN', 'ME', 'MA', 'MZ',
-    'MM', 'NA', 'NR', 'NP', 'NL', 'NZ', 'NI', 'NE', 'NG', 'MK', 'NO', 'OM',
-    'PK', 'PW', 'PS', 'PA', 'PG', 'PY', 'PE', 'PH', 'PL', 'PT', 'QA', 'RO',
-    'RU', 'RW', 'KN', 'LC', 'VC', 'WS', 'SM', 'ST', 'SA', 'SN', 'RS', 'SC',
-    'SL', 'SG', 'SK', 'SI', 'SB', 'SO', 'ZA', 'SS', 'ES', 'LK', 'SD', 'SR',
-    'SE', 'CH', 'SY', 'TW', 'TJ', 'TZ', 'TH', 'TL', 'TG', 'TO', 'TT', 'TN',
-    'TR', 'TM', 'UG', 'UA', 'AE', 'GB', 'US', 'UY', 'UZ', 'VU', 'VA', 'VE',
-    'VN', 'YE', 'ZM', 'ZW', 'AQ'
-])
-COUNTRY_LIST = []
-def get_continent(alpha_2):
-    special_cases = {
-        'AQ': 'Antarctica',
-        'TL': 'Asia',
-        'VA': 'Europe',
-        'TR': 'Europe',
-    }
-    if alpha_2 in special_cases:
-        return special_cases[alpha_2]
-    try:
-        continent_code = pycountry_convert.country_alpha2_to_continent_code(alpha_2)
-        return continent_map.get(continent_code, 'Unknown')
-    except Exception:
-        return 'Unknown'
-for country in list(pycountry.countries):
-    if hasattr(country, 'alpha_2') and country.alpha_2 in UN_MEMBER_ALPHA2:
-        short_name = coco.convert(names=country.alpha_2, to='name_short')
-        COUNTRY_LIST.append({
-            "name": short_name,
-            "alpha_2": country.alpha_2,
-            "continent": get_continent(country.alpha_2)
-        })
-country_options = [f"{c['name']} ({c['alpha_2']})" for c in COUNTRY_LIST]
+# The catalogue is precomputed by country_catalogue.py; see there for how it is built.
+# Shared with the chart engine, which builds every figure (see engine.py).
+COUNTRY_REGISTRY = get_registry()
+COUNTRY_LIST = COUNTRY_REGISTRY.countries
+country_options = COUNTRY_REGISTRY.labels()
+# Names, codes and aliases, searched as the user types (see country_search.py)
+COUNTRY_SEARCH = CountrySearchIndex(COUNTRY_REGISTRY)
+# Built figures, keyed by their normalized inputs (see figure_cache.py for the backends)
+FIGURE_CACHE = make_figure_cache()
+# Each page's visit and residence tables, so callbacks don't need every row sent to them (see sessions.py)
+SESSIONS = make_session_store()
+# Shown instead of the tables when the session has gone, rather than rebuilding them from defaults
+SESSION_EXPIRED = "This page's session has expired, please reload the page."
+GENERATE_RETRY_MS = 100  # Generate! asks again this often while edits are still on their way to the session
+GENERATE_RETRIES = 20  # ... and gives up after this many tries
+# First visits read from an uploaded GPS history; offered when boundary data is installed (see location_import.py)
+LOCATION_IMPORTER = LocationImporter()
 
 # --- Dash App Layout ---
 today = datetime.date.today()
 current_year = today.year
 current_month = today.month
-months_full = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
-app.layout = dmc.MantineProvider(
+PAGE = dmc.MantineProvider(
     html.Div([
         html.Div([
             dbc.Container([
@@ -111,14 +80,14 @@ app.layout = dmc.MantineProvider(
                     html.Div("When were you born?", style={"fontSize": 15, "fontWeight": 400, "color": "#444", "marginBottom": 6, "width": "220px", "display": "inline-block", "verticalAlign": "middle", "marginRight": "10px", "textAlign": "left"}),
             dcc.Dropdown(
                 id="dob_year",
-                options=[{"label": str(y), "value": y} for y in range(1900, current_year + 1)],
+                options=year_options(1900, current_year),
                 value=1990,
                 clearable=False,
                 style={"width": "140px", "display": "inline-block", "verticalAlign": "middle", "marginRight": "20px"}
             ),
             dcc.Dropdown(
                 id="dob_month",
-                        options=[{"label": month, "value": i+1} for i, month in enumerate(months_full[:current_month])],
+                        options=MONTH_OPTIONS[:current_month],
                 value=1,
                 clearable=False,
                 style={"width": "120px", "display": "inline-block", "verticalAlign": "middle"}
@@ -128,19 +97,28 @@ app.layout = dmc.MantineProvider(
                 html.H4("Travel timeline", style={"marginTop": "12px", "marginBottom": "12px"}),
                 html.Div([
                     # Big header 'Timeline of first visits' now removed, only subheader remains
-            dmc.MultiSelect(
+            # Options come from the server as the user types (see search_country_options)
+            dcc.Dropdown(
                 id="country_select",
-                        data=[label for label in country_options],
+                        options=[],
                 value=[],
+                multi=True,
                         placeholder="Where have you visited?",
                 searchable=True,
                 clearable=True,
-                maxDropdownHeight=300,
-                        style={"width": "510px"},
-                        disabled=True
+                maxHeight=300,
+                        style={"width": "510px"}
                     ),
-                    dcc.Interval(id="country_select_timer", interval=2000, n_intervals=0, max_intervals=1),
                 ], style={"flex": 1, "minWidth": "520px", "maxWidth": "600px", "marginBottom": "24px"}),
+                # Location history import: the button picks a file, which is uploaded straight to
+                # /import/location-history (see uploadLocationHistory)
+                html.Div([
+                    html.Div("Or import them from your location history (Google Takeout JSON, GPX or CSV):", style={"fontSize": 14, "color": "#444", "marginBottom": "6px"}),
+                    html.Button("Import location history", id="import_location_btn", n_clicks=0, style={"backgroundColor": "#e0e0e0", "color": "#222", "border": "none", "padding": "6px 14px", "borderRadius": "6px", "fontWeight": 600, "fontSize": "14px", "cursor": "pointer"}),
+                    html.Div(id="import_status", style={"fontSize": 13, "color": "#666", "marginTop": "6px"}),
+                    dcc.Store(id="import_job"),
+                    dcc.Interval(id="import_poll", interval=1000, disabled=True),
+                ], id="import_section", style={"display": "block" if LOCATION_IMPORTER.available() else "none", "marginBottom": "24px", "maxWidth": "600px"}),
                 html.Div(
                     "When did you first visit these countries?",
                     id="visit_countries_label",
@@ -157,6 +135,7 @@ app.layout = dmc.MantineProvider(
                 html.Div([
                     html.Button("Add countries of residence", id="toggle_residence_btn", n_clicks=0, style={"backgroundColor": "#e0e0e0", "color": "#222", "border": "none", "padding": "10px 18px", "marginRight": "16px", "borderRadius": "6px", "fontWeight": 600, "fontSize": "15px", "cursor": "pointer"}),
                     dbc.Button("Generate!", id="generate_btn", color="primary", n_clicks=0),
+                    dcc.Interval(id="generate_retry", interval=GENERATE_RETRY_MS, disabled=True),
                 ], style={"display": "flex", "flexDirection": "row", "alignItems": "center"}),
             ], style={"maxWidth": "1200px", "margin": "0 auto"}),
         html.Br(),
@@ -170,110 +149,183 @@ app.layout = dmc.MantineProvider(
     ], style={"background": "#eafbe7", "minHeight": "100vh", "width": "100vw", "paddingTop": "40px"})
 )
 
+def serve_layout():
+    # Every page load starts a new session
+    session_key = new_session_key()
+    SESSIONS.create(session_key)
+    return html.Div([dcc.Store(id="session_key", data=session_key), dcc.Store(id="edit_version", data=0), dcc.Store(id="page_digest"), PAGE])
+
+app.layout = serve_layout
+
 # --- Dynamic Inputs for Visit Dates ---
+# The table is built once, then kept up to date with a Patch: a removed country's row is deleted
+# and an added one inserted, leaving the other rows (and the dates picked in them) untouched.
+# Rows are kept in order of first visit, so a row whose date was edited since the last change
+# is moved back into place (rebuilt from the session, which has its date).
+# The page sends which rows it has (the session may be ahead of it, if a response never arrived);
+# the dates are kept in the session.
+def rows_in_order(positions):
+    # Indexes of a longest run of positions that is already in ascending order
+    tails, tail_indexes, previous = [], [], []
+    for index, position in enumerate(positions):
+        length = bisect.bisect_left(tails, position)
+        previous.append(tail_indexes[length - 1] if length else None)
+        if length == len(tails):
+            tails.append(position)
+            tail_indexes.append(index)
+        else:
+            tails[length] = position
+            tail_indexes[length] = index
+    indexes = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        indexes.add(index)
+        index = previous[index]
+    return indexes
+
 @app.callback(
     Output("visit_inputs", "children"),
     Input("country_select", "value"),
-    State("dob_month", "value"),
-    State("dob_year", "value"),
-    State({"type": "visit_year", "code": ALL}, "value"),
-    State({"type": "visit_month", "code": ALL}, "value"),
+    Input("dob_month", "value"),
+    Input("dob_year", "value"),
     State({"type": "visit_year", "code": ALL}, "id"),
-    State({"type": "visit_month", "code": ALL}, "id"),
+    State("session_key", "data"),
     prevent_initial_call=False
 )
-def update_visit_inputs(selected_labels, dob_month, dob_year, visit_years, visit_months, year_ids, month_ids):
+def update_visit_inputs(selected_labels, dob_month, dob_year, year_ids, session_key):
     if not selected_labels:
+        try:
+            SESSIONS.update(session_key, lambda session: session.update(selected=[], visits={}))
+        except SessionExpired:
+            return SESSION_EXPIRED
         return ""
-    import datetime
     default_month = dob_month or 1
     default_year = dob_year or 1990
-    today = datetime.date.today()
-    current_year = today.year
-    current_month = today.month
-    # Build a dict of selected years for each country code
-    selected_year_dict = {}
-    if year_ids and visit_years:
-        for yid, yval in zip(year_ids, visit_years):
-            if yid and isinstance(yid, dict) and "code" in yid:
-                selected_year_dict[yid["code"]] = yval
-    # Build a dict of selected months for each country code
-    selected_month_dict = {}
-    if month_ids and visit_months:
-        for mid, mval in zip(month_ids, visit_months):
-            if mid and isinstance(mid, dict) and "code" in mid:
-                selected_month_dict[mid["code"]] = mval
-    # Sort selected_labels by (year, month) if possible
-    label_to_date = {}
-    for label in selected_labels:
-        c = next(c for c in COUNTRY_LIST if f"{c['name']} ({c['alpha_2']})" == label)
-        code = c["alpha_2"]
-        year = selected_year_dict.get(code, default_year)
-        month = selected_month_dict.get(code, default_month)
-        label_to_date[label] = (year, month)
-    sorted_labels = sorted(selected_labels, key=lambda l: label_to_date[l])
-    # --- Add column headers for visit table ---
-    header = html.Div([
-        html.Div('Country', style={'width': '280px', 'fontSize': 13, 'color': '#888', 'fontWeight': 500, 'textAlign': 'left', 'lineHeight': '20px', 'marginRight': '8px'}),
-        html.Div('First visited in...', style={'width': '180px', 'fontSize': 13, 'color': '#888', 'fontWeight': 500, 'textAlign': 'center', 'lineHeight': '20px', 'marginRight': '16px', 'display': 'flex', 'justifyContent': 'center', 'alignItems': 'center'}),
-        html.Div('', style={'width': '120px'}),
-        html.Div('', style={'flex': 1}),
-    ], style={'display': 'flex', 'flexDirection': 'row', 'alignItems': 'center', 'marginBottom': '2px', 'marginLeft': '2px'})
-    inputs = []
-    for label in sorted_labels:
-        c = next(c for c in COUNTRY_LIST if f"{c['name']} ({c['alpha_2']})" == label)
-        code = c["alpha_2"]
-        selected_year = selected_year_dict.get(code, default_year)
-        selected_month = selected_month_dict.get(code, default_month)
-        # For visit selectors, allow any year/month from dob to current year/current month
-        year_options = [y for y in range(default_year, current_year + 1)]
-        # If selected_year is in the future, reset to current_year
-        if selected_year > current_year:
-            selected_year = current_year
-        # Restrict month options
-        def get_month_options(year):
-            if year == default_year and year == current_year:
-                # If dob year is also current year, restrict from dob month to current month
-                return [(months_full[m-1], m) for m in range(default_month, current_month+1)]
-            elif year == default_year:
-                # If dob year, allow from dob month to December
-                return [(months_full[m-1], m) for m in range(default_month, 13)]
-            elif year == current_year:
-                # If current year, allow from Jan to current month
-                return [(months_full[m-1], m) for m in range(1, current_month+1)]
-            else:
-                # Any other year, allow all months
-                return [(months_full[m-1], m) for m in range(1, 13)]
-        month_options = get_month_options(selected_year)
-        # If selected_month is not in month_options, pick the first valid month
-        valid_month_values = [v for _, v in month_options]
-        if selected_month not in valid_month_values:
-            selected_month = valid_month_values[0]
-        row = html.Div([
+    # For visit selectors, allow any year/month from dob to current year/current month;
+    # every row starts at the dob, so they all share the same option lists
+    visit_year_options = year_options(default_year)
+    visit_month_options = month_options(default_year, default_year, default_month)
+    def build_row(c, visit):
+        # visit: the [year, month] already in the session (an imported first visit), or None
+        year, month = visit or (default_year, visit_month_options[0]["value"])
+        return html.Div([
             html.Div(
-                html.B(c['name'], style={"fontSize": 13, "textAlign": "left"}),
+                html.B(c.name, style={"fontSize": 13, "textAlign": "left"}),
                 style={"width": "220px", "display": "inline-block", "marginRight": "10px"}
             ),
             dcc.Dropdown(
-                id={"type": "visit_year", "code": code},
-                options=[{"label": str(y), "value": y} for y in year_options],
-                value=selected_year,
+                id={"type": "visit_year", "code": c.alpha_2},
+                options=visit_year_options,
+                value=year,
                 clearable=False,
                 style={"width": "140px", "display": "inline-block", "verticalAlign": "middle", "marginRight": "20px"}
             ),
             dcc.Dropdown(
-                id={"type": "visit_month", "code": code},
-                options=[{"label": label, "value": value} for label, value in month_options],
-                value=selected_month,
+                id={"type": "visit_month", "code": c.alpha_2},
+                options=month_options(year, default_year, default_month),
+                value=month,
                 clearable=False,
                 style={"width": "120px", "maxHeight": "120px", "display": "inline-block", "verticalAlign": "middle"}
             ),
+            dcc.Store(id={"type": "visit_edit", "code": c.alpha_2}),
         ], style={"marginBottom": "18px", "display": "flex", "alignItems": "center", "maxWidth": "600px"})
-        inputs.append(row)
-    return [header] + inputs
+    selected = {c.alpha_2: c for c in map(COUNTRY_REGISTRY.by_label, selected_labels)}
+    selected_codes = list(selected)
+    row_codes = [year_id["code"] for year_id in year_ids]
+    # A new date of birth changes the options of the rows already there
+    dob_changed = bool(row_codes) and ctx.triggered_id in ("dob_month", "dob_year")
+    def record(session):
+        # Returns the table's rows after this change, the dates of the selected countries, and
+        # the page's rows the session has no date for (they are rebuilt with the one they get now)
+        lost = {code for code in row_codes if code not in session["visits"]}
+        added = [code for code in selected_codes if code not in row_codes]
+        session["selected"] = selected_codes
+        session["visits"] = {code: session["visits"].get(code, [default_year, visit_month_options[0]["value"]]) for code in selected_codes}
+        if dob_changed:
+            # A visit in the birth year before the birth month moves to the first month offered
+            for code, (year, month) in session["visits"].items():
+                options = month_options(year, default_year, default_month)
+                if options and month_option(month) not in options:
+                    session["visits"][code] = [year, options[0]["value"]]
+        # Rows are in order of first visit: each new one goes after the rows with the same date,
+        # so countries visited in the same month keep their selection order
+        rows = sorted((code for code in row_codes if code in selected_codes), key=lambda code: month_index(*session["visits"][code]))
+        dates = [month_index(*session["visits"][code]) for code in rows]
+        for code in added:
+            date = month_index(*session["visits"][code])
+            position = bisect.bisect_right(dates, date)
+            rows.insert(position, code)
+            dates.insert(position, date)
+        return rows, session["visits"], lost
+    try:
+        rows, visits, lost = SESSIONS.update(session_key, record)
+    except SessionExpired:
+        return SESSION_EXPIRED
+    if not row_codes:
+        # --- Add column headers for visit table ---
+        header = html.Div([
+            html.Div('Country', style={'width': '280px', 'fontSize': 13, 'color': '#888', 'fontWeight': 500, 'textAlign': 'left', 'lineHeight': '20px', 'marginRight': '8px'}),
+            html.Div('First visited in...', style={'width': '180px', 'fontSize': 13, 'color': '#888', 'fontWeight': 500, 'textAlign': 'center', 'lineHeight': '20px', 'marginRight': '16px', 'display': 'flex', 'justifyContent': 'center', 'alignItems': 'center'}),
+            html.Div('', style={'width': '120px'}),
+            html.Div('', style={'flex': 1}),
+        ], style={'display': 'flex', 'flexDirection': 'row', 'alignItems': 'center', 'marginBottom': '2px', 'marginLeft': '2px'})
+        return [header] + [build_row(selected[code], visits[code]) for code in rows]
+    patch = Patch()
+    # Rows that are already in order stay; the rest are deleted and inserted at their position
+    positions = {code: position for position, code in enumerate(rows)}
+    kept = [code for code in row_codes if code in positions]
+    staying = {kept[index] for index in rows_in_order([positions[code] for code in kept])} - lost
+    # Position 0 is the header; delete from the end so earlier positions don't shift
+    for position in reversed(range(len(row_codes))):
+        if row_codes[position] not in staying:
+            del patch[position + 1]
+    # Insert in table order, so each row's position is final when it goes in
+    for position, code in enumerate(rows):
+        if code not in staying:
+            patch.insert(position + 1, build_row(selected[code], visits[code]))
+        elif dob_changed:
+            year, month = visits[code]
+            row = patch[position + 1]["props"]["children"]
+            row[1]["props"]["options"] = visit_year_options
+            row[2]["props"]["options"] = month_options(year, default_year, default_month)
+            row[2]["props"]["value"] = month
+    return patch
+
+# --- Visit dates: each change is numbered by the page and recorded in the session ---
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="stampEdit"),
+    Output({"type": "visit_edit", "code": MATCH}, "data"),
+    Input({"type": "visit_year", "code": MATCH}, "value"),
+    Input({"type": "visit_month", "code": MATCH}, "value"),
+    State({"type": "visit_edit", "code": MATCH}, "id"),
+    prevent_initial_call=True
+)
 
-# --- Dynamic month options for each visit selector ---
 @app.callback(
+    Output({"type": "visit_year", "code": MATCH}, "className"),
+    Input({"type": "visit_edit", "code": MATCH}, "data"),
+    State({"type": "visit_edit", "code": MATCH}, "id"),
+    State("session_key", "data"),
+    prevent_initial_call=True
+)
+def record_visit_date(edit, row_id, session_key):
+    year, month = edit["values"]
+    def record(session):
+        # Only rows still in the table
+        if row_id["code"] in session["visits"]:
+            session["visits"][row_id["code"]] = [year, month]
+        record_edit(session, f"visit:{row_id['code']}", edit["count"])
+    try:
+        SESSIONS.update(session_key, record)
+    except SessionExpired:
+        # Generate! says so
+        raise PreventUpdate
+    # Nothing on the page changes, Dash just needs an output
+    return dash.no_update
+
+# --- Dynamic month options for each visit selector ---
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="visitMonthOptions"),
     Output({"type": "visit_month", "code": MATCH}, "options"),
     Output({"type": "visit_month", "code": MATCH}, "value"),
     Input({"type": "visit_year", "code": MATCH}, "value"),
@@ -282,262 +334,115 @@ def update_visit_inputs(selected_labels, dob_month, dob_year, visit_years, visit
     State({"type": "visit_month", "code": MATCH}, "value"),
     State({"type": "visit_year", "code": MATCH}, "id"),
 )
-def update_visit_month_options(selected_year, dob_month, dob_year, selected_month, year_id):
-    today = datetime.date.today()
-    current_year = today.year
-    current_month = today.month
-    default_month = dob_month or 1
-    default_year = dob_year or 1990
-    if selected_year == default_year and selected_year == current_year:
-        month_options = [(months_full[m-1], m) for m in range(default_month, current_month+1)]
-    elif selected_year == default_year:
-        month_options = [(months_full[m-1], m) for m in range(default_month, 13)]
-    elif selected_year == current_year:
-        month_options = [(months_full[m-1], m) for m in range(1, current_month+1)]
-    else:
-        month_options = [(months_full[m-1], m) for m in range(1, 13)]
-    valid_month_values = [v for _, v in month_options]
-    if selected_month not in valid_month_values:
-        selected_month = valid_month_values[0]
-    return ([{"label": label, "value": value} for label, value in month_options], selected_month)
 
 # --- Main Callback: Generate Plot ---
+# The page's selection and residence rows, hashed in the browser, so Generate! can tell whether
+# the session has caught up with them without uploading them
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="pageDigest"),
+    Output("page_digest", "data"),
+    Input("country_select", "value"),
+    Input({"type": "res_country", "index": ALL}, "id"),
+)
+
 @app.callback(
     Output("summary", "children"),
     Output("graph_container", "children"),
+    Output("generate_retry", "disabled"),
+    Output("generate_retry", "n_intervals"),
     Input("generate_btn", "n_clicks"),
+    Input("generate_retry", "n_intervals"),
     State("dob_month", "value"),
     State("dob_year", "value"),
-    State("country_select", "value"),
-    State({"type": "visit_month", "code": dash.ALL}, "value"),
-    State({"type": "visit_year", "code": dash.ALL}, "value"),
-    State({"type": "visit_month", "code": dash.ALL}, "id"),
-    State({"type": "visit_year", "code": dash.ALL}, "id"),
-    State({"type": "res_country", "index": dash.ALL}, "value"),
-    State({"type": "res_from_year", "index": dash.ALL}, "value"),
-    State({"type": "res_from_month", "index": dash.ALL}, "value"),
-    State({"type": "res_until_year", "index": dash.ALL}, "value"),
-    State({"type": "res_until_month", "index": dash.ALL}, "value"),
+    State("session_key", "data"),
+    State("edit_version", "data"),
+    State("page_digest", "data"),
     State("user_name", "value"),
     prevent_initial_call=True
 )
-def generate_plot(n_clicks, dob_month, dob_year, selected_labels, visit_months, visit_years, month_ids, year_ids, res_countries, res_from_years, res_from_months, res_until_years, res_until_months, user_name):
-    if not selected_labels:
-        return "Please select at least one country and enter the age you first visited.", None
-    months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+def generate_plot(n_clicks, retries, dob_month, dob_year, session_key, edit_version, digest, user_name):
+    # The visits and residence periods come from the session, not from the page; the page sends
+    # how many edits it has made and a digest of its rows, so a chart isn't built from a session
+    # that hasn't caught up with them yet. Until it has, generate_retry asks again shortly (the
+    # edits need a worker too, so this one isn't held while waiting).
+    session = SESSIONS.get(session_key)
+    if session is None:
+        return SESSION_EXPIRED, None, True, 0
+    labels = [COUNTRY_REGISTRY.by_alpha_2(code).label for code in session["selected"]]
+    if session.get("version", 0) < (edit_version or 0) or page_digest(labels, [int(index) for index in session["residences"]]) != digest:
+        if ctx.triggered_id == "generate_btn":
+            return dash.no_update, dash.no_update, False, 0
+        if retries < GENERATE_RETRIES:
+            return dash.no_update, dash.no_update, False, dash.no_update
+        return "Your last changes are still being saved, press Generate! again in a moment.", None, True, 0
+    if not session["selected"]:
+        return "Please select at least one country and enter the age you first visited.", None, True, 0
+    inputs = normalize_plot_inputs(dob_month, dob_year, session)
+    if not inputs["visits"]:
+        return "Please select at least one country and enter the age you first visited.", None, True, 0
+    # Identical inputs (re-clicks, refreshes) reuse the figure built the first time
+    key = figure_cache_key(inputs, "atlas" if FLAG_ATLAS else None)
+    entry = FIGURE_CACHE.get(key)
+    # A cached figure drawn with placeholders is rebuilt once one of its flags has arrived
+    if entry is None or any(not FLAG_CACHE.pending(code) for _, code, *_ in entry["summary"].get("pending_flags", [])):
+        flag_atlas = (lambda size, placements: flag_atlas_url(atlas_spec(size, placements))) if FLAG_ATLAS else None
+        fig, summary = build_figure(inputs, get_flag_url, COUNTRY_REGISTRY, flag_atlas)
+        summary["pending_flags"] = pending_flag_images(fig)
+        entry = {"figure": fig.to_json(), "summary": summary}
+        FIGURE_CACHE.set(key, entry)
+    return (*render_plot(json.loads(entry["figure"]), entry["summary"], key), True, 0)
+
+# --- Chart inputs: everything the figure depends on, in a canonical, hashable form ---
+def normalize_plot_inputs(dob_month, dob_year, session, today=None):
     visit_info = {}
-    for m_id, y_id, m_val, y_val in zip(month_ids, year_ids, visit_months, visit_years):
-        code = m_id["code"]
-        visit_info[code] = {"visit_month": m_val or 1, "visit_year": y_val or 1990}
-    visited = []
-    for label in selected_labels:
-        c = next(c for c in COUNTRY_LIST if f"{c['name']} ({c['alpha_2']})" == label)
-        code = c["alpha_2"]
-        info = visit_info.get(code, {"visit_month": 1, "visit_year": 1990})
-        age = (info["visit_year"] - dob_year) + (info["visit_month"] - dob_month) / 12
-        visited.append({'country': c, 'age': age, 'visit_month': info["visit_month"], 'visit_year': info["visit_year"]})
-    visited_sorted = sorted(visited, key=lambda x: x['age'])
-    visited_sorted_chart = list(reversed(visited_sorted))
-    if not visited_sorted_chart:
-        return "Please select at least one country and enter the age you first visited.", None
-    country_names = [c['country']['name'] for c in visited_sorted_chart]
-    ages = [c['age'] for c in visited_sorted_chart]
-    codes = [c['country']['alpha_2'] for c in visited_sorted_chart]
-    today = datetime.date.today()
-    birth_date = datetime.date(dob_year, dob_month, 1)
-    current_age = (today.year - birth_date.year) + (today.month - birth_date.month) / 12
-    max_visit_age = max(ages) if ages else current_age
-    x_axis_max = max(current_age, max_visit_age) + max(1, min(2, current_age * 0.2))
-    n_countries = len(visited_sorted_chart)
-    flag_height_px = min(82, max(42, 62))
-    slot_height = flag_height_px + 2
-    chart_height = max(600, n_countries * slot_height)
-    pixels_per_data_unit = chart_height / n_countries if n_countries > 0 else 1
-    margin_px = 1
-    margin_data_units = margin_px / pixels_per_data_unit
-    bar_height = 1.0 - 2 * margin_data_units
-    flag_height = bar_height - 2 * margin_data_units
-    y_pos = np.arange(len(visited_sorted_chart))
-    fig = go.Figure()
-    # Draw subtle vertical grid lines for each year, and more prominent for each 5 years
-    for age in range(0, int(current_age) + 1):
-        if age % 5 == 0:
-            fig.add_shape(type="line", x0=age, x1=age, y0=-0.5, y1=len(visited_sorted_chart)-0.5,
-                          line=dict(color="#cccccc", dash="dot", width=1.5), layer="below")
-        elif age > 0:
-            fig.add_shape(type="line", x0=age, x1=age, y0=-0.5, y1=len(visited_sorted_chart)-0.5,
-                          line=dict(color="#eeeeee", dash="dot", width=1), layer="below")
-    zebra_colors = ['#d0f5df', '#b2eac7']
-    n_ticks = len(visited_sorted_chart)
-    # --- Residence period extraction from dynamic rows ---
-    residence_periods = []
-    for country_label, from_year, from_month, until_year, until_month in zip(res_countries, res_from_years, res_from_months, res_until_years, res_until_months):
-        if not country_label:
-            continue
-        c = next((c for c in COUNTRY_LIST if f"{c['name']} ({c['alpha_2']})" == country_label), None)
+    for code, (y_val, m_val) in session["visits"].items():
+        visit_info[code] = (y_val or DEFAULT_VISIT[0], m_val or DEFAULT_VISIT[1])
+    # Selection order is kept: it decides the order of countries first visited in the same month
+    visits = []
+    for code in session["selected"]:
+        c = COUNTRY_REGISTRY.by_alpha_2(code)
         if not c:
             continue
-        code = c["alpha_2"]
-        from_age = (from_year - dob_year) + (from_month - dob_month) / 12
-        until_age = (until_year - dob_year) + (until_month - dob_month) / 12
-        residence_periods.append({'code': code, 'from_age': from_age, 'until_age': until_age})
-    for i, c in enumerate(visited_sorted_chart):
-        code = c['country']['alpha_2']
-        block = ((n_ticks - 1 - i) // 5) % 2
-        bar_color = zebra_colors[block]
-        # Draw the main bar (full period)
-        bar_start = c['age']
-        bar_end = current_age
-        fig.add_trace(go.Bar(
-            y=[i],
-            x=[bar_end - bar_start],
-            base=bar_start,
-            orientation='h',
-            marker=dict(color=bar_color),
-            width=bar_height,
-            showlegend=False,
-            hoverinfo='none',
-        ))
-        # Draw all gold residence bars for this country
-        for period in residence_periods:
-            if period['code'] == code:
-                res_start = max(period['from_age'], bar_start)
-                res_end = min(period['until_age'], bar_end)
-                if res_end > res_start:
-                    # Use deeper gold for dark green stripes, lighter gold for light green stripes
-                    residence_gold = '#ffd700' if block == 1 else '#ffe066'
-                    fig.add_trace(go.Bar(
-                        y=[i],
-                        x=[res_end - res_start],
-                        base=res_start,
-                        orientation='h',
-                        marker=dict(color=residence_gold),
-            width=bar_height,
-            showlegend=False,
-            hoverinfo='none',
-        ))
-    # Add flag images
-    for i, c in enumerate(visited_sorted_chart):
-        code = c['country']['alpha_2']
-        flag_b64 = get_flag_base64(code)
-        if flag_b64:
-            flag_sizex = 2.5
-            flag_x = c['age']
-            # If flag would overflow right edge, center it on the bar
-            if flag_x + flag_sizex > x_axis_max:
-                flag_x = min(x_axis_max - flag_sizex / 2, max(flag_sizex / 2, c['age']))
-                xanchor = "center"
-            else:
-                xanchor = "left"
-            fig.add_layout_image(
-                dict(
-                    source=flag_b64,
-                    xref="x",
-                    yref="y",
-                    x=flag_x,
-                    y=i,
-                    sizex=flag_sizex,
-                    sizey=flag_height,
-                    xanchor=xanchor,
-                    yanchor="middle",
-                    layer="above",
-                    sizing="contain"
-                )
-            )
-    # --- X-axis ticks: only up to current_age ---
-    x_tick_step = 5 if current_age > 10 else 1
-    x_tick_end = int(current_age) if current_age % 1 == 0 else int(current_age) + 1
-    x_tickvals = list(range(0, x_tick_end + 1, x_tick_step))
-    if x_tickvals[-1] < round(current_age):
-        x_tickvals.append(round(current_age))
-    x_tickvals = [v for v in x_tickvals if v <= current_age]
-    x_ticktext = [str(v) for v in x_tickvals]
-    fig.update_xaxes(title_text="Age", range=[0, x_axis_max], linewidth=3, linecolor="black", showline=False, zeroline=False, tickvals=x_tickvals, ticktext=x_ticktext)
-    # Robust y-axis ticks: 0 at bottom, 5, 10, ... at correct places, topmost value always labeled
-    n_ticks = len(visited_sorted_chart)
-    tickvals = [n_ticks - 0.5 - i*5 for i in range((n_ticks // 5) + 1)]
-    ticktext = [str(i*5) for i in range((n_ticks // 5) + 1)]
-    if n_ticks % 5 != 0:
-        tickvals = [-0.5] + tickvals
-        ticktext = [str(n_ticks)] + ticktext
-    fig.update_yaxes(
-        tickvals=tickvals,
-        ticktext=ticktext,
-        range=[-0.5, len(visited_sorted_chart)-0.5],
-        autorange=False,
-        title_text="Total countries visited",
-        title_font=dict(size=16, family="Arial, sans-serif", color="black"),
-        showticklabels=True,
-        showline=False,
-        linewidth=3,
-        linecolor="black"
-    )
-    # Add a custom vertical black line for the y-axis
-    fig.add_shape(
-        type="line",
-        x0=0, x1=0,
-        y0=-0.5, y1=len(visited_sorted_chart)-0.5,
-        line=dict(color="black", width=4),
-        layer="above"
-    )
-    # Add country name/age annotations, dynamically position to right or left of flag
-    label_width = 2.5  # estimate of label width in data units
-    for i, c in enumerate(visited_sorted_chart):
-        visit_age = c['age']
-        # Default: place to right of flag
-        ann_x = visit_age + 2.7
-        ann_xanchor = "left"
-        # If label would overflow right edge, place to left
-        if ann_x + label_width > x_axis_max:
-            ann_x = max(visit_age - 2.7, 0)
-            ann_xanchor = "right"
-        fig.add_annotation(
-            x=ann_x,
-            y=i,
-            text=f"{c['country']['name']} ({c['age']:.1f})",
-            showarrow=False,
-            font=dict(size=14, family="Arial, sans-serif", color="#222"),
-            xanchor=ann_xanchor,
-            yanchor="middle",
-            align="left",
-            bgcolor="rgba(255,255,255,0.0)",
-            borderpad=2,
-            opacity=1
-        )
-    fig.update_layout(
-        title={"text": "Countries visited by age", "x": 0.5, "xanchor": "center"},
-        height=chart_height,
-        plot_bgcolor="white",
-        paper_bgcolor="white",
-        margin=dict(l=0, r=40, t=80, b=40),
-        bargap=0,
-        bargroupgap=0,
-        barmode='overlay',
-        yaxis_autorange="reversed",
-    )
-    # Restore the thin black line at the bottom of the lowest bar to mimic the x-axis
-    fig.add_shape(type="line", x0=0, x1=current_age, y0=len(visited_sorted_chart)-0.5, y1=len(visited_sorted_chart)-0.5, line=dict(color="black", width=2), layer="above")
-    n_countries = len(visited_sorted_chart)
-    age_now = max(ages) if ages else 0
-    percent = (n_countries / current_age) * 100 if current_age > 0 else 0
+        visits.append((c.alpha_2, *visit_info.get(c.alpha_2, DEFAULT_VISIT)))
+    residences = []
+    # Edits are recorded as they happen, but the table only drops the periods after an invalid
+    # one when it next changes; the chart drops them straight away
+    rows = valid_residence_rows([(int(index), *values) for index, values in session["residences"].items()])
+    for _, country_label, from_year, from_month, until_year, until_month in rows:
+        c = COUNTRY_REGISTRY.by_label(country_label) if country_label else None
+        if not c or None in (from_year, from_month, until_year, until_month):
+            continue
+        residences.append((c.alpha_2, from_year, from_month, until_year, until_month))
+    return make_inputs(dob_year, dob_month, visits, residences, today)
+
+def render_plot(figure, summary, key):
+    n_countries = summary["n_countries"]
+    percent = summary["percent"]
+    chart_height = summary["chart_height"]
+    # Tall charts show a window of rows; the cached figure (and the export) keeps them all.
+    # What moving the window needs is sent along with it, so paging doesn't depend on the cache.
+    windowed = is_windowed(n_countries)
+    rows = None
+    if windowed:
+        rows = dict(window_rows(figure), n_rows=n_countries)
+        chart_height = window_height(chart_height, n_countries)
+        figure = window_figure(figure, 0, WINDOW_ROWS, chart_height)
     # --- SUMMARY TEXT ---
     summary_text = html.Div([
         html.Div(f"You have visited {n_countries} countries, which is {percent:.1f}% of your age.", style={"fontSize": 18, "fontWeight": 600, "marginBottom": "8px"})
     ])
     # --- Place summary above chart ---
+    # Rendered on the server (see export_chart), so it doesn't depend on the browser or device
     download_button = dbc.Button(
         "Download chart as PNG",
         id="download_chart_btn",
-        n_clicks=0,
+        href=app.get_relative_path(f"/export/{key}.png"),
+        external_link=True,
+        download="countries_by_age.png",
         color="primary",
         style={"marginTop": "18px", "marginBottom": "8px"}
     )
-    # Legend flag: use first visited country or default to Cuba
-    if visited_sorted_chart:
-        first_flag_code = visited_sorted_chart[0]['country']['alpha_2'].lower()
-    else:
-        first_flag_code = 'cu'
-    flag_url = f"https://flagcdn.com/w20/{first_flag_code}.png"
+    flag_url = get_flag_url(summary["legend_flag_code"]) or get_flag_url('cu')
     return (
         summary_text,
         html.Div([
@@ -557,133 +462,373 @@ def generate_plot(n_clicks, dob_month, dob_year, selected_labels, visit_months,
                 html.Img(src=flag_url, style={"width": "18px", "height": "14px", "marginRight": "8px", "verticalAlign": "middle", "border": "1px solid #bbb", "borderRadius": "2px"}),
                 html.Span("Country first visited", style={"fontWeight": 600, "fontSize": "15px", "verticalAlign": "middle"}),
             ], style={"display": "flex", "flexDirection": "row", "alignItems": "center", "marginBottom": "10px", "marginTop": "0", "marginLeft": "0"}),
-            dcc.Graph(figure=fig, id="country_plot", style={"width": "100%", "height": f"{chart_height}px", "marginLeft": 0}),
-            download_button
+            dcc.Graph(figure=figure, id="country_plot", style={"width": "100%", "height": f"{chart_height}px", "marginLeft": 0}),
+            html.Div([
+                html.Button("Later", id="chart_window_prev", n_clicks=0, disabled=True, style=WINDOW_BUTTON_STYLE),
+                html.Span(window_label(0, WINDOW_ROWS, n_countries), id="chart_window_label", style={"fontSize": "14px", "color": "#444", "margin": "0 12px"}),
+                html.Button("Earlier", id="chart_window_next", n_clicks=0, style=WINDOW_BUTTON_STYLE),
+            ], style={"display": "flex" if windowed else "none", "alignItems": "center", "marginTop": "8px"}),
+            dcc.Store(id="chart_window", data=[0, min(WINDOW_ROWS, n_countries)]),
+            dcc.Store(id="chart_rows", data=rows),
+            dcc.Store(id="chart_key", data=key),
+            download_button,
+            # Flags still downloading are drawn as placeholders and swapped in as they arrive
+            dcc.Store(id="pending_flags", data=summary.get("pending_flags", [])),
+            dcc.Interval(id="pending_flags_poll", interval=1000, max_intervals=2 * FLAG_FETCH_TIMEOUT, disabled=not summary.get("pending_flags")),
         ])
     )
 
-# Add clientside callback to trigger Plotly downloadImage
-app.clientside_callback(
-    """
-    function(n_clicks) {
-        if (n_clicks > 0) {
-            var graphDiv = document.getElementById('country_plot');
-            if (graphDiv && window.Plotly) {
-                window.Plotly.downloadImage(graphDiv, {format: 'png', filename: 'countries_by_age'});
-            }
-        }
-        return window.dash_clientside.no_update;
-    }
-    """,
-    Output('download_chart_btn', 'n_clicks'),
-    Input('download_chart_btn', 'n_clicks')
+# --- Windowed charts: move the window, showing only its rows' flags and labels ---
+WINDOW_BUTTON_STYLE = {"backgroundColor": "#e0e0e0", "color": "#222", "border": "none", "padding": "6px 12px", "borderRadius": "6px", "fontWeight": 600, "fontSize": "14px", "cursor": "pointer"}
+
+def window_label(first, last, n_countries):
+    # Rows are counted from the top, countries from the first one visited
+    return f"Countries {n_countries - last + 1}-{n_countries - first} of {n_countries}"
+
+@app.callback(
+    Output("country_plot", "figure", allow_duplicate=True),
+    Output("chart_window", "data"),
+    Output("chart_window_label", "children"),
+    Output("chart_window_prev", "disabled"),
+    Output("chart_window_next", "disabled"),
+    Input("chart_window_prev", "n_clicks"),
+    Input("chart_window_next", "n_clicks"),
+    Input("country_plot", "relayoutData"),
+    State("chart_window", "data"),
+    State("chart_rows", "data"),
+    prevent_initial_call=True
 )
+def move_chart_window(prev_clicks, next_clicks, relayout, window, rows):
+    if not rows:
+        raise PreventUpdate
+    n_countries = rows["n_rows"]
+    patch = Patch()
+    first, last = window
+    if ctx.triggered_id == "chart_window_prev":
+        first = max(0, first - WINDOW_ROWS)
+        last = min(n_countries, first + WINDOW_ROWS)
+        patch["layout"]["yaxis"]["range"] = [last - 0.5, first - 0.5]
+    elif ctx.triggered_id == "chart_window_next":
+        first = min(first + WINDOW_ROWS, max(0, n_countries - WINDOW_ROWS))
+        last = min(n_countries, first + WINDOW_ROWS)
+        patch["layout"]["yaxis"]["range"] = [last - 0.5, first - 0.5]
+    elif relayout and "yaxis.range[0]" in relayout:
+        # Panned or zoomed: show whatever rows are now in view
+        first, last = visible_rows([relayout["yaxis.range[0]"], relayout["yaxis.range[1]"]], n_countries)
+    else:
+        raise PreventUpdate
+    if [first, last] == window:
+        raise PreventUpdate
+    was_shown, _ = window_contents(rows, *window)
+    shown, labels = window_contents(rows, first, last)
+    for i, (before, now) in enumerate(zip(was_shown, shown)):
+        if before != now:
+            patch["layout"]["images"][i]["visible"] = now
+    for k, texts in labels.items():
+        patch["data"][k]["text"] = texts
+    return patch, [first, last], window_label(first, last, n_countries), first == 0, last == n_countries
 
-# --- Helper: Download and cache flag images as base64 ---
-FLAG_DIR = "Flags"
-os.makedirs(FLAG_DIR, exist_ok=True)
-def get_flag_base64(code):
-    flag_path = os.path.join(FLAG_DIR, f"{code}.png")
-    if not os.path.exists(flag_path):
-        url = f"https://flagcdn.com/w40/{code.lower()}.png"
-        try:
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
-            with open(flag_path, "wb") as f:
-                f.write(r.content)
-        except Exception:
-            return None
-    try:
-        with open(flag_path, "rb") as f:
-            img = Image.open(io.BytesIO(f.read())).convert("RGBA")
-            # Add 2px transparent border to top and bottom
-            border_px = 2
-            new_width, new_height = img.width, img.height + 2 * border_px
-            new_img = Image.new("RGBA", (new_width, new_height), (255, 255, 255, 0))
-            new_img.paste(img, (0, border_px))
-            buffered = io.BytesIO()
-            new_img.save(buffered, format="PNG")
-            img_b64 = base64.b64encode(buffered.getvalue()).decode()
-            return f"data:image/png;base64,{img_b64}"
-    except Exception:
-        return None
+# --- Helper: flag images, served from the pre-rendered flag cache at fingerprinted URLs ---
+# Flags that aren't on disk yet are downloaded in the background (see flags.py); until then
+# they point at /flags/pending/, which serves a placeholder.
+# With COUNTRYGEN_FLAG_ATLAS=1 a chart's flags are drawn as one composed image per chunk of
+# rows instead, served from /flags/atlas/ (see flags.py).
+FLAG_CACHE = FlagCache()
+FLAG_CACHE.warm()
+FLAG_ATLAS = FlagAtlasCache(FLAG_CACHE) if atlas_enabled() else None
+def get_flag_url(code):
+    path = FLAG_CACHE.url_path(code)
+    if path:
+        return app.get_relative_path(path)
+    if FLAG_CACHE.pending(code):
+        return app.get_relative_path(f"/flags/pending/{flag_key(code)}.png")
+    return None
+
+def flag_atlas_url(spec):
+    return app.get_relative_path(f"/flags/atlas/{FLAG_ATLAS.fingerprint(spec)}/{spec}.png")
+
+def pending_flag_images(fig):
+    # [image index, code] for every flag drawn as a placeholder; [image index, code, spec] for
+    # every placeholder in an atlas
+    pending = []
+    for i, image in enumerate(fig.layout.images):
+        source = image.source or ""
+        name = source.rsplit("/", 1)[-1][:-len(".png")]
+        if "/flags/pending/" in source:
+            pending.append([i, name])
+        elif "/flags/atlas/" in source:
+            pending.extend([i, code, name] for code in FLAG_ATLAS.pending(name))
+    return pending
+
+@app.server.route("/flags/pending/<code>.png")
+def serve_pending_flag(code):
+    if not COUNTRY_REGISTRY.by_alpha_2(code):
+        abort(404)
+    if FLAG_CACHE.get(code) is not None:
+        return redirect(get_flag_url(code))
+    response = Response(FLAG_CACHE.placeholder.png, mimetype="image/png")
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 @app.callback(
+    Output("country_plot", "figure"),
+    Output("pending_flags", "data"),
+    Output("pending_flags_poll", "disabled"),
+    Input("pending_flags_poll", "n_intervals"),
+    State("pending_flags", "data"),
+    prevent_initial_call=True
+)
+def upgrade_pending_flags(n_intervals, pending):
+    if not pending:
+        raise PreventUpdate
+    patch = Patch()
+    still_pending = []
+    for index, code, *spec in pending:
+        if FLAG_CACHE.pending(code):
+            still_pending.append([index, code, *spec])
+            continue
+        # Otherwise the download either worked or failed; if it failed the placeholder stays
+        # (an atlas is recomposed, with the flag or without its placeholder)
+        flag_url = flag_atlas_url(spec[0]) if spec else get_flag_url(code)
+        if flag_url:
+            patch["layout"]["images"][index]["source"] = flag_url
+    return patch, still_pending, not still_pending
+
+@app.server.route("/flags/<fingerprint>/<code>.png")
+def serve_flag(fingerprint, code):
+    # Only countries we know about, so arbitrary paths can't trigger flag downloads
+    asset = FLAG_CACHE.get(code) if COUNTRY_REGISTRY.by_alpha_2(code) else None
+    if asset is None:
+        abort(404)
+    if fingerprint != asset.etag:
+        # Stale fingerprint (flag re-rendered since the figure was built): point at the current one
+        return redirect(get_flag_url(code))
+    response = Response(asset.png, mimetype="image/png")
+    response.set_etag(asset.etag)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+@app.server.route("/flags/atlas/<fingerprint>/<spec>.png")
+def serve_flag_atlas(fingerprint, spec):
+    if FLAG_ATLAS is None:
+        abort(404)
+    # Anyone can ask for any spec, so only atlases a figure could have asked for are composed:
+    # one flag per row of a chart's chunk, on its row grid, written as the figure writes it
+    try:
+        size, placements = parse_atlas_spec(spec)
+    except ValueError:
+        abort(404)
+    if spec != atlas_spec(size, placements) or not is_atlas_spec(size, placements, len(COUNTRY_LIST)):
+        abort(404)
+    # Only countries we know about, as for single flags
+    if not all(COUNTRY_REGISTRY.by_alpha_2(key) for key, _, _ in placements):
+        abort(404)
+    if fingerprint != FLAG_ATLAS.fingerprint(spec):
+        # A flag in it has arrived or changed since the figure was built
+        return redirect(flag_atlas_url(spec))
+    asset = FLAG_ATLAS.get(spec)
+    response = Response(asset.png, mimetype="image/png")
+    response.set_etag(asset.etag)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+# --- Chart export: PNG/SVG/PDF of a cached figure, rendered in a worker pool ---
+CHART_EXPORTER = ChartExporter()
+def inline_flag_images(figure_json):
+    # The renderer can't fetch our flag URLs, so embed the flags before handing the figure over
+    figure = json.loads(figure_json)
+    for image in figure.get("layout", {}).get("images", []):
+        source = image.get("source") or ""
+        if "/flags/atlas/" in source and FLAG_ATLAS:
+            image["source"] = FLAG_ATLAS.get(source.rsplit("/", 1)[-1][:-len(".png")]).data_uri
+        elif "/flags/" in source:
+            code = source.rsplit("/", 1)[-1][:-len(".png")]
+            image["source"] = FLAG_CACHE.data_uri(code) or FLAG_CACHE.placeholder.data_uri
+    return json.dumps(figure)
+
+@app.server.route("/export/<key>.<fmt>")
+def export_chart(key, fmt):
+    if fmt not in EXPORT_FORMATS or not is_cache_key(key):
+        abort(404)
+    entry = FIGURE_CACHE.get(key)
+    if entry is None:
+        # Figure no longer cached; pressing Generate! again rebuilds it
+        abort(404)
+    # The figure is rebuilt under the same key once its pending flags arrive, and those flags are
+    # inlined as they are at render time, so exports are cached (and revalidated) per figure as built
+    # and flags still missing
+    missing = sorted({code for _, code, *_ in entry["summary"].get("pending_flags", []) if FLAG_CACHE.pending(code)})
+    version = hashlib.sha1(f"{entry['figure']}/{','.join(missing)}".encode()).hexdigest()[:16]
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        try:
+            data = CHART_EXPORTER.export(version, fmt, lambda: inline_flag_images(entry["figure"]))
+        except ExportBusy:
+            return Response("Too many exports in progress, try again shortly.", status=503, headers={"Retry-After": "5"})
+        except ExportTimeout:
+            return Response("Rendering the chart took too long.", status=504)
+        response = Response(data, mimetype=EXPORT_FORMATS[fmt])
+        response.headers["Content-Disposition"] = f'attachment; filename="countries_by_age.{fmt}"'
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="dobMonthOptions"),
     Output("dob_month", "options"),
     Input("dob_year", "value")
 )
-def update_dob_month_options(selected_year):
-    today = datetime.date.today()
-    current_year = today.year
-    current_month = today.month
-    if selected_year == current_year:
-        return [{"label": month, "value": i+1} for i, month in enumerate(months_full[:current_month])]
-    else:
-        return [{"label": month, "value": i+1} for i, month in enumerate(months_full)]
 
-# --- Enable country select after 3 seconds ---
+# --- Country search: the select's options are the best matches for what has been typed ---
+def country_search_option(c, query):
+    # The dropdown filters options again in the browser, on their label and "search" text;
+    # the query's own words (as typed and normalized) are included so nothing the server matched gets hidden
+    return {"label": c.label, "value": c.label, "search": f"{COUNTRY_SEARCH.search_terms(c)} {search_text(query)} {query}"}
+
 @app.callback(
-    Output("country_select", "disabled"),
-    Input("country_select_timer", "n_intervals"),
-    prevent_initial_call=False
+    Output("country_select", "options"),
+    Input("country_select", "search_value"),
+    State("country_select", "value"),
+    prevent_initial_call=True
+)
+def search_country_options(search_value, selected_labels):
+    if not search_value:
+        # Keep the last matches until something new is typed
+        raise PreventUpdate
+    # Selected countries stay in the options, so their labels keep showing
+    selected = [COUNTRY_REGISTRY.by_label(label) for label in selected_labels or []]
+    matches = [c for c in COUNTRY_SEARCH.search(search_value) if c.label not in (selected_labels or [])]
+    return [country_search_option(c, search_value) for c in selected + matches if c]
+
+@app.server.route("/api/countries/search")
+def search_countries():
+    try:
+        limit = min(max(int(request.args.get("limit", SEARCH_LIMIT)), 1), len(COUNTRY_REGISTRY))
+    except ValueError:
+        abort(400)
+    matches = COUNTRY_SEARCH.search(request.args.get("q", ""), limit)
+    response = jsonify([{"code": c.alpha_2, "name": c.name, "label": c.label} for c in matches])
+    # Answers only change with the catalogue
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
+
+# --- Location history import: upload, then poll the job until it has the first visits ---
+# The body is the raw file (not a form), spooled to disk as it arrives. Jobs live in this
+# process, so with several workers the page has to come back to the same one.
+@app.server.route("/import/location-history", methods=["POST"])
+def import_location_history():
+    if not LOCATION_IMPORTER.available():
+        return Response("Importing location history isn't set up on this server.", status=503)
+    if (request.content_length or 0) > IMPORT_MAX_BYTES:
+        return Response(f"Uploads are limited to {IMPORT_MAX_BYTES // 1024 ** 3} GB.", status=413)
+    # The job's slot is taken before anything is written to disk
+    try:
+        LOCATION_IMPORTER.reserve()
+    except ImportBusy:
+        return Response("Too many imports in progress, try again shortly.", status=503, headers={"Retry-After": "30"})
+    job = None
+    try:
+        path, head = spool_upload(request.stream)
+        if not head:
+            os.remove(path)
+            return Response("That file is empty.", status=400)
+        job = LOCATION_IMPORTER.start(path, detect_format(request.args.get("name"), head))
+    except UploadTooLarge:
+        return Response(f"Uploads are limited to {IMPORT_MAX_BYTES // 1024 ** 3} GB.", status=413)
+    finally:
+        if job is None:
+            LOCATION_IMPORTER.release()
+    return jsonify({"job": job.id}), 202
+
+@app.server.route("/import/<job_id>.json")
+def import_status(job_id):
+    job = LOCATION_IMPORTER.job(job_id)
+    if job is None:
+        abort(404)
+    response = jsonify(job.status())
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="uploadLocationHistory"),
+    Output("import_status", "children"),
+    Input("import_location_btn", "n_clicks"),
+    prevent_initial_call=True
 )
-def enable_country_select(n_intervals):
-    return False if n_intervals and n_intervals > 0 else True
 
-# --- Toggle residence section visibility ---
 @app.callback(
+    Output("import_status", "children", allow_duplicate=True),
+    Output("import_poll", "disabled"),
+    Output("country_select", "value", allow_duplicate=True),
+    Output("country_select", "options", allow_duplicate=True),
+    Input("import_job", "data"),
+    Input("import_poll", "n_intervals"),
+    State("country_select", "value"),
+    State("session_key", "data"),
+    State("dob_year", "value"),
+    State("dob_month", "value"),
+    prevent_initial_call=True
+)
+def poll_location_import(job_id, n_intervals, selected_labels, session_key, dob_year, dob_month):
+    job = LOCATION_IMPORTER.job(job_id) if job_id else None
+    if job is None:
+        return "That import has expired, please upload the file again.", True, dash.no_update, dash.no_update
+    status = job.status()
+    if status["state"] in ("queued", "running"):
+        return f"Reading your location history: {status['progress']:.0%} ({status['points']:,} points so far)", False, dash.no_update, dash.no_update
+    if status["state"] == "error":
+        return f"Couldn't import that file: {status['error']}", True, dash.no_update, dash.no_update
+    # Imported countries are added with their first month (never before the dob); countries
+    # already selected keep the dates the user gave them
+    first_month = month_index(dob_year or 1990, dob_month or 1)
+    selected = [COUNTRY_REGISTRY.by_label(label) for label in selected_labels or []]
+    selected_codes = {c.alpha_2 for c in selected if c}
+    imported = {}
+    for code, (year, month) in status["countries"].items():
+        c = COUNTRY_REGISTRY.by_alpha_2(code)
+        if c and code not in selected_codes:
+            imported[c] = [year, month] if month_index(year, month) >= first_month else [dob_year or 1990, dob_month or 1]
+    def record(session):
+        session["visits"].update((c.alpha_2, visit) for c, visit in imported.items())
+    try:
+        SESSIONS.update(session_key, record)
+    except SessionExpired:
+        return SESSION_EXPIRED, True, dash.no_update, dash.no_update
+    added = sorted(imported, key=lambda c: month_index(*imported[c]))
+    message = f"Found {len(status['countries'])} countries in {status['points']:,} points; {len(added)} added to your list."
+    # Selected countries stay in the options, so their labels keep showing
+    options = [country_search_option(c, "") for c in selected + added if c]
+    return message, True, [c.label for c in selected + added if c], options
+
+# --- Toggle residence section visibility ---
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="toggleResidenceSection"),
     Output("residence_section", "style"),
     Input("toggle_residence_btn", "n_clicks"),
     State("residence_section", "style"),
     prevent_initial_call=False
 )
-def toggle_residence_section(n_clicks, current_style):
-    if not n_clicks or n_clicks % 2 == 0:
-        # Hide section
-        style = dict(current_style) if current_style else {}
-        style["display"] = "none"
-        return style
-    else:
-        # Show section
-        style = dict(current_style) if current_style else {}
-        style["display"] = "block"
-        return style
 
 # --- Residence periods: dynamic rows ---
+# Rows are only ever removed, cut off at the end or appended, so once the table exists it is
+# updated with a Patch: untouched rows keep their components and their option callbacks don't rerun.
+# Row ids are stable (not positions), so the remove button and MATCH callbacks keep pointing at the same row.
+# The page sends which rows it has; their values are kept in the session (in table order), where
+# record_residence_edit records each edit, so a change to one row doesn't upload the whole table.
 @app.callback(
     Output('residence_periods_container', 'children'),
     Input('add_residence_period_btn', 'n_clicks'),
     Input({'type': 'remove_residence_period', 'index': ALL}, 'n_clicks'),
     Input('residence_section', 'style'),
-    Input({'type': 'res_country', 'index': ALL}, 'value'),
-    Input({'type': 'res_from_year', 'index': ALL}, 'value'),
-    Input({'type': 'res_from_month', 'index': ALL}, 'value'),
-    Input({'type': 'res_until_year', 'index': ALL}, 'value'),
-    Input({'type': 'res_until_month', 'index': ALL}, 'value'),
-    State('residence_periods_container', 'children'),
-    State('country_select', 'value'),
+    Input('country_select', 'value'),
+    State({'type': 'res_country', 'index': ALL}, 'id'),
+    State('session_key', 'data'),
     State('dob_year', 'value'),
     State('dob_month', 'value'),
-    State({'type': 'visit_year', 'code': ALL}, 'value'),
-    State({'type': 'visit_month', 'code': ALL}, 'value'),
-    State({'type': 'visit_year', 'code': ALL}, 'id'),
-    State({'type': 'visit_month', 'code': ALL}, 'id'),
-    State({'type': 'res_country', 'index': ALL}, 'value'),
-    State({'type': 'res_from_year', 'index': ALL}, 'value'),
-    State({'type': 'res_from_month', 'index': ALL}, 'value'),
-    State({'type': 'res_until_year', 'index': ALL}, 'value'),
-    State({'type': 'res_until_month', 'index': ALL}, 'value'),
     prevent_initial_call=False
 )
-def update_residence_periods(add_clicks, remove_clicks, res_section_style, input_countries, input_from_years, input_from_months, input_until_years, input_until_months, current_children, visited_countries, dob_year, dob_month, visit_years, visit_months, visit_year_ids, visit_month_ids, res_countries, res_from_years, res_from_months, res_until_years, res_until_months):
-    # Use the input_* values for the current state
-    res_countries = input_countries
-    res_from_years = input_from_years
-    res_from_months = input_from_months
-    res_until_years = input_until_years
-    res_until_months = input_until_months
-    import copy
-    from dash import html, dcc
+def update_residence_periods(add_clicks, remove_clicks, res_section_style, visited_countries, row_ids, session_key, dob_year, dob_month):
     import datetime
     today = datetime.date.today()
     current_year = today.year
@@ -711,13 +856,13 @@ def update_residence_periods(add_clicks, remove_clicks, res_section_style, input
             html.Div([
                 dcc.Dropdown(
                     id={'type': 'res_from_year', 'index': idx},
-                    options=[{'label': str(y), 'value': y} for y in range(dob_year, current_year + 1)],
+                    options=year_options(dob_year),
                     value=from_year,
                     style={'width': '100px', 'marginRight': '6px', 'fontSize': 15, 'display': 'inline-block'}
                 ),
                 dcc.Dropdown(
                     id={'type': 'res_from_month', 'index': idx},
-                    options=[{'label': m, 'value': i+1} for i, m in enumerate(months_full)],
+                    options=MONTH_OPTIONS,
                     value=from_month,
                     style={'width': '80px', 'fontSize': 15, 'display': 'inline-block'}
                 ),
@@ -725,13 +870,13 @@ def update_residence_periods(add_clicks, remove_clicks, res_section_style, input
             html.Div([
                 dcc.Dropdown(
                     id={'type': 'res_until_year', 'index': idx},
-                    options=[{'label': str(y), 'value': y} for y in range(dob_year, current_year + 1)],
+                    options=year_options(dob_year),
                     value=until_year,
                     style={'width': '100px', 'marginRight': '6px', 'fontSize': 15, 'display': 'inline-block'}
                 ),
                 dcc.Dropdown(
                     id={'type': 'res_until_month', 'index': idx},
-                    options=[{'label': m, 'value': i+1} for i, m in enumerate(months_full)],
+                    options=MONTH_OPTIONS,
                     value=until_month,
                     style={'width': '80px', 'fontSize': 15, 'display': 'inline-block'}
                 ),
@@ -739,97 +884,137 @@ def update_residence_periods(add_clicks, remove_clicks, res_section_style, input
             html.Div([
                 html.Button('Remove', id={'type': 'remove_residence_period', 'index': idx}, n_clicks=0, style={'backgroundColor': '#eee', 'color': '#222', 'border': 'none', 'padding': '4px 10px', 'borderRadius': '4px', 'fontSize': '13px', 'cursor': 'pointer', 'height': '38px', 'display': 'flex', 'alignItems': 'center'})
             ], style={'display': 'flex', 'alignItems': 'center'}),
+            dcc.Store(id={'type': 'res_edit', 'index': idx}),
         ], style={'marginBottom': '12px', 'display': 'flex', 'alignItems': 'center'})
     triggered = ctx.triggered_id
     options = visited_countries or []
     section_visible = res_section_style and res_section_style.get('display') == 'block'
-    def ensure_list(val):
-        if isinstance(val, list):
-            return val
-        elif val is None:
-            return []
-        else:
-            return [val]
-    res_countries = ensure_list(res_countries)
-    res_from_years = ensure_list(res_from_years)
-    res_from_months = ensure_list(res_from_months)
-    res_until_years = ensure_list(res_until_years)
-    res_until_months = ensure_list(res_until_months)
-    # Remove row if remove button clicked
-    if isinstance(triggered, dict) and triggered.get('type') == 'remove_residence_period':
-        idx = triggered['index']
-        res_countries = [c for i, c in enumerate(res_countries) if i != idx]
-        res_from_years = [y for i, y in enumerate(res_from_years) if i != idx]
-        res_from_months = [m for i, m in enumerate(res_from_months) if i != idx]
-        res_until_years = [y for i, y in enumerate(res_until_years) if i != idx]
-        res_until_months = [m for i, m in enumerate(res_until_months) if i != idx]
-    # Always keep at least one row
-    if not res_countries or len(res_countries) == 0:
-        default_country = options[0] if options else None
-        from_year = dob_year
-        from_month = dob_month
-        until_year = current_year
-        until_month = current_month
-        res_countries = [default_country]
-        res_from_years = [from_year]
-        res_from_months = [from_month]
-        res_until_years = [until_year]
-        res_until_months = [until_month]
-    # Add new row if add button clicked
-    if triggered == 'add_residence_period_btn' and section_visible:
-        idx = len(res_countries)
-        # Find the next available country (not already used), or allow repeats if all are used
-        used_countries = set(res_countries)
-        next_country = next((c for c in options if c not in used_countries), options[0] if options else None)
-        # Use the last row's until as the new row's from
-        last_until_year = res_until_years[-1] if res_until_years[-1] is not None else dob_year
-        last_until_month = res_until_months[-1] if res_until_months[-1] is not None else dob_month
-        from_year = last_until_year
-        from_month = last_until_month
-        until_year = current_year
-        until_month = current_month
-        # Append new row values
-        res_countries = res_countries + [next_country]
-        res_from_years = res_from_years + [from_year]
-        res_from_months = res_from_months + [from_month]
-        res_until_years = res_until_years + [until_year]
-        res_until_months = res_until_months + [until_month]
-    # --- AUTO-RESET/CLEAR FUTURE PERIODS (move before building rows) ---
-    n = len(res_countries)
-    last_valid = 1 if n > 0 else 0
-    for i in range(1, n):
-        # Only check if from is after until (invalid period)
-        if (res_until_years[i] < res_from_years[i]) or (res_until_years[i] == res_from_years[i] and res_until_months[i] < res_from_months[i]):
+    old_indexes = [row_id['index'] for row_id in row_ids]
+    def change(session):
+        # One (index, country, from_year, from_month, until_year, until_month) per row, in table order.
+        # A row the session has no values for was removed by a response the page never got; it goes now.
+        residences = session['residences']
+        rows = [(index, *residences[str(index)]) for index in old_indexes if str(index) in residences]
+        next_index = max(old_indexes + [int(index) for index in residences], default=-1) + 1
+        # Remove row if remove button clicked
+        if isinstance(triggered, dict) and triggered.get('type') == 'remove_residence_period':
+            rows = [row for row in rows if row[0] != triggered['index']]
+        # Always keep at least one row
+        if not rows:
+            default_country = options[0] if options else None
+            rows = [(next_index, default_country, dob_year, dob_month, current_year, current_month)]
+            next_index += 1
+        # Add new row if add button clicked
+        if triggered == 'add_residence_period_btn' and section_visible:
+            # Find the next available country (not already used), or allow repeats if all are used
+            used_countries = set(row[1] for row in rows)
+            next_country = next((c for c in options if c not in used_countries), options[0] if options else None)
+            # Use the last row's until as the new row's from
+            last_until_year = rows[-1][4] if rows[-1][4] is not None else dob_year
+            last_until_month = rows[-1][5] if rows[-1][5] is not None else dob_month
+            rows.append((next_index, next_country, last_until_year, last_until_month, current_year, current_month))
+        rows = valid_residence_rows(rows)
+        session['residences'] = {str(row[0]): list(row[1:]) for row in rows}
+        return rows
+    try:
+        rows = SESSIONS.update(session_key, change)
+    except SessionExpired:
+        return SESSION_EXPIRED
+    if not old_indexes:
+        # First render: build the whole table
+        return [header] + [build_row(*row, options) for row in rows]
+    kept_indexes = set(row[0] for row in rows)
+    patch = Patch()
+    changed = False
+    # Position 0 is the header; delete from the end so earlier positions don't shift
+    for position in reversed(range(len(old_indexes))):
+        if old_indexes[position] not in kept_indexes:
+            del patch[position + 1]
+            changed = True
+    for row in rows:
+        if row[0] not in old_indexes:
+            patch.append(build_row(*row, options))
+            changed = True
+    if triggered == 'country_select':
+        country_options = [{'label': c, 'value': c} for c in options]
+        for position, row in enumerate(rows):
+            if row[0] in old_indexes:
+                patch[position + 1]['props']['children'][0]['props']['children'][0]['props']['options'] = country_options
+                changed = True
+    if not changed:
+        raise PreventUpdate
+    return patch
+
+def valid_residence_rows(rows):
+    # --- AUTO-RESET/CLEAR FUTURE PERIODS ---
+    # rows: (index, country, from_year, from_month, until_year, until_month) in table order
+    last_valid = 1
+    for i in range(1, len(rows)):
+        _, country, from_year, from_month, until_year, until_month = rows[i]
+        # Only check if from is after until (invalid period); a date being picked isn't checked yet
+        if None not in (from_year, from_month, until_year, until_month) and (
+                (until_year < from_year) or (until_year == from_year and until_month < from_month)):
             break
         # Check if country is set
-        if not res_countries[i]:
+        if not country:
             break
         last_valid = i + 1
-    # Truncate all lists at the first invalid/non-sequential period
-    res_countries = res_countries[:last_valid]
-    res_from_years = res_from_years[:last_valid]
-    res_from_months = res_from_months[:last_valid]
-    res_until_years = res_until_years[:last_valid]
-    res_until_months = res_until_months[:last_valid]
-    # Build all rows
-    preserved_rows = [build_row(i, res_countries[i], res_from_years[i], res_from_months[i], res_until_years[i], res_until_months[i], options) for i in range(len(res_countries))]
-    return [header] + preserved_rows
+    # Truncate at the first invalid/non-sequential period
+    return rows[:last_valid]
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="hideToggleResidenceBtn"),
     Output("toggle_residence_btn", "style"),
     Input("residence_section", "style"),
     State("toggle_residence_btn", "style"),
     prevent_initial_call=False
 )
-def hide_toggle_residence_btn(res_section_style, btn_style):
-    style = dict(btn_style) if btn_style else {}
-    if res_section_style and res_section_style.get("display") == "block":
-        style["display"] = "none"
-    else:
-        style["display"] = ""
-    return style
+
+# --- Residence edits: each change is numbered by the page and recorded in the session ---
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="stampEdit"),
+    Output({'type': 'res_edit', 'index': MATCH}, 'data'),
+    Input({'type': 'res_country', 'index': MATCH}, 'value'),
+    Input({'type': 'res_from_year', 'index': MATCH}, 'value'),
+    Input({'type': 'res_from_month', 'index': MATCH}, 'value'),
+    Input({'type': 'res_until_year', 'index': MATCH}, 'value'),
+    Input({'type': 'res_until_month', 'index': MATCH}, 'value'),
+    State({'type': 'res_edit', 'index': MATCH}, 'id'),
+    prevent_initial_call=True
+)
+
+@app.callback(
+    Output({'type': 'res_country', 'index': MATCH}, 'className'),
+    Input({'type': 'res_edit', 'index': MATCH}, 'data'),
+    State({'type': 'res_edit', 'index': MATCH}, 'id'),
+    State('session_key', 'data'),
+    prevent_initial_call=True
+)
+def record_residence_edit(edit, row_id, session_key):
+    key = str(row_id['index'])
+    def record(session):
+        # A row that has just been removed isn't brought back
+        if key in session['residences']:
+            session['residences'][key] = list(edit['values'])
+        record_edit(session, f"residence:{key}", edit['count'])
+    try:
+        SESSIONS.update(session_key, record)
+    except SessionExpired:
+        # Generate! says so
+        raise PreventUpdate
+    # Nothing on the page changes, Dash just needs an output
+    return dash.no_update
 
 # --- Residence period logic: restrict 'until' >= 'from' and prevent overlaps ---
+def other_residence_periods(session_key, row_id, dob_year):
+    # The other rows' periods in the session, as month indexes
+    session = SESSIONS.get(session_key)
+    if session is None:
+        raise PreventUpdate
+    key = str(row_id['index'])
+    return [(month_index(fy or dob_year, fm or 1), month_index(uy or dob_year, um or 1))
+            for index, (_, fy, fm, uy, um) in session['residences'].items() if index != key and fy is not None and uy is not None]
+
 @app.callback(
     Output({'type': 'res_until_year', 'index': MATCH}, 'options'),
     Output({'type': 'res_until_month', 'index': MATCH}, 'options'),
@@ -838,16 +1023,15 @@ def hide_toggle_residence_btn(res_section_style, btn_style):
     Input({'type': 'res_country', 'index': MATCH}, 'value'),
     State({'type': 'res_until_year', 'index': MATCH}, 'value'),
     State({'type': 'res_until_month', 'index': MATCH}, 'value'),
-    State({'type': 'res_country', 'index': ALL}, 'value'),
-    State({'type': 'res_from_year', 'index': ALL}, 'value'),
-    State({'type': 'res_from_month', 'index': ALL}, 'value'),
-    State({'type': 'res_until_year', 'index': ALL}, 'value'),
-    State({'type': 'res_until_month', 'index': ALL}, 'value'),
+    State({'type': 'res_country', 'index': MATCH}, 'id'),
+    State('session_key', 'data'),
     State('dob_year', 'value'),
     State('dob_month', 'value'),
     prevent_initial_call=False
 )
-def restrict_until_options(from_year, from_month, country, until_year, until_month, all_countries, all_from_years, all_from_months, all_until_years, all_until_months, dob_year, dob_month):
+def restrict_until_options(from_year, from_month, country, until_year, until_month, row_id, session_key, dob_year, dob_month):
+    other_periods = other_residence_periods(session_key, row_id, dob_year)
+    current_until_year, current_until_month = until_year, until_month
     import datetime
     today = datetime.date.today()
     current_year = today.year
@@ -860,49 +1044,29 @@ def restrict_until_options(from_year, from_month, country, until_year, until_mon
     if from_month is None:
         from_month = dob_month or 1
     if until_year == from_year:
-        until_month_options = [(months_full[m-1], m) for m in range(from_month, current_month+1 if until_year==current_year else 13)]
+        until_months = (from_month, current_month if until_year == current_year else 12)
     elif until_year == current_year:
-        until_month_options = [(months_full[m-1], m) for m in range(1, current_month+1)]
+        until_months = (1, current_month)
     else:
-        until_month_options = [(months_full[m-1], m) for m in range(1, 13)]
-    this_idx = None
-    for idx, (c, fy, fm, uy, um) in enumerate(zip(all_countries, all_from_years, all_from_months, all_until_years, all_until_months)):
-        if c == country and fy == from_year and fm == from_month and uy == until_year and um == until_month:
-            this_idx = idx
-            break
-    def age_tuple(y, m):
-        return (y or dob_year, m or 1)
-    this_from = age_tuple(from_year, from_month)
-    # --- CHANGED: collect all other periods, not just same country ---
-    other_periods = []
-    for idx, (c, fy, fm, uy, um) in enumerate(zip(all_countries, all_from_years, all_from_months, all_until_years, all_until_months)):
-        if idx == this_idx or fy is None or uy is None:
-            continue
-        other_periods.append((age_tuple(fy, fm), age_tuple(uy, um)))
-    filtered_until_year_options = []
-    filtered_until_month_options = []
-    current_until_year = all_until_years[this_idx] if this_idx is not None else None
-    current_until_month = all_until_months[this_idx] if this_idx is not None else None
-    for y in until_year_options:
-        for m in ([v for _, v in until_month_options] if y == until_year else range(1, 13)):
-            this_until = (y, m)
-            overlap = False
-            for (o_from, o_until) in other_periods:
-                if not (this_until <= o_from or this_from >= o_until):
-                    overlap = True
-                    break
-            if not overlap or (y == current_until_year and m == current_until_month):
-                if y not in filtered_until_year_options:
-                    filtered_until_year_options.append(y)
-                if y == until_year or y == current_until_year:
-                    filtered_until_month_options.append((months_full[m-1], m))
+        until_months = (1, 12)
+    # Any 'until' up to the start of the next period that ends after our 'from' is free
+    latest_until = PeriodIndex(other_periods).latest_until(month_index(from_year or dob_year, from_month or 1))
+    keep = (current_until_year, current_until_month) if None not in (current_until_year, current_until_month) else None
+    filtered_until_year_options, until_month_values = free_options(
+        until_year_options,
+        lambda y: until_months if y == until_year else (1, 12),
+        high=latest_until,
+        keep=keep,
+        detail_years=(until_year, current_until_year),
+    )
+    filtered_until_month_options = [month_option(m) for m in until_month_values]
     if not filtered_until_year_options:
         filtered_until_year_options = [from_year]
     if not filtered_until_month_options:
-        filtered_until_month_options = [(months_full[from_month-1], from_month)]
+        filtered_until_month_options = [month_option(from_month)]
     return (
-        [{'label': str(y), 'value': y} for y in filtered_until_year_options],
-        [{'label': label, 'value': value} for label, value in filtered_until_month_options]
+        [year_option(y) for y in filtered_until_year_options],
+        filtered_until_month_options
     )
 
 @app.callback(
@@ -911,16 +1075,17 @@ def restrict_until_options(from_year, from_month, country, until_year, until_mon
     Input({'type': 'res_country', 'index': MATCH}, 'value'),
     Input({'type': 'res_until_year', 'index': MATCH}, 'value'),
     Input({'type': 'res_until_month', 'index': MATCH}, 'value'),
-    State({'type': 'res_country', 'index': ALL}, 'value'),
-    State({'type': 'res_from_year', 'index': ALL}, 'value'),
-    State({'type': 'res_from_month', 'index': ALL}, 'value'),
-    State({'type': 'res_until_year', 'index': ALL}, 'value'),
-    State({'type': 'res_until_month', 'index': ALL}, 'value'),
+    State({'type': 'res_from_year', 'index': MATCH}, 'value'),
+    State({'type': 'res_from_month', 'index': MATCH}, 'value'),
+    State({'type': 'res_country', 'index': MATCH}, 'id'),
+    State('session_key', 'data'),
     State('dob_year', 'value'),
     State('dob_month', 'value'),
     prevent_initial_call=False
 )
-def restrict_from_options(country, until_year, until_month, all_countries, all_from_years, all_from_months, all_until_years, all_until_months, dob_year, dob_month):
+def restrict_from_options(country, until_year, until_month, from_year, from_month, row_id, session_key, dob_year, dob_month):
+    other_periods = other_residence_periods(session_key, row_id, dob_year)
+    current_from_year, current_from_month = from_year, from_month
     import datetime
     today = datetime.date.today()
     current_year = today.year
@@ -935,54 +1100,35 @@ def restrict_from_options(country, until_year, until_month, all_countries, all_f
     if dob_month is None:
         dob_month = 1
     if until_year == dob_year:
-        from_month_options = [(months_full[m-1], m) for m in range(dob_month, until_month+1)]
+        from_months = (dob_month, until_month)
     elif until_year == current_year:
-        from_month_options = [(months_full[m-1], m) for m in range(1, until_month+1)]
+        from_months = (1, until_month)
     else:
-        from_month_options = [(months_full[m-1], m) for m in range(1, 13)]
-    # --- CHANGED: collect all other periods, not just same country ---
-    this_idx = None
-    for idx, (c, fy, fm, uy, um) in enumerate(zip(all_countries, all_from_years, all_from_months, all_until_years, all_until_months)):
-        if c == country and uy == until_year and um == until_month and fy == all_from_years[idx] and fm == all_from_months[idx]:
-            this_idx = idx
-            break
-    def age_tuple(y, m):
-        return (y or dob_year, m or 1)
-    this_until = age_tuple(until_year, until_month)
-    other_periods = []
-    for idx, (c, fy, fm, uy, um) in enumerate(zip(all_countries, all_from_years, all_from_months, all_until_years, all_until_months)):
-        if idx == this_idx or fy is None or uy is None:
-            continue
-        other_periods.append((age_tuple(fy, fm), age_tuple(uy, um)))
-    filtered_from_year_options = []
-    filtered_from_month_options = []
+        from_months = (1, 12)
+    # Any 'from' after the end of the last period that starts before our 'until' is free
+    earliest_from = PeriodIndex(other_periods).earliest_from(month_index(until_year or dob_year, until_month or 1))
     # Always include the currently selected value
-    current_from_year = all_from_years[this_idx] if this_idx is not None else None
-    current_from_month = all_from_months[this_idx] if this_idx is not None else None
-    for y in from_year_options:
-        for m in ([v for _, v in from_month_options] if y == dob_year else range(1, 13)):
-            this_from = (y, m)
-            overlap = False
-            for (o_from, o_until) in other_periods:
-                if not (this_until <= o_from or this_from >= o_until):
-                    overlap = True
-                    break
-            if not overlap or (y == current_from_year and m == current_from_month):
-                if y not in filtered_from_year_options:
-                    filtered_from_year_options.append(y)
-                if y == dob_year or y == current_from_year:
-                    filtered_from_month_options.append((months_full[m-1], m))
+    keep = (current_from_year, current_from_month) if None not in (current_from_year, current_from_month) else None
+    filtered_from_year_options, from_month_values = free_options(
+        from_year_options,
+        lambda y: from_months if y == dob_year else (1, 12),
+        low=earliest_from,
+        keep=keep,
+        detail_years=(dob_year, current_from_year),
+    )
+    filtered_from_month_options = [month_option(m) for m in from_month_values]
     if not filtered_from_year_options:
         filtered_from_year_options = [dob_year]
     if not filtered_from_month_options:
-        filtered_from_month_options = [(months_full[dob_month-1], dob_month)]
+        filtered_from_month_options = [month_option(dob_month)]
     return (
-        [{'label': str(y), 'value': y} for y in filtered_from_year_options],
-        [{'label': label, 'value': value} for label, value in filtered_from_month_options]
+        [year_option(y) for y in filtered_from_year_options],
+        filtered_from_month_options
     )
 
 # Add auto-correction for from/until residence period selection
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="autocorrectFromUntil"),
     Output({'type': 'res_from_year', 'index': MATCH}, 'value'),
     Output({'type': 'res_from_month', 'index': MATCH}, 'value'),
     Output({'type': 'res_until_year', 'index': MATCH}, 'value'),
@@ -995,31 +1141,29 @@ def restrict_from_options(country, until_year, until_month, all_countries, all_f
     State('dob_month', 'value'),
     prevent_initial_call=False
 )
-def autocorrect_from_until(from_year, from_month, until_year, until_month, dob_year, dob_month):
-    # If until is before from, set from = until
-    # If from is after until, set until = from
-    if from_year is None or from_month is None:
-        return from_year, from_month, until_year, until_month
-    if until_year is None or until_month is None:
-        return from_year, from_month, until_year, until_month
-    from_tuple = (from_year, from_month)
-    until_tuple = (until_year, until_month)
-    if until_tuple < from_tuple:
-        return until_year, until_month, until_year, until_month
-    if from_tuple > until_tuple:
-        return from_year, from_month, from_year, from_month
-    return from_year, from_month, until_year, until_month
 
 # Add a callback to show/hide the label based on country selection
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="countrygen", function_name="showVisitLabel"),
     Output("visit_countries_label", "style"),
     Input("country_select", "value"),
 )
-def show_visit_label(selected_countries):
-    if selected_countries and len(selected_countries) > 0:
-        return {"fontSize": 14, "marginBottom": "18px", "display": "block"}
-    else:
-        return {"fontSize": 14, "marginBottom": "18px", "display": "none"}
+
+# --- Metrics: opt-in, per callback, on /metrics (see metrics.py) ---
+def metrics_gauges():
+    gauges = {
+        "flag_cache": FLAG_CACHE.stats(),
+        "figure_cache": FIGURE_CACHE.stats(),
+        "export": CHART_EXPORTER.stats(),
+        "sessions": SESSIONS.stats(),
+        "imports": LOCATION_IMPORTER.stats(),
+    }
+    if FLAG_ATLAS:
+        gauges["flag_atlas"] = FLAG_ATLAS.stats()
+    return gauges
+
+if metrics_enabled():
+    install_metrics(app, metrics_gauges, os.environ.get("COUNTRYGEN_METRICS_PROFILE_DIR"))
 
 if __name__ == "__main__":
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,182 @@
+import json
+import os
+import unicodedata
+from collections import namedtuple
+from importlib import metadata
+
+# --- Country catalogue: built once, loaded from disk at startup ---
+# Run `python country_catalogue.py` to regenerate the data file. The app rebuilds
+# it automatically if the pycountry/coco versions it was built from have changed.
+CATALOGUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_catalogue.json")
+CATALOGUE_SCHEMA = 2
+SOURCE_DISTRIBUTIONS = ("pycountry", "country_converter", "pycountry_convert")
+# Catalogue rows are stored on disk in this field order
+Country = namedtuple("Country", ["alpha_2", "alpha_3", "name", "continent", "label"])
+
+continent_map = {
+    'AF': 'Africa',
+    'AS': 'Asia',
+    'EU': 'Europe',
+    'NA': 'North America',
+    'OC': 'Oceania',
+    'SA': 'South America',
+    'AN': 'Antarctica'
+}
+UN_MEMBER_ALPHA2 = set([
+    'AF', 'AL', 'DZ', 'AD', 'AO', 'AG', 'AR', 'AM', 'AU', 'AT', 'AZ',
+    'BS', 'BH', 'BD', 'BB', 'BY', 'BE', 'BZ', 'BJ', 'BT', 'BO', 'BA', 'BW',
+    'BR', 'BN', 'BG', 'BF', 'BI', 'CV', 'KH', 'CM', 'CA', 'CF', 'TD', 'CL',
+    'CN', 'CO', 'KM', 'CD', 'CG', 'CR', 'CI', 'HR', 'CU', 'CY', 'CZ', 'DK',
+    'DJ', 'DM', 'DO', 'EC', 'EG', 'SV', 'GQ', 'ER', 'EE', 'SZ', 'ET', 'FJ',
+    'FI', 'FR', 'GA', 'GM', 'GE', 'DE', 'GH', 'GR', 'GD', 'GT', 'GN', 'GW',
+    'GY', 'HT', 'HN', 'HU', 'IS', 'IN', 'ID', 'IR', 'IQ', 'IE', 'IL', 'IT',
+    'JM', 'JP', 'JO', 'KZ', 'KE', 'KI', 'KP', 'KR', 'KW', 'KG', 'LA', 'LV',
+    'LB', 'LS', 'LR', 'LY', 'LI', 'LT', 'LU', 'MG', 'MW', 'MY', 'MV', 'ML',
+    'MT', 'MH', 'MR', 'MU', 'MX', 'FM', 'MD', 'MC', 'MN', 'ME', 'MA', 'MZ',
+    'MM', 'NA', 'NR', 'NP', 'NL', 'NZ', 'NI', 'NE', 'NG', 'MK', 'NO', 'OM',
+    'PK', 'PW', 'PS', 'PA', 'PG', 'PY', 'PE', 'PH', 'PL', 'PT', 'QA', 'RO',
+    'RU', 'RW', 'KN', 'LC', 'VC', 'WS', 'SM', 'ST', 'SA', 'SN', 'RS', 'SC',
+    'SL', 'SG', 'SK', 'SI', 'SB', 'SO', 'ZA', 'SS', 'ES', 'LK', 'SD', 'SR',
+    'SE', 'CH', 'SY', 'TW', 'TJ', 'TZ', 'TH', 'TL', 'TG', 'TO', 'TT', 'TN',
+    'TR', 'TM', 'UG', 'UA', 'AE', 'GB', 'US', 'UY', 'UZ', 'VU', 'VA', 'VE',
+    'VN', 'YE', 'ZM', 'ZW', 'AQ'
+])
+
+def get_continent(alpha_2):
+    import pycountry_convert
+    special_cases = {
+        'AQ': 'Antarctica',
+        'TL': 'Asia',
+        'VA': 'Europe',
+        'TR': 'Europe',
+    }
+    if alpha_2 in special_cases:
+        return special_cases[alpha_2]
+    try:
+        continent_code = pycountry_convert.country_alpha2_to_continent_code(alpha_2)
+        return continent_map.get(continent_code, 'Unknown')
+    except Exception:
+        return 'Unknown'
+
+def country_label(name, alpha_2):
+    return f"{name} ({alpha_2})"
+
+def source_versions():
+    # Read from package metadata so checking the catalogue never imports the (slow) libraries themselves
+    versions = {}
+    for dist in SOURCE_DISTRIBUTIONS:
+        try:
+            versions[dist] = metadata.version(dist)
+        except metadata.PackageNotFoundError:
+            versions[dist] = None
+    return versions
+
+def build_country_list():
+    import pycountry
+    import country_converter as coco
+    countries = [country for country in pycountry.countries
+                 if hasattr(country, 'alpha_2') and country.alpha_2 in UN_MEMBER_ALPHA2]
+    # One converter and one batched conversion instead of a fresh converter per country
+    short_names = coco.CountryConverter().convert(names=[country.alpha_2 for country in countries], to='name_short')
+    if isinstance(short_names, str):
+        short_names = [short_names]
+    return [
+        Country(
+            alpha_2=country.alpha_2,
+            alpha_3=country.alpha_3,
+            name=short_name,
+            continent=get_continent(country.alpha_2),
+            label=country_label(short_name, country.alpha_2),
+        )
+        for country, short_name in zip(countries, short_names)
+    ]
+
+def write_catalogue(country_list, path=CATALOGUE_PATH):
+    payload = {
+        "schema": CATALOGUE_SCHEMA,
+        "versions": source_versions(),
+        "countries": [list(c) for c in country_list],
+    }
+    # Write to a temp file and rename so concurrent workers never read a half-written catalogue
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+def read_catalogue(path=CATALOGUE_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if payload.get("schema") != CATALOGUE_SCHEMA or payload.get("versions") != source_versions():
+        return None
+    return [Country(*row) for row in payload["countries"]]
+
+def load_country_list(path=CATALOGUE_PATH):
+    country_list = read_catalogue(path)
+    if country_list is None:
+        country_list = build_country_list()
+        try:
+            write_catalogue(country_list, path)
+        except OSError:
+            pass
+    return country_list
+
+def normalize_name(text):
+    # Case- and accent-insensitive form used for name lookups ("Côte d'Ivoire" -> "cote d'ivoire")
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold().strip()
+
+class CountryRegistry:
+    """Country records with hash indexes by label, alpha_2, alpha_3 and normalized name."""
+
+    __slots__ = ("countries", "_by_label", "_by_alpha_2", "_by_alpha_3", "_by_name", "_index")
+
+    def __init__(self, countries):
+        self.countries = tuple(countries)
+        self._by_label = {c.label: c for c in self.countries}
+        self._by_alpha_2 = {c.alpha_2: c for c in self.countries}
+        self._by_alpha_3 = {c.alpha_3: c for c in self.countries}
+        self._by_name = {normalize_name(c.name): c for c in self.countries}
+        self._index = {c.alpha_2: i for i, c in enumerate(self.countries)}
+
+    def __len__(self):
+        return len(self.countries)
+
+    def __iter__(self):
+        return iter(self.countries)
+
+    def by_label(self, label):
+        return self._by_label.get(label)
+
+    def by_alpha_2(self, code):
+        return self._by_alpha_2.get(code.upper()) if code else None
+
+    def by_alpha_3(self, code):
+        return self._by_alpha_3.get(code.upper()) if code else None
+
+    def by_name(self, name):
+        return self._by_name.get(normalize_name(name)) if name else None
+
+    def index_of(self, code):
+        # Position in .countries, so per-country data can live in arrays
+        return self._index[code.upper()]
+
+    def lookup(self, text):
+        # Resolve whatever the user (or a profile file) gave us: a label, a code or a name
+        if not text:
+            return None
+        return (self._by_label.get(text) or self.by_alpha_2(text) or self.by_alpha_3(text)
+                or self.by_name(text))
+
+    def labels(self):
+        return [c.label for c in self.countries]
+
+def load_registry(path=CATALOGUE_PATH):
+    return CountryRegistry(load_country_list(path))
+
+if __name__ == "__main__":
+    countries = build_country_list()
+    write_catalogue(countries)
+    print(f"Wrote {len(countries)} countries to {CATALOGUE_PATH}")
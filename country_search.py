@@ -0,0 +1,140 @@
+import re
+
+from country_catalogue import normalize_name
+
+# --- Country search: ranked, accent-insensitive matches on names, codes and aliases ---
+# Everything is worked out when the index is built: every prefix of every name, alias and
+# code (and of each of their words) maps to its ranked matches, so a search as you type is
+# one dict lookup. Queries that aren't such a prefix (several partial words, or text from
+# the middle of a word) are answered from word-prefix and trigram sets.
+SEARCH_LIMIT = 20
+NGRAM = 3
+
+# Other names people type; the catalogue only has each country's short name
+COUNTRY_ALIASES = {
+    "AE": ("UAE", "Emirates", "Dubai"),
+    "BA": ("Bosnia",),
+    "BN": ("Brunei",),
+    "CD": ("Democratic Republic of the Congo", "DRC", "Congo-Kinshasa", "Zaire"),
+    "CG": ("Republic of the Congo", "Congo-Brazzaville"),
+    "CH": ("Schweiz", "Suisse", "Svizzera"),
+    "CI": ("Ivory Coast",),
+    "CN": ("People's Republic of China", "PRC"),
+    "CV": ("Cape Verde",),
+    "CZ": ("Czechia",),
+    "DE": ("Deutschland",),
+    "ES": ("España",),
+    "FM": ("Micronesia",),
+    "GB": ("UK", "Great Britain", "Britain", "England", "Scotland", "Wales", "Northern Ireland"),
+    "GR": ("Hellas", "Ellada"),
+    "IR": ("Persia",),
+    "KG": ("Kyrgyzstan",),
+    "KN": ("Saint Kitts and Nevis",),
+    "KP": ("DPRK", "Democratic People's Republic of Korea"),
+    "KR": ("Korea", "Republic of Korea"),
+    "LA": ("Lao People's Democratic Republic",),
+    "LC": ("Saint Lucia",),
+    "MK": ("Macedonia",),
+    "MM": ("Burma",),
+    "NL": ("Holland", "Nederland"),
+    "PS": ("State of Palestine",),
+    "RU": ("Russian Federation",),
+    "SY": ("Syrian Arab Republic",),
+    "SZ": ("Swaziland",),
+    "TL": ("East Timor",),
+    "TR": ("Turkey",),
+    "TW": ("Republic of China",),
+    "US": ("USA", "United States of America", "America"),
+    "VA": ("Holy See", "Vatican City"),
+    "VC": ("Saint Vincent and the Grenadines",),
+    "VN": ("Viet Nam",),
+}
+
+# Best first: how a country matches a query
+EXACT, NAME_PREFIX, NAME_WORD, CODE_PREFIX, ALIAS_PREFIX, ALIAS_WORD, INFIX = range(7)
+
+def search_text(text):
+    # Accent- and case-insensitive words separated by single spaces ("Côte d'Ivoire" -> "cote d ivoire")
+    return " ".join(re.findall(r"\w+", normalize_name(text)))
+
+def ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+class CountrySearchIndex:
+    """Prefix and trigram index over a registry's countries."""
+
+    def __init__(self, registry, aliases=COUNTRY_ALIASES):
+        self.registry = registry
+        self.countries = registry.countries
+        # Normalized name, codes and aliases of each country, in registry order
+        self.names = [search_text(c.name) for c in self.countries]
+        self.terms = []
+        ranks = {}
+        grams = {}
+        for position, c in enumerate(self.countries):
+            name = self.names[position]
+            codes = [c.alpha_2.lower(), c.alpha_3.lower()]
+            alias_texts = [search_text(alias) for alias in aliases.get(c.alpha_2, ())]
+            self.terms.append(" ".join([name, *codes, *alias_texts]))
+            keys = {}
+            for text, whole_rank, word_rank in [(name, NAME_PREFIX, NAME_WORD)] + [(code, CODE_PREFIX, CODE_PREFIX) for code in codes] + [(alias, ALIAS_PREFIX, ALIAS_WORD) for alias in alias_texts]:
+                for end in range(1, len(text) + 1):
+                    self._best(keys, text[:end], whole_rank)
+                self._best(keys, text, EXACT)
+                for word in text.split(" ")[1:]:
+                    for end in range(1, len(word) + 1):
+                        self._best(keys, word[:end], word_rank)
+            for key, rank in keys.items():
+                ranks.setdefault(key, {})[position] = rank
+            for gram in ngrams(self.terms[position]):
+                grams.setdefault(gram, set()).add(position)
+        self._ngrams = {gram: frozenset(positions) for gram, positions in grams.items()}
+        # Every prefix's matches, ranked, and the rank each one has (for queries of several words)
+        self._ranks = ranks
+        self._ranked = {key: tuple(sorted(matches, key=lambda p: (matches[p], self.names[p]))) for key, matches in ranks.items()}
+
+    @staticmethod
+    def _best(keys, key, rank):
+        if rank < keys.get(key, INFIX + 1):
+            keys[key] = rank
+
+    def _word_matches(self, word):
+        # {position: rank} of the countries with a name, code or alias containing word
+        matches = dict(self._ranks.get(word, ()))
+        if len(word) >= NGRAM:
+            candidates = frozenset.intersection(*(self._ngrams.get(gram, frozenset()) for gram in ngrams(word)))
+            for position in candidates:
+                if position not in matches and word in self.terms[position]:
+                    matches[position] = INFIX
+        return matches
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        # Countries matching query, best first
+        text = search_text(query or "")
+        if not text:
+            return []
+        ranked = self._ranked.get(text, ())
+        if len(ranked) < limit:
+            # Too few prefix matches: add those where the text is in the middle of a word, or
+            # where each word of the text matches on its own
+            scores = self._scores(text)
+            seen = set(ranked)
+            ranked += tuple(sorted((p for p in scores if p not in seen), key=lambda p: (scores[p], self.names[p])))
+        return [self.countries[p] for p in ranked[:limit]]
+
+    def _scores(self, text):
+        # Every word has to match somewhere; the worst of the words' ranks counts
+        scores = None
+        for word in text.split(" "):
+            matches = self._word_matches(word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {p: max(rank, matches[p]) for p, rank in scores.items() if p in matches}
+            if not scores:
+                return {}
+        return scores
+
+    def search_terms(self, country):
+        # The normalized name, codes and aliases of a country
+        return self.terms[self.registry.index_of(country.alpha_2)]
@@ -0,0 +1,50 @@
+import datetime
+import threading
+from functools import lru_cache
+
+# --- Dropdown options for years and months, shared by every callback that offers them ---
+# Option dicts and tables are built once and handed out as-is, so treat them as read-only.
+# Ranges without an end run to the current month, so cached tables are dropped when it rolls over.
+months_full = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
+MONTH_OPTIONS = tuple({"label": name, "value": m} for m, name in enumerate(months_full, 1))
+
+_tables = {}
+_tables_month = None
+_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def year_option(year):
+    return {"label": str(year), "value": year}
+
+def month_option(month):
+    return MONTH_OPTIONS[month - 1]
+
+def _this_month():
+    today = datetime.date.today()
+    return today.year, today.month
+
+def _table(key, build):
+    global _tables_month
+    this_month = _this_month()
+    with _lock:
+        if this_month != _tables_month:
+            _tables.clear()
+            _tables_month = this_month
+        table = _tables.get(key)
+    if table is None:
+        table = tuple(build())
+        with _lock:
+            table = _tables.setdefault(key, table)
+    return table
+
+def year_options(start_year, end_year=None):
+    end_year = end_year or _this_month()[0]
+    return _table((start_year, None, end_year, None), lambda: map(year_option, range(start_year, end_year + 1)))
+
+def month_options(year, start_year, start_month, end_year=None, end_month=None):
+    # Months of `year` that lie between start and end (default: this month)
+    if end_year is None:
+        end_year, end_month = _this_month()
+    first = start_month if year == start_year else 1
+    last = end_month if year == end_year else 12
+    return _table((start_year, start_month, end_year, end_month, year), lambda: MONTH_OPTIONS[first - 1:last])
@@ -0,0 +1,500 @@
+import argparse
+import copy
+import csv
+import datetime
+import functools
+import json
+import math
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import plotly.graph_objs as go
+
+from country_catalogue import load_registry
+from timeline import Timeline
+
+# --- Chart engine: timeline computation and figure construction, independent of Dash ---
+# The app calls this for every chart; `python engine.py profiles.jsonl --out charts/`
+# renders saved profiles in bulk. Profiles are JSON objects (in a .json list or one per
+# line in .jsonl) or CSV rows with the same fields:
+#   {"id": "ana", "dob": "1990-04",
+#    "visits": ["FR:2001-05", {"country": "Japan", "date": "2015-10"}],
+#    "residences": ["GB:1990-04:2005-06", {"country": "DE", "from": "2010-01", "until": "2012-08"}]}
+# In CSV, visits and residences are ";"-separated lists of the string forms above.
+DEFAULT_VISIT = (1990, 1)  # used when a visit has no date, same as the app's visit selectors
+OUTPUT_FORMATS = ("json", "png", "svg", "pdf")
+PROGRESS_EVERY = 100
+MARGIN = dict(l=0, r=40, t=80, b=40)
+SLOT_HEIGHT = 64  # chart pixels per row (a 62px flag and its margins); charts are at least 600px tall
+# Flag atlas mode draws each chunk of rows' flags as one image, composed at fixed pixel
+# positions, so the figure's size and margins are fixed rather than fitted to the page
+ATLAS_WIDTH = 836  # the app's chart column
+ATLAS_MARGIN = dict(MARGIN, l=70)
+ATLAS_ROWS = 40
+# Every atlas a figure asks for is the plot area's width (see is_atlas_spec)
+ATLAS_PLOT_WIDTH = ATLAS_WIDTH - ATLAS_MARGIN["l"] - ATLAS_MARGIN["r"]
+# Charts with more rows than this are shown a window of rows at a time (see window_figure)
+WINDOW_ROWS = 40
+
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = load_registry()
+    return _registry
+
+def make_inputs(dob_year, dob_month, visits, residences, today=None):
+    # visits: (alpha_2, year, month) in selection order, which decides the order of countries
+    # first visited in the same month; residences: (alpha_2, from_year, from_month, until_year, until_month)
+    today = today or datetime.date.today()
+    return {
+        "dob": [dob_year, dob_month],
+        "today": [today.year, today.month],
+        "visits": [list(v) for v in visits],
+        "residences": [list(r) for r in residences],
+    }
+
+# --- Profiles ---
+def parse_month(text, default=None):
+    if not text:
+        if default is None:
+            raise ValueError("missing date")
+        return default
+    match = re.fullmatch(r"\s*(\d{4})(?:-(\d{1,2}))?\s*", str(text))
+    if not match:
+        raise ValueError(f"bad date {text!r}, expected YYYY-MM")
+    year, month = int(match.group(1)), int(match.group(2) or 1)
+    if not 1 <= month <= 12:
+        raise ValueError(f"bad month in {text!r}")
+    return year, month
+
+def split_items(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(";") if item.strip()]
+    return list(value)
+
+def resolve_country(registry, text):
+    c = registry.lookup(str(text).strip()) if text else None
+    if c is None:
+        raise ValueError(f"unknown country {text!r}")
+    return c
+
+def parse_profile(record, registry=None, today=None):
+    registry = registry or get_registry()
+    dob_year, dob_month = parse_month(record.get("dob"))
+    visits = []
+    seen = set()
+    for item in split_items(record.get("visits")):
+        if isinstance(item, dict):
+            country, date = item.get("country"), item.get("date")
+        elif ":" in item:
+            country, date = item.rsplit(":", 1)
+        else:
+            country, date = item, None
+        c = resolve_country(registry, country)
+        # A country can only be visited for the first time once
+        if c.alpha_2 in seen:
+            continue
+        seen.add(c.alpha_2)
+        visits.append((c.alpha_2, *parse_month(date, DEFAULT_VISIT)))
+    if not visits:
+        raise ValueError("no visits")
+    residences = []
+    for item in split_items(record.get("residences")):
+        if isinstance(item, dict):
+            country, date_from, date_until = item.get("country"), item.get("from"), item.get("until")
+        else:
+            country, date_from, date_until = item.rsplit(":", 2)
+        c = resolve_country(registry, country)
+        residences.append((c.alpha_2, *parse_month(date_from), *parse_month(date_until)))
+    return make_inputs(dob_year, dob_month, visits, residences, today)
+
+def iter_profiles(path):
+    # .jsonl and .csv are read a record at a time, so huge files never sit in memory
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+    elif path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+        yield from payload["profiles"] if isinstance(payload, dict) else payload
+
+# --- Figure ---
+def vertical_lines_path(xs, y0, y1):
+    # SVG path in data coordinates drawing a vertical line from y0 to y1 at every x
+    return "".join(f"M{x},{y0}L{x},{y1}" for x in xs)
+
+def row_heights(n_rows):
+    # Chart height in pixels, and bar and flag heights in rows: a 1px margin around each bar and flag
+    chart_height = max(600, n_rows * SLOT_HEIGHT)
+    pixels_per_data_unit = chart_height / n_rows if n_rows > 0 else 1
+    margin_data_units = 1 / pixels_per_data_unit
+    bar_height = 1.0 - 2 * margin_data_units
+    return chart_height, bar_height, bar_height - 2 * margin_data_units
+
+@functools.lru_cache(maxsize=None)
+def atlas_rows(n_rows, first):
+    # The atlas of an n_rows chart's rows from `first`: its height, and the (top, height) of each
+    # row's flag box, in the plot area's pixels
+    chart_height, _, flag_height = row_heights(n_rows)
+    row_px = (chart_height - ATLAS_MARGIN["t"] - ATLAS_MARGIN["b"]) / n_rows
+    last = min(first + ATLAS_ROWS, n_rows)
+    top = round(first * row_px)
+    boxes = tuple(
+        (round((i + 0.5 - flag_height / 2) * row_px) - top, round(flag_height * row_px))
+        for i in range(first, last)
+    )
+    return round(last * row_px) - top, boxes
+
+def is_atlas_spec(size, placements, max_rows):
+    # Whether add_flag_atlas could have asked for this atlas, for a chart of at most max_rows rows:
+    # the plot area's width, one flag of each country per row of one of its chunks, all as wide
+    if size[0] != ATLAS_PLOT_WIDTH or not 1 <= len(placements) <= ATLAS_ROWS:
+        return False
+    if len({code for code, _, _ in placements}) != len(placements):
+        return False
+    if len({box[2] for _, box, _ in placements}) != 1:
+        return False
+    rows = (size[1], tuple((box[1], box[3]) for _, box, _ in placements))
+    for first in range(0, max_rows, ATLAS_ROWS):
+        if len(placements) < ATLAS_ROWS:
+            # Only a chart's last chunk is short
+            row_counts = [first + len(placements)]
+        else:
+            row_counts = range(first + ATLAS_ROWS, max_rows + 1)
+        if any(n_rows <= max_rows and atlas_rows(n_rows, first) == rows for n_rows in row_counts):
+            return True
+    return False
+
+def add_flag_atlas(fig, flags, flag_atlas, x_axis_max, flag_sizex):
+    # One layout image per ATLAS_ROWS rows, stretched over them; flag boxes are in the plot area's pixels
+    n_rows = len(flags)
+    plot_width = ATLAS_PLOT_WIDTH
+    x_px = plot_width / x_axis_max
+    for first in range(0, n_rows, ATLAS_ROWS):
+        last = min(first + ATLAS_ROWS, n_rows)
+        height, rows = atlas_rows(n_rows, first)
+        placements = []
+        for (code, _, flag_x, xanchor), (top, flag_px) in zip(flags[first:last], rows):
+            left = flag_x - (flag_sizex / 2 if xanchor == "center" else 0)
+            box = (round(left * x_px), top, round(flag_sizex * x_px), flag_px)
+            placements.append((code, box, xanchor[0]))
+        source = flag_atlas((plot_width, height), placements)
+        if source:
+            fig.add_layout_image(
+                source=source,
+                xref="x",
+                yref="y",
+                x=0,
+                y=first - 0.5,
+                sizex=x_axis_max,
+                sizey=last - first,
+                xanchor="left",
+                yanchor="top",
+                layer="above",
+                sizing="stretch",
+            )
+
+def build_figure(inputs, flag_source, registry=None, flag_atlas=None):
+    # flag_source maps an alpha_2 code to an image source (URL or data URI), or None for no flag.
+    # With flag_atlas, flags are drawn as atlases instead: it maps ((width, height), placements) to
+    # an image source, placements being (alpha_2, (left, top, width, height), "l" or "c") in pixels.
+    registry = registry or get_registry()
+    # Rows in chart order: most recent first visit at the top
+    timeline = Timeline.from_inputs(inputs, registry)
+    visit_ages = timeline.ages
+    ages = visit_ages.tolist()
+    countries = [timeline.country(i) for i in range(len(timeline))]
+    current_age = timeline.current_age
+    max_visit_age = max(ages) if ages else current_age
+    x_axis_max = max(current_age, max_visit_age) + max(1, min(2, current_age * 0.2))
+    n_countries = len(timeline)
+    chart_height, bar_height, flag_height = row_heights(n_countries)
+    y_pos = np.arange(n_countries)
+    fig = go.Figure()
+    # Draw subtle vertical grid lines for each year, and more prominent for each 5 years;
+    # each set is a single path shape, however old the user is
+    grid_ages = range(0, int(current_age) + 1)
+    grid_styles = [
+        ([age for age in grid_ages if age % 5 == 0], dict(color="#cccccc", dash="dot", width=1.5)),
+        ([age for age in grid_ages if age % 5 != 0], dict(color="#eeeeee", dash="dot", width=1)),
+    ]
+    for xs, line in grid_styles:
+        if xs:
+            fig.add_shape(type="path", path=vertical_lines_path(xs, -0.5, n_countries - 0.5), line=line, layer="below")
+    zebra_colors = ['#d0f5df', '#b2eac7']
+    n_ticks = n_countries
+    # Zebra blocks of 5 countries, counted from the bottom of the chart
+    blocks = ((n_ticks - 1 - y_pos) // 5) % 2
+    # Draw every main bar (visit to now) as a single trace
+    fig.add_trace(go.Bar(
+        y=y_pos,
+        x=current_age - visit_ages,
+        base=visit_ages,
+        orientation='h',
+        marker=dict(color=np.array(zebra_colors)[blocks].tolist()),
+        width=bar_height,
+        showlegend=False,
+        hoverinfo='none',
+    ))
+    # All gold residence bars, clipped to each country's bar, go into a second trace
+    res_rows, res_starts, res_ends = timeline.residence_segments()
+    if len(res_rows):
+        # Use deeper gold for dark green stripes, lighter gold for light green stripes
+        residence_golds = np.where(blocks[res_rows] == 1, '#ffd700', '#ffe066')
+        fig.add_trace(go.Bar(
+            y=res_rows,
+            x=res_ends - res_starts,
+            base=res_starts,
+            orientation='h',
+            marker=dict(color=residence_golds.tolist()),
+            width=bar_height,
+            showlegend=False,
+            hoverinfo='none',
+        ))
+    # Flag positions: left edge at the visit, or centred on the bar if it would overflow the right edge
+    flag_sizex = 2.5
+    flags = []
+    for i, (c, visit_age) in enumerate(zip(countries, ages)):
+        if visit_age + flag_sizex > x_axis_max:
+            flags.append((c.alpha_2, i, min(x_axis_max - flag_sizex / 2, max(flag_sizex / 2, visit_age)), "center"))
+        else:
+            flags.append((c.alpha_2, i, visit_age, "left"))
+    if flag_atlas:
+        add_flag_atlas(fig, flags, flag_atlas, x_axis_max, flag_sizex)
+    else:
+        # Add flag images
+        for code, i, flag_x, xanchor in flags:
+            flag_src = flag_source(code)
+            if flag_src:
+                fig.add_layout_image(
+                    dict(
+                        source=flag_src,
+                        xref="x",
+                        yref="y",
+                        x=flag_x,
+                        y=i,
+                        sizex=flag_sizex,
+                        sizey=flag_height,
+                        xanchor=xanchor,
+                        yanchor="middle",
+                        layer="above",
+                        sizing="contain"
+                    )
+                )
+    # --- X-axis ticks: only up to current_age ---
+    x_tick_step = 5 if current_age > 10 else 1
+    x_tick_end = int(current_age) if current_age % 1 == 0 else int(current_age) + 1
+    x_tickvals = list(range(0, x_tick_end + 1, x_tick_step))
+    if x_tickvals[-1] < round(current_age):
+        x_tickvals.append(round(current_age))
+    x_tickvals = [v for v in x_tickvals if v <= current_age]
+    x_ticktext = [str(v) for v in x_tickvals]
+    fig.update_xaxes(title_text="Age", range=[0, x_axis_max], linewidth=3, linecolor="black", showline=False, zeroline=False, tickvals=x_tickvals, ticktext=x_ticktext)
+    # Robust y-axis ticks: 0 at bottom, 5, 10, ... at correct places, topmost value always labeled
+    tickvals = [n_ticks - 0.5 - i*5 for i in range((n_ticks // 5) + 1)]
+    ticktext = [str(i*5) for i in range((n_ticks // 5) + 1)]
+    if n_ticks % 5 != 0:
+        tickvals = [-0.5] + tickvals
+        ticktext = [str(n_ticks)] + ticktext
+    fig.update_yaxes(
+        tickvals=tickvals,
+        ticktext=ticktext,
+        # Reversed (first row at the top) and pinned, so the label traces don't pad the range
+        range=[n_countries-0.5, -0.5],
+        autorange=False,
+        title_text="Total countries visited",
+        title_font=dict(size=16, family="Arial, sans-serif", color="black"),
+        showticklabels=True,
+        showline=False,
+        linewidth=3,
+        linecolor="black"
+    )
+    # Add a custom vertical black line for the y-axis
+    fig.add_shape(
+        type="line",
+        x0=0, x1=0,
+        y0=-0.5, y1=n_countries-0.5,
+        line=dict(color="black", width=4),
+        layer="above"
+    )
+    # Add country name/age labels, dynamically positioned to right or left of flag.
+    # Labels are two text traces (right- and left-hand) rather than one annotation per country
+    label_width = 2.5  # estimate of label width in data units
+    # Default: place to right of flag; if label would overflow right edge, place to left
+    on_left = visit_ages + 2.7 + label_width > x_axis_max
+    label_x = np.where(on_left, np.maximum(visit_ages - 2.7, 0), visit_ages + 2.7)
+    label_text = np.array([f"{c.name} ({visit_age:.1f})" for c, visit_age in zip(countries, ages)], dtype=object)
+    for side, rows in (("middle right", ~on_left), ("middle left", on_left)):
+        if rows.any():
+            fig.add_trace(go.Scatter(
+                x=label_x[rows],
+                y=y_pos[rows],
+                text=label_text[rows],
+                mode="text",
+                textposition=side,
+                textfont=dict(size=14, family="Arial, sans-serif", color="#222"),
+                # Labels may run past the plot area, like the annotations they replace
+                cliponaxis=False,
+                showlegend=False,
+                hoverinfo="skip",
+            ))
+    fig.update_layout(
+        title={"text": "Countries visited by age", "x": 0.5, "xanchor": "center"},
+        height=chart_height,
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+        margin=MARGIN,
+        bargap=0,
+        bargroupgap=0,
+        barmode='overlay',
+    )
+    if flag_atlas:
+        fig.update_layout(width=ATLAS_WIDTH, margin=ATLAS_MARGIN)
+        fig.update_xaxes(automargin=False)
+        fig.update_yaxes(automargin=False)
+    # Restore the thin black line at the bottom of the lowest bar to mimic the x-axis
+    fig.add_shape(type="line", x0=0, x1=current_age, y0=n_countries-0.5, y1=n_countries-0.5, line=dict(color="black", width=2), layer="above")
+    percent = (n_countries / current_age) * 100 if current_age > 0 else 0
+    # Legend flag: use first visited country or default to Cuba
+    if countries:
+        first_flag_code = countries[0].alpha_2.lower()
+    else:
+        first_flag_code = 'cu'
+    summary = {
+        "n_countries": n_countries,
+        "percent": percent,
+        "chart_height": chart_height,
+        "legend_flag_code": first_flag_code,
+    }
+    return fig, summary
+
+# --- Windowed display: a tall chart shows WINDOW_ROWS rows at a time ---
+# The figure keeps every row; a window pins the y range to its rows and leaves the flags and
+# labels of the other rows out (images hidden, label text blanked), so they aren't drawn or loaded.
+def is_windowed(n_rows):
+    return n_rows > WINDOW_ROWS
+
+def window_height(chart_height, n_rows):
+    # Figure height showing WINDOW_ROWS rows at the full chart's row height
+    plot_height = chart_height - MARGIN["t"] - MARGIN["b"]
+    return round(WINDOW_ROWS * plot_height / n_rows) + MARGIN["t"] + MARGIN["b"]
+
+def visible_rows(y_range, n_rows):
+    # Rows (first, last + 1) at least partly inside a y range, in either order
+    low, high = sorted(y_range)
+    return max(0, math.floor(low + 0.5)), min(n_rows, math.ceil(high + 0.5))
+
+def image_rows(image):
+    # Top and bottom of an image's box, in rows
+    top = image["y"] if image.get("yanchor") == "top" else image["y"] - image["sizey"] / 2
+    return top, top + image["sizey"]
+
+def window_rows(figure):
+    # What moving the window needs from a figure dict (JSON-serialisable, so the page can keep it):
+    # the rows each layout image covers, and the rows and text of each label trace by trace index
+    return {
+        "images": [image_rows(image) for image in figure["layout"].get("images", [])],
+        "labels": {str(k): [trace["y"], trace["text"]] for k, trace in enumerate(figure["data"]) if trace.get("mode") == "text"},
+    }
+
+def window_contents(rows, first, last):
+    # For a window showing rows first..last-1 (rows from window_rows): whether each layout image
+    # is shown, and the text of each label trace by trace index
+    shown = [top < last - 0.5 and bottom > first - 0.5 for top, bottom in rows["images"]]
+    labels = {int(k): [text if first <= y < last else "" for y, text in zip(ys, texts)]
+              for k, (ys, texts) in rows["labels"].items()}
+    return shown, labels
+
+def window_figure(figure, first, last, height):
+    # Copy of a figure dict showing rows first..last-1 in a figure `height` pixels tall
+    figure = copy.deepcopy(figure)
+    shown, labels = window_contents(window_rows(figure), first, last)
+    for image, visible in zip(figure["layout"].get("images", []), shown):
+        image["visible"] = visible
+    for k, texts in labels.items():
+        figure["data"][k]["text"] = texts
+    figure["layout"]["yaxis"]["range"] = [last - 0.5, first - 0.5]
+    figure["layout"]["height"] = height
+    return figure
+
+# --- Batch rendering ---
+_flag_cache = None
+
+def _init_worker():
+    # Each worker loads the catalogue and flag pack once, then reuses them for every profile
+    global _flag_cache
+    from flags import FlagCache
+    get_registry()
+    _flag_cache = FlagCache()
+
+def output_name(record, number):
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", str(record.get("id") or "")).strip("._")
+    return name or f"profile-{number}"
+
+def render_profile(job):
+    number, record, out_dir, fmt = job
+    name = output_name(record, number)
+    try:
+        inputs = parse_profile(record)
+        # Output has to stand on its own, so flags are embedded rather than linked,
+        # and a batch job can afford to wait for the ones that have to be downloaded
+        fig, _ = build_figure(inputs, lambda code: _flag_cache.data_uri(code, wait=True))
+        if fmt == "json":
+            data = fig.to_json().encode()
+        else:
+            import plotly.io as pio
+            from chart_export import EXPORT_SCALE, EXPORT_WIDTH
+            data = pio.to_image(fig, format=fmt, width=EXPORT_WIDTH, scale=EXPORT_SCALE, engine="kaleido")
+        path = os.path.join(out_dir, f"{name}.{fmt}")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        return name, f"{type(e).__name__}: {e}"
+    return name, None
+
+def render_batch(path, out_dir, fmt="json", workers=None, chunksize=4):
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = ((number, record, out_dir, fmt) for number, record in enumerate(iter_profiles(path), 1))
+    done = failed = 0
+    started = time.perf_counter()
+    with Pool(workers or os.cpu_count(), initializer=_init_worker) as pool:
+        for name, error in pool.imap_unordered(render_profile, jobs, chunksize):
+            done += 1
+            if error:
+                failed += 1
+                print(f"{name}: {error}", file=sys.stderr)
+            if done % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - started
+                print(f"{done} profiles, {done / elapsed:.1f}/s", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    return done, failed, elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render 'countries visited by age' charts for many profiles.")
+    parser.add_argument("profiles", help="profiles file (.json, .jsonl or .csv)")
+    parser.add_argument("--out", default="charts", help="output directory (default: charts)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="json", help="output format (default: json)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+    done, failed, elapsed = render_batch(args.profiles, args.out, args.format, args.workers)
+    rate = done / elapsed if elapsed else 0.0
+    print(f"Rendered {done - failed} of {done} profiles in {elapsed:.1f}s ({rate:.1f} profiles/s)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# --- Figure cache: built figures keyed by a hash of the normalized chart inputs ---
+# Entries are {"figure": <figure JSON string>, "summary": {...}}. The in-process cache
+# is the default; set COUNTRYGEN_FIGURE_CACHE_DIR to share one directory between workers.
+FIGURE_CACHE_ENTRIES = 256
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+FIGURE_CACHE_DIR_BYTES = 512 * 1024 * 1024
+FIGURE_CACHE_VERSION = 3  # bump when the figure builder's output changes
+
+def figure_cache_key(inputs, variant=None):
+    # variant: how the figure is drawn, when that isn't the same for every process (e.g. "atlas")
+    canonical = json.dumps([FIGURE_CACHE_VERSION, variant, inputs], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def is_cache_key(key):
+    # Keys come back to us in URLs, so check them before they get near a file name
+    return len(key) == 64 and all(ch in "0123456789abcdef" for ch in key)
+
+def entry_size(entry):
+    return len(entry["figure"]) + len(json.dumps(entry["summary"]))
+
+class MemoryFigureCache:
+    """Per-process LRU, bounded by entry count and by total serialized size."""
+
+    def __init__(self, max_entries=FIGURE_CACHE_ENTRIES, max_bytes=FIGURE_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, entry):
+        size = entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (entry, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+class FileFigureCache:
+    """One JSON file per entry in a shared directory; least recently used files are evicted by size."""
+
+    def __init__(self, directory, max_bytes=FIGURE_CACHE_DIR_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            # mtime is the recency used for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            self._count(False)
+            return None
+        self._count(True)
+        return entry
+
+    def set(self, key, entry):
+        path = self._path(key)
+        # Write to a temp file and rename so other workers never read a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._evict()
+
+    def _scan(self):
+        files = []
+        for dir_entry in os.scandir(self.directory):
+            if dir_entry.name.endswith(".json"):
+                try:
+                    st = dir_entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, dir_entry.path))
+        return files
+
+    def _evict(self):
+        files = self._scan()
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        files = self._scan()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "file",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(files),
+                "bytes": sum(size for _, size, _ in files),
+            }
+
+def make_figure_cache():
+    directory = os.environ.get("COUNTRYGEN_FIGURE_CACHE_DIR")
+    if directory:
+        return FileFigureCache(directory)
+    return MemoryFigureCache()
@@ -0,0 +1,436 @@
+import base64
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# --- Flag assets: padded/encoded once, then served from a memory-mapped pack ---
+# Run `python flags.py` to (re)build the pack. If it is missing or stale the app
+# builds it in the background and renders individual flags on demand meanwhile.
+# Flags missing from Flags/ are downloaded in the background; set COUNTRYGEN_FLAGS_OFFLINE=1
+# to never touch the network. Set COUNTRYGEN_FLAG_ATLAS=1 to draw each chunk of chart rows'
+# flags as one composed atlas image instead of one image per flag.
+FLAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Flags")
+FLAG_PACK_PATH = os.path.join(FLAG_DIR, "flags.pack")
+FLAG_PACK_VERSION = 1
+FLAG_BORDER_PX = 2  # transparent border added to top and bottom, in source pixels
+FLAG_RENDER_WIDTH = 160  # source flags are 640px wide; charts show them at ~50px
+FLAG_CACHE_SIZE = 512
+FLAG_CDN_URL = "https://flagcdn.com/w40/{key}.png"
+FLAG_FETCH_WORKERS = 4
+FLAG_FETCH_TIMEOUT = 10
+FLAG_RETRY_AFTER = 3600  # seconds before a failed download is tried again
+FLAG_PLACEHOLDER_SIZE = (160, 107)
+FLAG_ATLAS_SCALE = 2  # atlas pixels per chart pixel, so flags stay sharp on high-DPI screens
+FLAG_ATLAS_CACHE_BYTES = 64 * 1024 * 1024
+FLAG_ATLAS_MAX_SIZE = 4096  # chart pixels, per side
+FLAG_ATLAS_MAX_FLAGS = 256
+_HEADER_LEN = struct.Struct("<Q")
+
+FlagAsset = namedtuple("FlagAsset", ["png", "data_uri", "etag"])
+
+def flag_key(code):
+    return code.lower()
+
+def render_flag(raw):
+    img = Image.open(io.BytesIO(raw)).convert("RGBA")
+    scale = min(1.0, FLAG_RENDER_WIDTH / img.width)
+    if scale < 1.0:
+        img = img.resize((FLAG_RENDER_WIDTH, max(1, round(img.height * scale))), Image.LANCZOS)
+    border_px = max(1, round(FLAG_BORDER_PX * scale))
+    new_img = Image.new("RGBA", (img.width, img.height + 2 * border_px), (255, 255, 255, 0))
+    new_img.paste(img, (0, border_px))
+    buffered = io.BytesIO()
+    new_img.save(buffered, format="PNG", optimize=True)
+    return buffered.getvalue()
+
+def make_asset(png):
+    # The content hash doubles as ETag and as the fingerprint in the flag's URL
+    return FlagAsset(
+        png,
+        f"data:image/png;base64,{base64.b64encode(png).decode()}",
+        hashlib.sha1(png).hexdigest()[:16],
+    )
+
+def render_placeholder():
+    # Light grey card shown while a flag is being downloaded
+    width, height = FLAG_PLACEHOLDER_SIZE
+    img = Image.new("RGBA", (width, height), (226, 226, 226, 255))
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG", optimize=True)
+    return render_flag(buffered.getvalue())
+
+def atlas_enabled():
+    return os.environ.get("COUNTRYGEN_FLAG_ATLAS", "").lower() in ("1", "true", "yes")
+
+def offline():
+    return os.environ.get("COUNTRYGEN_FLAGS_OFFLINE", "").lower() in ("1", "true", "yes")
+
+def fetch_flag(code, flag_dir=FLAG_DIR, session=None):
+    flag_path = os.path.join(flag_dir, f"{flag_key(code)}.png")
+    url = FLAG_CDN_URL.format(key=flag_key(code))
+    try:
+        r = (session or requests).get(url, timeout=FLAG_FETCH_TIMEOUT)
+        r.raise_for_status()
+        # Make sure it really is an image before it lands in the flag directory
+        Image.open(io.BytesIO(r.content)).verify()
+    except Exception:
+        return False
+    tmp_path = f"{flag_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp_path, flag_path)
+    except OSError:
+        # Flag directory missing, read-only or full: count it as a failed download
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+class FlagFetcher:
+    """Downloads missing flags on a small thread pool, remembering failures for a while."""
+
+    def __init__(self, flag_dir=FLAG_DIR, workers=FLAG_FETCH_WORKERS, retry_after=FLAG_RETRY_AFTER):
+        self.flag_dir = flag_dir
+        self.workers = workers
+        self.retry_after = retry_after
+        self.fetched = 0
+        self.failed = 0
+        self._pending = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._session = None
+
+    def _start(self):
+        # Threads and the connection pool are only created once something is actually missing
+        if self._pool is None:
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self._session.mount("https://", adapter)
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="flag-fetch")
+        return self._pool
+
+    def failed_recently(self, key):
+        failed_at = self._failures.get(key)
+        return failed_at is not None and time.monotonic() - failed_at < self.retry_after
+
+    def is_pending(self, key):
+        return key in self._pending
+
+    def request(self, key):
+        # Returns the download's future (shared by everyone asking for the same flag), or None
+        # if the flag can't be downloaded right now: offline, or it failed recently
+        if offline():
+            return None
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None and not self.failed_recently(key):
+                future = self._start().submit(self._fetch, key)
+                self._pending[key] = future
+            return future
+
+    def _fetch(self, key):
+        ok = False
+        try:
+            ok = fetch_flag(key, self.flag_dir, self._session)
+        finally:
+            # Whatever happened, the flag is no longer pending, or nobody would ask for it again
+            with self._lock:
+                if ok:
+                    self.fetched += 1
+                    self._failures.pop(key, None)
+                else:
+                    self.failed += 1
+                    self._failures[key] = time.monotonic()
+                self._pending.pop(key, None)
+        return ok
+
+def source_stamps(flag_dir=FLAG_DIR):
+    stamps = {}
+    for entry in os.scandir(flag_dir):
+        if entry.name.endswith(".png") and entry.is_file():
+            st = entry.stat()
+            stamps[entry.name[:-4]] = [st.st_size, st.st_mtime_ns]
+    return stamps
+
+def build_pack(flag_dir=FLAG_DIR, pack_path=FLAG_PACK_PATH):
+    stamps = source_stamps(flag_dir)
+    index = {}
+    blobs = []
+    offset = 0
+    for key in sorted(stamps):
+        try:
+            with open(os.path.join(flag_dir, f"{key}.png"), "rb") as f:
+                png = render_flag(f.read())
+        except Exception:
+            continue
+        index[key] = [offset, len(png)]
+        blobs.append(png)
+        offset += len(png)
+    header = json.dumps({
+        "version": FLAG_PACK_VERSION,
+        "render_width": FLAG_RENDER_WIDTH,
+        "sources": {key: stamps[key] for key in index},
+        "index": index,
+    }, separators=(",", ":")).encode()
+    tmp_path = f"{pack_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        for png in blobs:
+            f.write(png)
+    os.replace(tmp_path, pack_path)
+    return len(index)
+
+class FlagPack:
+    """Read-only view of a built pack file; entries whose source PNG changed are ignored."""
+
+    def __init__(self, pack_path, flag_dir):
+        with open(pack_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (header_len,) = _HEADER_LEN.unpack_from(self._mm, 0)
+        header = json.loads(self._mm[_HEADER_LEN.size:_HEADER_LEN.size + header_len])
+        if header.get("version") != FLAG_PACK_VERSION or header.get("render_width") != FLAG_RENDER_WIDTH:
+            raise ValueError("flag pack was built by a different version")
+        self._data_start = _HEADER_LEN.size + header_len
+        stamps = source_stamps(flag_dir)
+        self.index = {key: span for key, span in header["index"].items()
+                      if stamps.get(key) == header["sources"].get(key)}
+        self.complete = set(self.index) == set(stamps)
+
+    def get(self, key):
+        span = self.index.get(key)
+        if span is None:
+            return None
+        start = self._data_start + span[0]
+        return self._mm[start:start + span[1]]
+
+class FlagCache:
+    """Bounded LRU of ready-to-use flag assets, filled from the pack (or rendered on a pack miss)."""
+
+    def __init__(self, flag_dir=FLAG_DIR, pack_path=FLAG_PACK_PATH, maxsize=FLAG_CACHE_SIZE, fetcher=None):
+        self.flag_dir = flag_dir
+        self.fetcher = fetcher or FlagFetcher(flag_dir)
+        self.placeholder = make_asset(render_placeholder())
+        self.pack_path = pack_path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pack = None
+        self._building = False
+        os.makedirs(flag_dir, exist_ok=True)
+        self._load_pack()
+
+    def _load_pack(self):
+        try:
+            self._pack = FlagPack(self.pack_path, self.flag_dir)
+        except (OSError, ValueError, struct.error):
+            self._pack = None
+        return self._pack is not None and self._pack.complete
+
+    def warm(self, background=True):
+        # Build the pack if it is missing or stale; the build is what takes seconds, not loading it
+        if self._load_pack() or self._building:
+            return
+        self._building = True
+        def build():
+            try:
+                build_pack(self.flag_dir, self.pack_path)
+                self._load_pack()
+            finally:
+                self._building = False
+        if background:
+            threading.Thread(target=build, name="flag-pack-build", daemon=True).start()
+        else:
+            build()
+
+    def _load(self, key, wait):
+        pack = self._pack
+        png = pack.get(key) if pack is not None else None
+        if png is not None:
+            return png
+        flag_path = os.path.join(self.flag_dir, f"{key}.png")
+        if not os.path.exists(flag_path):
+            # Never download inline: queue it, and only wait for it if the caller asked to
+            future = self.fetcher.request(key)
+            if not (wait and future is not None and future.result()):
+                return None
+        try:
+            with open(flag_path, "rb") as f:
+                return render_flag(f.read())
+        except Exception:
+            return None
+
+    def get(self, code, wait=False):
+        key = flag_key(code)
+        with self._lock:
+            asset = self._entries.get(key)
+            if asset is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return asset
+            self.misses += 1
+        png = self._load(key, wait)
+        if png is None:
+            return None
+        asset = make_asset(png)
+        with self._lock:
+            self._entries[key] = asset
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return asset
+
+    def pending(self, code):
+        # True while the flag is being downloaded, so a placeholder is worth showing
+        return self.fetcher.is_pending(flag_key(code))
+
+    def data_uri(self, code, wait=False):
+        asset = self.get(code, wait)
+        return asset.data_uri if asset else None
+
+    def url_path(self, code):
+        # Fingerprinted path, so the response can be cached forever; prefix it with the app's route
+        asset = self.get(code)
+        return f"/flags/{asset.etag}/{flag_key(code)}.png" if asset else None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "packed": len(self._pack.index) if self._pack is not None else 0,
+                "fetched": self.fetcher.fetched,
+                "fetch_failed": self.fetcher.failed,
+            }
+
+# --- Flag atlas: all flags of a chunk of chart rows composed into one image ---
+# A spec describes the atlas in chart pixels: "<width>x<height>" followed by one
+# "+<key>,<left>,<top>,<width>,<height>,<l|c>" per flag, the box the flag is fitted into
+# (like a layout image with sizing="contain") and whether it is aligned left or centred in it.
+def atlas_spec(size, placements):
+    parts = [f"{size[0]}x{size[1]}"]
+    parts += [f"{flag_key(code)},{left},{top},{width},{height},{anchor}" for code, (left, top, width, height), anchor in placements]
+    return "+".join(parts)
+
+def parse_atlas_spec(spec):
+    # Returns (size, placements), or raises ValueError; specs come from URLs, so sizes are bounded
+    head, *items = spec.split("+")
+    size = tuple(int(v) for v in head.split("x"))
+    if len(size) != 2 or not all(0 < v <= FLAG_ATLAS_MAX_SIZE for v in size) or len(items) > FLAG_ATLAS_MAX_FLAGS:
+        raise ValueError(f"bad atlas spec {spec!r}")
+    placements = []
+    for item in items:
+        key, *box, anchor = item.split(",")
+        box = tuple(int(v) for v in box)
+        # Boxes lie inside the atlas
+        if (len(box) != 4 or anchor not in ("l", "c") or min(box) < 0
+                or box[0] + box[2] > size[0] or box[1] + box[3] > size[1]):
+            raise ValueError(f"bad atlas spec {spec!r}")
+        placements.append((key, box, anchor))
+    return size, placements
+
+def compose_atlas(size, flags, scale=FLAG_ATLAS_SCALE):
+    # flags: (png, box, anchor) as in a spec
+    atlas = Image.new("RGBA", (size[0] * scale, size[1] * scale), (255, 255, 255, 0))
+    for png, (left, top, width, height), anchor in flags:
+        img = Image.open(io.BytesIO(png)).convert("RGBA")
+        fit = min(width * scale / img.width, height * scale / img.height)
+        w, h = max(1, round(img.width * fit)), max(1, round(img.height * fit))
+        x = left * scale + ((width * scale - w) // 2 if anchor == "c" else 0)
+        y = top * scale + (height * scale - h) // 2
+        img = img.resize((w, h), Image.LANCZOS)
+        atlas.paste(img, (x, y), img)
+    buffered = io.BytesIO()
+    atlas.save(buffered, format="PNG", optimize=True)
+    return buffered.getvalue()
+
+class FlagAtlasCache:
+    """Composed atlases, keyed by spec and the flags that went into them, in an LRU bounded by size."""
+
+    def __init__(self, flags, max_bytes=FLAG_ATLAS_CACHE_BYTES):
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _sources(self, placements):
+        # The flag asset for every placement: the placeholder while it is downloading, left out if unavailable
+        sources = []
+        for key, box, anchor in placements:
+            asset = self.flags.get(key)
+            if asset is None and self.flags.pending(key):
+                asset = self.flags.placeholder
+            if asset is not None:
+                sources.append((asset, box, anchor))
+        return sources
+
+    def fingerprint(self, spec):
+        # Changes whenever a flag in the atlas does (arrives, or is re-rendered), so URLs can be cached forever
+        _, placements = parse_atlas_spec(spec)
+        etags = ",".join(asset.etag for asset, _, _ in self._sources(placements))
+        return hashlib.sha1(f"{FLAG_ATLAS_SCALE}/{spec}/{etags}".encode()).hexdigest()[:16]
+
+    def get(self, spec):
+        fingerprint = self.fingerprint(spec)
+        with self._lock:
+            asset = self._entries.get(fingerprint)
+            if asset is not None:
+                self._entries.move_to_end(fingerprint)
+                self.hits += 1
+                return asset
+            self.misses += 1
+        size, placements = parse_atlas_spec(spec)
+        png = compose_atlas(size, [(asset.png, box, anchor) for asset, box, anchor in self._sources(placements)])
+        asset = FlagAsset(png, f"data:image/png;base64,{base64.b64encode(png).decode()}", fingerprint)
+        with self._lock:
+            if fingerprint not in self._entries:
+                self._entries[fingerprint] = asset
+                self._bytes += len(png)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.png)
+        return asset
+
+    def pending(self, spec):
+        # Keys of the flags drawn as placeholders in this atlas
+        _, placements = parse_atlas_spec(spec)
+        return [key for key, _, _ in placements if self.flags.pending(key)]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+if __name__ == "__main__":
+    n = build_pack()
+    print(f"Packed {n} flags into {FLAG_PACK_PATH}")
@@ -0,0 +1,59 @@
+import bisect
+
+# --- Residence periods as half-open month-index intervals [from, until) ---
+# A date is one integer (year * 12 + month - 1), so ordering and overlap checks are plain
+# integer comparisons and the free range around a date is found by bisection.
+
+def month_index(year, month):
+    return year * 12 + month - 1
+
+class PeriodIndex:
+    """The other residence periods, sorted by start and by end with running bounds."""
+
+    def __init__(self, periods):
+        by_start = sorted(periods)
+        self._starts = [start for start, _ in by_start]
+        # _max_end[i]: latest end among the i + 1 earliest-starting periods
+        self._max_end = []
+        for _, end in by_start:
+            self._max_end.append(max(end, self._max_end[-1]) if self._max_end else end)
+        by_end = sorted(periods, key=lambda p: p[1])
+        self._ends = [end for _, end in by_end]
+        # _min_start[i]: earliest start among the periods ending at or after the i-th end
+        self._min_start = [start for start, _ in by_end]
+        for i in range(len(self._min_start) - 2, -1, -1):
+            self._min_start[i] = min(self._min_start[i], self._min_start[i + 1])
+
+    def latest_until(self, start):
+        # Latest 'until' a period starting at `start` can have without overlapping; None if unbounded
+        i = bisect.bisect_right(self._ends, start)
+        return self._min_start[i] if i < len(self._min_start) else None
+
+    def earliest_from(self, until):
+        # Earliest 'from' a period ending at `until` can have without overlapping; None if unbounded
+        i = bisect.bisect_left(self._starts, until)
+        return self._max_end[i - 1] if i else None
+
+def free_months(year, first, last, low=None, high=None, keep=None):
+    # Months first..last of `year` whose index lies in [low, high]; `keep` (year, month) is always
+    # allowed, so the value already selected never disappears from its own dropdown
+    base = month_index(year, 1)
+    lo = first if low is None else max(first, low - base + 1)
+    hi = last if high is None else min(last, high - base + 1)
+    months = list(range(lo, hi + 1))
+    if keep is not None and keep[0] == year and first <= keep[1] <= last and not lo <= keep[1] <= hi:
+        bisect.insort(months, keep[1])
+    return months
+
+def free_options(years, month_range, low=None, high=None, keep=None, detail_years=()):
+    # Year options that still have a free month, and the free months of the years in detail_years.
+    # month_range(year) gives the (first, last) months offered for that year.
+    year_options = []
+    month_options = []
+    for year in years:
+        months = free_months(year, *month_range(year), low=low, high=high, keep=keep)
+        if months:
+            year_options.append(year)
+            if year in detail_years:
+                month_options.extend(months)
+    return year_options, month_options
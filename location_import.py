@@ -0,0 +1,558 @@
+import bisect
+import csv
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from country_catalogue import UN_MEMBER_ALPHA2
+from intervals import month_index
+
+# --- Location history import: the first month spent in each country, from a GPS export ---
+# Uploads (Google location history JSON, GPX or CSV, any size) are spooled to disk and read
+# as a stream, so memory doesn't grow with the file. Points are geocoded in a process pool
+# against country boundaries from a GeoJSON file (e.g. Natural Earth admin 0 countries);
+# none are bundled, so set COUNTRYGEN_BOUNDARIES to its path (default: boundaries.geojson
+# next to the app). Without it the import isn't offered.
+IMPORT_FORMATS = ("json", "gpx", "csv")
+IMPORT_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+IMPORT_JOBS = 2  # imports read at the same time; more are refused
+IMPORT_BATCH = 50000  # points sent to a worker at a time
+IMPORT_MAX_BYTES = 16 * 1024 ** 3
+IMPORT_JOB_TTL = 3600  # seconds a finished job's result is kept for the page to collect
+GRID_DEGREES = 0.5
+READ_CHUNK = 1024 * 1024
+JSON_TAIL = 64 * 1024  # no string in a location history JSON is longer than this
+EARLIEST_YEAR = 1900
+DEFAULT_BOUNDARIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "boundaries.geojson")
+# Properties that hold a feature's ISO 3166 alpha-2 code, in the order they are tried
+# (Natural Earth's ISO_A2 is "-99" for a few countries; ISO_A2_EH has them)
+CODE_PROPERTIES = ("ISO_A2_EH", "ISO_A2", "iso_a2", "ISO3166-1-Alpha-2", "alpha_2", "code")
+
+class ImportBusy(Exception):
+    pass
+
+class UploadTooLarge(Exception):
+    pass
+
+def boundaries_path():
+    return os.environ.get("COUNTRYGEN_BOUNDARIES", DEFAULT_BOUNDARIES)
+
+# --- Reading points: (lat, lon, month index) from each format ---
+def point_month(value):
+    # Month index of a timestamp: ISO 8601 text or seconds/milliseconds since the epoch
+    if value is None:
+        return None
+    text = str(value).strip().strip('"')
+    if len(text) >= 7 and text[4] == "-" and text[:4].isdigit() and text[5:7].isdigit():
+        year, month = int(text[:4]), int(text[5:7])
+    else:
+        try:
+            seconds = float(text)
+        except ValueError:
+            return None
+        # Values this large are milliseconds
+        if seconds > 1e11:
+            seconds /= 1000
+        try:
+            moment = time.gmtime(seconds)
+        except (OverflowError, OSError, ValueError):
+            return None
+        year, month = moment.tm_year, moment.tm_mon
+    if year < EARLIEST_YEAR or not 1 <= month <= 12:
+        return None
+    return month_index(year, month)
+
+def valid_point(lat, lon):
+    return -90 <= lat <= 90 and -180 <= lon <= 180
+
+class CountingReader(io.RawIOBase):
+    """A binary file that counts the bytes read from it, for progress."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.raw.readinto(buffer)
+        self.bytes_read += n or 0
+        return n
+
+JSON_KEYS = (rb"latitudeE7|longitudeE7|latE7|lngE7|latitude|longitude|lat|lng|lon|point|latLng|placeLocation"
+             rb"|timestampMs|timestamp|time|startTime|startTimestampMs|startTimestamp")
+JSON_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+# Group 1 and 2: one of the keys and its value; group 3: a brace
+JSON_TERMINAL = rb'"(' + JSON_KEYS + rb')"\s*:\s*(' + JSON_STRING + rb'|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|([{}])'
+try:
+    # Other strings and text are skipped by the regex itself, a token per key or brace; a key
+    # holding an object ("point": {...}) is skipped too, its object counts
+    # (possessive quantifiers need Python 3.11)
+    JSON_SKIP = re.compile(rb'(?:"(?!(?:' + JSON_KEYS + rb')"\s*:\s*(?:[-"\d]|\Z))[^"\\]*(?:\\.[^"\\]*)*"|[^"{}]+)*+')
+    JSON_TOKEN = re.compile(JSON_SKIP.pattern + rb'(?:' + JSON_TERMINAL + rb')')
+except re.error:
+    # Other strings are tokens of their own, so braces in them are never taken for objects
+    JSON_SKIP = None
+    JSON_TOKEN = re.compile(JSON_TERMINAL + rb'|' + JSON_STRING)
+JSON_MAX_BUFFER = 4 * READ_CHUNK
+JSON_LATLNG = re.compile(r"(-?\d+(?:\.\d+)?)\D+?(-?\d+(?:\.\d+)?)")
+LAT_KEYS = {b"latitudeE7": 1e-7, b"latE7": 1e-7, b"latitude": 1, b"lat": 1}
+LON_KEYS = {b"longitudeE7": 1e-7, b"lngE7": 1e-7, b"longitude": 1, b"lng": 1, b"lon": 1}
+TIME_KEYS = {b"timestampMs", b"timestamp", b"time", b"startTime", b"startTimestampMs", b"startTimestamp"}
+
+def read_json_points(stream):
+    # Google location history in any of its layouts (Records.json, Timeline.json, semantic
+    # history, on-device exports) or any JSON of objects with coordinates and a time. The
+    # text is scanned for the keys that matter, keeping track of the objects they are in: a
+    # point takes its object's time or, failing that, the time of an enclosing object (a
+    # visit's "startTime"). An object with a time but no point of its own (semantic history's
+    # "duration") gives its time to the object it is in, so a placeVisit's or activitySegment's
+    # locations get it.
+    frames = []  # per open object: [lat, lon, month, points waiting for a month, month is its own]
+    find = JSON_TOKEN.match if JSON_SKIP else JSON_TOKEN.search
+    buffer = b""
+    at_end = False
+    while not at_end:
+        chunk = stream.read(READ_CHUNK)
+        at_end = not chunk
+        buffer += chunk
+        limit = len(buffer) if at_end else len(buffer) - JSON_TAIL
+        consumed = 0
+        while True:
+            match = find(buffer, consumed)
+            if match is None or match.end() > limit:
+                break
+            consumed = match.end()
+            key = match.group(1)
+            if key is None:
+                token = match.group(3)
+                if token == b"{":
+                    frames.append([None, None, None, [], False])
+                elif token == b"}" and frames:
+                    lat, lon, month, waiting, own = frames.pop()
+                    if lat is not None and lon is not None:
+                        waiting.append((lat, lon))
+                    if month is not None:
+                        for point in waiting:
+                            yield point[0], point[1], month
+                        if own and not waiting and frames and frames[-1][2] is None:
+                            frames[-1][2] = month
+                    elif waiting and frames:
+                        frames[-1][3].extend(waiting)
+                continue
+            if not frames:
+                continue
+            frame = frames[-1]
+            value = match.group(2)
+            try:
+                if key in LAT_KEYS:
+                    frame[0] = float(value.strip(b'"')) * LAT_KEYS[key]
+                elif key in LON_KEYS:
+                    frame[1] = float(value.strip(b'"')) * LON_KEYS[key]
+                elif key in TIME_KEYS:
+                    frame[2] = point_month(value.decode("ascii", "replace"))
+                    frame[4] = True
+                else:
+                    # "48.1234°, 11.5678°" or "geo:48.1234,11.5678"
+                    found = JSON_LATLNG.search(str(json.loads(value)))
+                    if found:
+                        frame[3].append((float(found.group(1)), float(found.group(2))))
+            except ValueError:
+                continue
+        if match is None and JSON_SKIP:
+            # Nothing left but text to skip, or a token cut off by the end of the chunk
+            consumed = JSON_SKIP.match(buffer, consumed).end()
+        buffer = buffer[consumed:]
+        if len(buffer) > JSON_MAX_BUFFER:
+            raise ValueError("this doesn't look like a location history")
+
+GPX_POINTS = ("trkpt", "rtept", "wpt")
+
+def read_gpx_points(stream):
+    # Track, route and way points that have a time
+    open_elements = []
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            open_elements.append(element)
+            continue
+        open_elements.pop()
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag in GPX_POINTS:
+            when = next((child.text for child in element if child.tag.rsplit("}", 1)[-1] == "time"), None)
+            month = point_month(when)
+            try:
+                lat, lon = float(element.get("lat")), float(element.get("lon"))
+            except (TypeError, ValueError):
+                month = None
+            if month is not None:
+                yield lat, lon, month
+        # Drop everything read so far: the parser keeps the open elements (<trkseg>, <rte>, ...)
+        # and whatever they hold. A point's children are needed until the point ends.
+        if open_elements and open_elements[-1].tag.rsplit("}", 1)[-1] not in GPX_POINTS:
+            element.clear()
+            open_elements[-1].remove(element)
+
+CSV_LAT = ("lat", "latitude")
+CSV_LON = ("lon", "lng", "long", "longitude")
+CSV_TIME = ("time", "timestamp", "date", "datetime", "date_time", "utc", "recorded_at")
+
+def read_csv_points(stream):
+    # A header row names the columns; latitude, longitude and time are found by name
+    text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+    rows = csv.reader(text)
+    header = [name.strip().lower() for name in next(rows, [])]
+    def column(names):
+        return next((header.index(name) for name in names if name in header), None)
+    lat_col, lon_col, time_col = column(CSV_LAT), column(CSV_LON), column(CSV_TIME)
+    if None in (lat_col, lon_col, time_col):
+        raise ValueError("the CSV header needs latitude, longitude and time columns")
+    last = max(lat_col, lon_col, time_col)
+    for row in rows:
+        if len(row) <= last:
+            continue
+        month = point_month(row[time_col])
+        try:
+            lat, lon = float(row[lat_col]), float(row[lon_col])
+        except ValueError:
+            continue
+        if month is not None:
+            yield lat, lon, month
+
+READERS = {"json": read_json_points, "gpx": read_gpx_points, "csv": read_csv_points}
+
+def detect_format(name, head):
+    # From the file name, or else from its first bytes
+    extension = os.path.splitext(name or "")[1].lstrip(".").lower()
+    if extension in IMPORT_FORMATS:
+        return extension
+    start = head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1]
+    if start == b"<":
+        return "gpx"
+    if start in (b"{", b"["):
+        return "json"
+    return "csv"
+
+def spool_upload(stream, max_bytes=IMPORT_MAX_BYTES):
+    # Copies a request body to a temporary file in chunks; returns its path and first bytes
+    fd, path = tempfile.mkstemp(prefix="countrygen-import-")
+    head = b""
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(READ_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"uploads are limited to {max_bytes // 1024 ** 3} GB")
+                if len(head) < 512:
+                    head += chunk[:512 - len(head)]
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, head
+
+# --- Reverse geocoding: a grid over the boundary polygons ---
+def feature_code(properties, allowed):
+    for name in CODE_PROPERTIES:
+        code = str((properties or {}).get(name) or "").upper()
+        if code in allowed:
+            return code
+    return None
+
+def feature_rings(geometry):
+    # Every ring (outer and holes) of a Polygon or MultiPolygon; parity takes care of holes
+    if not geometry:
+        return []
+    if geometry.get("type") == "Polygon":
+        return geometry["coordinates"]
+    if geometry.get("type") == "MultiPolygon":
+        return [ring for polygon in geometry["coordinates"] for ring in polygon]
+    return []
+
+def crossings(px, py, rx, ry, edges):
+    # Edges crossed by the segment from (px, py) to (rx, ry)
+    n = 0
+    dx, dy = rx - px, ry - py
+    for x1, y1, x2, y2 in edges:
+        d1 = dx * (y1 - py) - dy * (x1 - px)
+        d2 = dx * (y2 - py) - dy * (x2 - px)
+        if (d1 > 0) == (d2 > 0):
+            continue
+        ex, ey = x2 - x1, y2 - y1
+        if (ex * (py - y1) - ey * (px - x1) > 0) != (ex * (ry - y1) - ey * (rx - x1) > 0):
+            n += 1
+    return n
+
+class BoundaryIndex:
+    """Country polygons on a grid: a point is one dict lookup, plus a few edge tests near borders.
+
+    A cell that no border crosses belongs entirely to one country (or none). For a cell that
+    borders cross, each country touching it keeps the edges inside the cell and whether the
+    cell's centre is in the country; a point is in the country if the segment from it to the
+    centre crosses an even number of those edges (odd if the centre is outside).
+    """
+
+    def __init__(self, features, allowed=UN_MEMBER_ALPHA2, cell=GRID_DEGREES):
+        self.cell = cell
+        self.columns = int(math.ceil(360 / cell))
+        self.codes = set()
+        self._uniform = {}
+        self._mixed = {}
+        for feature in features:
+            code = feature_code(feature.get("properties"), allowed)
+            rings = feature_rings(feature.get("geometry"))
+            if code and rings:
+                self._add_shape(code, rings)
+                self.codes.add(code)
+
+    @classmethod
+    def load(cls, path, allowed=UN_MEMBER_ALPHA2, cell=GRID_DEGREES):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        features = data.get("features", []) if data.get("type") == "FeatureCollection" else [data]
+        return cls(features, allowed, cell)
+
+    def _cell_key(self, ix, iy):
+        return iy * self.columns + ix
+
+    def _add_shape(self, code, rings):
+        cell = self.cell
+        edges = []
+        for ring in rings:
+            points = [(float(p[0]), float(p[1])) for p in ring]
+            edges.extend((x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]) if (x1, y1) != (x2, y2))
+        if not edges:
+            return
+        # Edges by the cells their bounding box covers
+        cell_edges = {}
+        for edge in edges:
+            x1, y1, x2, y2 = edge
+            for iy in range(self._row(min(y1, y2)), self._row(max(y1, y2)) + 1):
+                for ix in range(self._column(min(x1, x2)), self._column(max(x1, x2)) + 1):
+                    cell_edges.setdefault((ix, iy), []).append(edge)
+        xs = [x for edge in edges for x in (edge[0], edge[2])]
+        ys = [y for edge in edges for y in (edge[1], edge[3])]
+        first_column, last_column = self._column(min(xs)), self._column(max(xs))
+        for iy in range(self._row(min(ys)), self._row(max(ys)) + 1):
+            # Scanline through the cell centres (nudged off round coordinates): the x of
+            # every edge crossing it, so a centre is inside if an odd number lie to its left
+            cy = (iy + 0.5) * cell - 90 + 1e-7
+            hits = sorted(x1 + (cy - y1) * (x2 - x1) / (y2 - y1) for x1, y1, x2, y2 in edges if (y1 > cy) != (y2 > cy))
+            if not hits:
+                continue
+            for ix in range(first_column, last_column + 1):
+                cx = (ix + 0.5) * cell - 180 + 1e-7
+                inside = bisect.bisect_left(hits, cx) % 2 == 1
+                key = self._cell_key(ix, iy)
+                crossing = cell_edges.get((ix, iy))
+                if crossing:
+                    self._mixed.setdefault(key, []).append((code, inside, cx, cy, tuple(crossing)))
+                elif inside:
+                    self._uniform[key] = code
+
+    def _column(self, lon):
+        return min(int((lon + 180) / self.cell), self.columns - 1)
+
+    def _row(self, lat):
+        return min(int((lat + 90) / self.cell), int(180 / self.cell) - 1)
+
+    def locate(self, lat, lon):
+        # alpha_2 of the country the point is in, or None (sea, or a country not indexed)
+        key = self._cell_key(self._column(lon), self._row(lat))
+        code = self._uniform.get(key)
+        if code is not None:
+            return code
+        for code, centre_inside, cx, cy, edges in self._mixed.get(key, ()):
+            if centre_inside != (crossings(lon, lat, cx, cy, edges) % 2 == 1):
+                return code
+        return None
+
+# Each pool worker loads the boundaries once
+_worker_index = None
+_worker_index_path = None
+
+def worker_index(path):
+    global _worker_index, _worker_index_path
+    if _worker_index is None or _worker_index_path != path:
+        _worker_index = BoundaryIndex.load(path)
+        _worker_index_path = path
+    return _worker_index
+
+def locate_batch(path, lats, lons, months):
+    # Runs in a pool worker: {alpha_2: earliest month index} for a batch of points
+    index = worker_index(path)
+    earliest = {}
+    # Points come in bursts at one place: the last answer is checked first
+    last_cell = last_code = None
+    for lat, lon, month in zip(lats, lons, months):
+        cell = index._cell_key(index._column(lon), index._row(lat))
+        if cell == last_cell and last_code is not None:
+            code = last_code
+        else:
+            code = index._uniform.get(cell)
+            last_cell, last_code = cell, code
+            if code is None:
+                code = index.locate(lat, lon)
+        if code is not None and month < earliest.get(code, month + 1):
+            earliest[code] = month
+    return earliest
+
+# --- Import jobs: read, geocode in the pool, report progress ---
+class ImportJob:
+    __slots__ = ("id", "state", "size", "bytes_read", "points", "earliest", "error", "started", "finished")
+
+    def __init__(self, size):
+        self.id = secrets.token_hex(16)
+        self.state = "queued"
+        self.size = size
+        self.bytes_read = 0
+        self.points = 0
+        self.earliest = {}
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+
+    def status(self):
+        return {
+            "state": self.state,
+            "progress": min(1.0, self.bytes_read / self.size) if self.size else 1.0,
+            "points": self.points,
+            # Earliest [year, month] in each country
+            "countries": {code: [month // 12, month % 12 + 1] for code, month in sorted(self.earliest.items())},
+            "error": self.error,
+        }
+
+class LocationImporter:
+    """Runs imports in threads, geocoding their points in a bounded process pool."""
+
+    def __init__(self, path=None, workers=IMPORT_WORKERS, jobs=IMPORT_JOBS, batch=IMPORT_BATCH):
+        self.path = path or boundaries_path()
+        self.workers = workers
+        self.batch = batch
+        self.imported = 0
+        self.failed = 0
+        self.rejected = 0
+        self.points = 0
+        self._slots = threading.BoundedSemaphore(jobs)
+        self._jobs = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        return os.path.isfile(self.path)
+
+    def _executor(self):
+        # Started on first use so importing the app never starts import workers; spawned, since a
+        # fork of the threaded server could copy a lock another thread holds
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def reserve(self):
+        # Takes a job slot before the upload is spooled, so uploads can't fill the disk while
+        # imports are busy; start() (when its job ends) or release() gives it back
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise ImportBusy("too many imports running")
+
+    def release(self):
+        self._slots.release()
+
+    def start(self, upload_path, fmt):
+        # Imports the spooled upload (deleted when done) in the background, in a slot taken
+        # with reserve(); returns the job
+        job = ImportJob(os.path.getsize(upload_path))
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        threading.Thread(target=self._run, args=(job, upload_path, fmt), daemon=True).start()
+        return job
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and now - job.finished > IMPORT_JOB_TTL]:
+            del self._jobs[job_id]
+
+    def _run(self, job, upload_path, fmt):
+        job.state = "running"
+        try:
+            with open(upload_path, "rb", buffering=0) as raw:
+                counting = CountingReader(raw)
+                stream = io.BufferedReader(counting, READ_CHUNK)
+                self._geocode(job, READERS[fmt](stream), counting)
+            job.bytes_read = job.size
+            job.state = "done"
+            self.imported += 1
+        except Exception as exc:
+            job.state = "error"
+            job.error = str(exc) or type(exc).__name__
+            self.failed += 1
+        finally:
+            job.finished = time.monotonic()
+            self._slots.release()
+            try:
+                os.remove(upload_path)
+            except OSError:
+                pass
+
+    def _geocode(self, job, points, counting):
+        # Batches go to the pool as they fill up; a few are in flight at a time, so reading
+        # the file and geocoding overlap without the queue growing
+        pool = self._executor()
+        in_flight = deque()
+        def collect(future):
+            for code, month in future.result().items():
+                if month < job.earliest.get(code, month + 1):
+                    job.earliest[code] = month
+        lats, lons, months = array("d"), array("d"), array("l")
+        for lat, lon, month in points:
+            if not valid_point(lat, lon):
+                continue
+            lats.append(lat)
+            lons.append(lon)
+            months.append(month)
+            if len(months) >= self.batch:
+                in_flight.append(pool.submit(locate_batch, self.path, lats, lons, months))
+                job.points += len(months)
+                self.points += len(months)
+                job.bytes_read = counting.bytes_read
+                lats, lons, months = array("d"), array("d"), array("l")
+                while len(in_flight) > 2 * self.workers:
+                    collect(in_flight.popleft())
+        if months:
+            in_flight.append(pool.submit(locate_batch, self.path, lats, lons, months))
+            job.points += len(months)
+            self.points += len(months)
+        while in_flight:
+            collect(in_flight.popleft())
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.state in ("queued", "running"))
+            return {
+                "imported": self.imported,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "running": running,
+                "points": self.points,
+            }
@@ -0,0 +1,198 @@
+import bisect
+import cProfile
+import os
+import threading
+import time
+from itertools import count
+
+from flask import Response, g, request
+
+# --- Callback metrics: latency, payload sizes and pattern-matched items per Dash callback ---
+# Opt-in: set COUNTRYGEN_METRICS=1 and the app measures every call to Dash's update endpoint
+# (so every server callback) and serves the numbers as Prometheus text on /metrics. When it
+# is off nothing is installed and callbacks run exactly as before. Set
+# COUNTRYGEN_METRICS_PROFILE_DIR as well to profile one call in METRICS_PROFILE_EVERY and keep
+# the profile (a .prof file for pstats/snakeviz) of those slower than METRICS_SLOW_SECONDS.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PROFILE_EVERY = 20
+METRICS_SLOW_SECONDS = 0.5
+METRICS_PROFILE_KEEP = 100  # newest profiles kept in the directory
+
+def enabled():
+    return os.environ.get("COUNTRYGEN_METRICS", "").lower() in ("1", "true", "yes")
+
+def pattern_items(deps):
+    # (ALL items, MATCH items) among a callback's inputs or state: ALL comes as a list of
+    # {id, property, value}, MATCH as a single one with a dict id
+    all_items = match_items = 0
+    for dep in deps or []:
+        if isinstance(dep, list):
+            all_items += len(dep)
+        elif isinstance(dep, dict) and isinstance(dep.get("id"), dict):
+            match_items += 1
+    return all_items, match_items
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class CallbackStats:
+    """Counters and a latency histogram for one callback."""
+
+    __slots__ = ("calls", "buckets", "seconds", "request_bytes", "response_bytes", "all_items", "match_items")
+
+    def __init__(self, n_buckets):
+        self.calls = {"ok": 0, "prevented": 0, "error": 0}
+        self.buckets = [0] * (n_buckets + 1)  # the last one is +Inf
+        self.seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.all_items = 0
+        self.match_items = 0
+
+class CallbackMetrics:
+    """Per-callback stats for this process, written out in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, status, request_bytes, response_bytes, all_items, match_items):
+        with self._lock:
+            stats = self._callbacks.get(name)
+            if stats is None:
+                stats = self._callbacks[name] = CallbackStats(len(self.buckets))
+            stats.calls[status] += 1
+            stats.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+            stats.seconds += seconds
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            stats.all_items += all_items
+            stats.match_items += match_items
+
+    def render(self, gauges=None):
+        # gauges: {name: stats dict} of caches etc.; their numeric values are written as gauges
+        lines = [
+            "# HELP countrygen_callback_calls_total Callback calls, by outcome.",
+            "# TYPE countrygen_callback_calls_total counter",
+        ]
+        with self._lock:
+            callbacks = sorted(self._callbacks.items())
+            for name, stats in callbacks:
+                for status, n in stats.calls.items():
+                    lines.append(f'countrygen_callback_calls_total{{callback="{escape_label(name)}",status="{status}"}} {n}')
+            lines += [
+                "# HELP countrygen_callback_seconds Callback latency, request in to response out.",
+                "# TYPE countrygen_callback_seconds histogram",
+            ]
+            for name, stats in callbacks:
+                label = f'callback="{escape_label(name)}"'
+                cumulative = 0
+                for bound, n in zip(self.buckets + ("+Inf",), stats.buckets):
+                    cumulative += n
+                    lines.append(f'countrygen_callback_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"countrygen_callback_seconds_sum{{{label}}} {stats.seconds}")
+                lines.append(f"countrygen_callback_seconds_count{{{label}}} {cumulative}")
+            for metric, attr, help_text in (
+                ("countrygen_callback_request_bytes_total", "request_bytes", "Bytes received by the callback."),
+                ("countrygen_callback_response_bytes_total", "response_bytes", "Bytes sent back by the callback."),
+                ("countrygen_callback_all_items_total", "all_items", "Pattern-matched ALL items received."),
+                ("countrygen_callback_match_items_total", "match_items", "Pattern-matched MATCH items received."),
+            ):
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                for name, stats in callbacks:
+                    lines.append(f'{metric}{{callback="{escape_label(name)}"}} {getattr(stats, attr)}')
+        for prefix, stats in sorted((gauges or {}).items()):
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric = f"countrygen_{prefix}_{key}"
+                    lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+class SlowCallProfiler:
+    """Profiles one call in `every` and keeps the profiles of the slow ones."""
+
+    def __init__(self, directory, every=METRICS_PROFILE_EVERY, slow_seconds=METRICS_SLOW_SECONDS, keep=METRICS_PROFILE_KEEP):
+        self.directory = directory
+        self.every = every
+        self.slow_seconds = slow_seconds
+        self.keep = keep
+        self.saved = 0
+        self._calls = count()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        # A profiler for this call, or None if it isn't sampled
+        if next(self._calls) % self.every:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this thread
+            return None
+        return profiler
+
+    def finish(self, profiler, name, seconds):
+        profiler.disable()
+        if seconds < self.slow_seconds:
+            return
+        safe_name = "".join(ch if ch.isalnum() or ch in "._-" else "_" for ch in name)[:80]
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.saved}-{int(seconds * 1000)}ms-{safe_name}.prof")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, path)
+        self.saved += 1
+        self._prune()
+
+    def _prune(self):
+        profiles = sorted((entry.stat().st_mtime_ns, entry.path) for entry in os.scandir(self.directory) if entry.name.endswith(".prof"))
+        for _, path in profiles[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def install(app, gauges=None, profile_dir=None):
+    # Measures app's callbacks and adds /metrics; gauges() returns {name: stats dict} to include
+    metrics = CallbackMetrics()
+    profiler = SlowCallProfiler(profile_dir) if profile_dir else None
+    server = app.server
+
+    def callback_name(output):
+        spec = app.callback_map.get(output, {})
+        return getattr(spec.get("callback"), "__name__", output)
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path.endswith("/_dash-update-component") and request.method == "POST":
+            g.callback_profiler = profiler.start() if profiler else None
+            g.callback_started = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        started = g.pop("callback_started", None)
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        body = request.get_json(silent=True) or {}
+        name = callback_name(body.get("output", "?"))
+        call_profiler = g.pop("callback_profiler", None)
+        if call_profiler is not None:
+            profiler.finish(call_profiler, name, seconds)
+        all_inputs, match_inputs = pattern_items(body.get("inputs"))
+        all_state, match_state = pattern_items(body.get("state"))
+        status = "ok" if response.status_code == 200 else "prevented" if response.status_code == 204 else "error"
+        response_bytes = response.calculate_content_length() or 0
+        metrics.observe(name, seconds, status, request.content_length or 0, response_bytes,
+                        all_inputs + all_state, match_inputs + match_state)
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        stats = dict(gauges()) if gauges else {}
+        if profiler:
+            stats["profiler"] = {"saved": profiler.saved}
+        return Response(metrics.render(stats), mimetype="text/plain; version=0.0.4")
+
+    return metrics
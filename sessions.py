@@ -0,0 +1,201 @@
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # fcntl isn't available on Windows; there the file store only locks within a process
+    fcntl = None
+
+# --- Sessions: the form state of each open page, kept on the server ---
+# The page holds a session key; callbacks that change a row of the visit or residence table
+# record it here, so other callbacks read the tables from the session instead of having
+# every row uploaded with each request. The in-process store is the default; set
+# COUNTRYGEN_SESSION_DIR to keep sessions in a directory shared between workers.
+# Sessions are created with the page; one that has gone (expired, evicted, or kept by another
+# worker) isn't recreated by an edit, since an empty one would reset the page's tables.
+#
+# A session is {"selected": [alpha_2 in selection order], "visits": {alpha_2: [year, month]},
+# "residences": {row index as a string, in table order: [country label, from year, from month,
+# until year, until month]}, "edits": {row: edits recorded}, "version": total edits recorded}.
+# Which rows the tables show is the page's business: it sends their ids when a table changes,
+# since a response that never arrived would leave the session ahead of it.
+#
+# The page numbers the edits of each row (see stampEdit in assets/clientside.js) and keeps their
+# total; Generate! sends it, with a digest of the page's selection and residence rows, so a chart
+# isn't built before the last edit has been recorded.
+SESSION_ENTRIES = 10000
+SESSION_TTL = 24 * 3600  # seconds a session is kept after its last change
+
+def new_session_key():
+    return secrets.token_hex(16)
+
+def is_session_key(key):
+    # Keys come from the page, so check them before they get near a file name
+    return isinstance(key, str) and len(key) == 32 and all(ch in "0123456789abcdef" for ch in key)
+
+class SessionExpired(Exception):
+    pass
+
+def empty_session():
+    return {"selected": [], "visits": {}, "residences": {}, "edits": {}, "version": 0}
+
+def record_edit(session, row, count):
+    # Counts the row's edits up to the page's number `count` for it. Edits can arrive out of
+    # order, and Dash may send only the last of several quick ones, which covers the others.
+    edits = session.setdefault("edits", {})
+    recorded = edits.get(row, 0)
+    if count > recorded:
+        edits[row] = count
+        session["version"] = session.get("version", 0) + count - recorded
+
+def page_digest(labels, residence_indexes):
+    # 32-bit FNV-1a over the code points of the selected labels and the residence row ids;
+    # pageDigest in assets/clientside.js computes the same in the browser
+    text = "\n".join(labels) + "\n" + ",".join(str(index) for index in residence_indexes)
+    digest = 0x811c9dc5
+    for ch in text:
+        digest = ((digest ^ ord(ch)) * 0x01000193) & 0xffffffff
+    return digest
+
+class MemorySessionStore:
+    """Per-process LRU of sessions, dropped after SESSION_TTL without changes."""
+
+    def __init__(self, max_entries=SESSION_ENTRIES, ttl=SESSION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        item = self._entries.get(key)
+        if item is None or time.monotonic() - item[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[0]
+
+    def get(self, key):
+        # A copy of the session, or None if there is none (new, expired or evicted)
+        if not is_session_key(key):
+            return None
+        with self._lock:
+            session = self._get(key)
+            return json.loads(json.dumps(session)) if session is not None else None
+
+    def create(self, key):
+        if not is_session_key(key):
+            raise ValueError("bad session key")
+        with self._lock:
+            self._put(key, empty_session())
+
+    def _put(self, key, session):
+        self._entries[key] = (session, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def update(self, key, change):
+        # Applies change(session) to the session and returns its result; changes to one session
+        # are applied one at a time. Raises SessionExpired if there is no such session.
+        if not is_session_key(key):
+            raise ValueError("bad session key")
+        with self._lock:
+            session = self._get(key)
+            if session is None:
+                raise SessionExpired(key)
+            result = change(session)
+            self._put(key, session)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "hits": self.hits, "misses": self.misses, "sessions": len(self._entries)}
+
+class FileSessionStore:
+    """One JSON file per session in a shared directory, updated under a file lock."""
+
+    def __init__(self, directory, ttl=SESSION_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        session = self._read(key) if is_session_key(key) else None
+        with self._lock:
+            if session is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return session
+
+    def create(self, key):
+        self._change(key, lambda session: None, create=True)
+
+    def update(self, key, change):
+        return self._change(key, change)
+
+    def _change(self, key, change, create=False):
+        if not is_session_key(key):
+            raise ValueError("bad session key")
+        path = self._path(key)
+        # Threads of this process take the lock in turn; other workers wait on the lock file
+        with self._lock, open(f"{path}.lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            session = empty_session() if create else self._read(key)
+            if session is None:
+                raise SessionExpired(key)
+            result = change(session)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(session, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        self._sweep()
+        return result
+
+    def _sweep(self):
+        # Now and then, remove sessions (and their lock files) that have expired
+        now = time.time()
+        if now - self._last_sweep < self.ttl / 24:
+            return
+        self._last_sweep = now
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    def stats(self):
+        with self._lock:
+            sessions = sum(1 for entry in os.scandir(self.directory) if entry.name.endswith(".json"))
+            return {"backend": "file", "hits": self.hits, "misses": self.misses, "sessions": sessions}
+
+def make_session_store():
+    directory = os.environ.get("COUNTRYGEN_SESSION_DIR")
+    if directory:
+        return FileSessionStore(directory)
+    return MemorySessionStore()
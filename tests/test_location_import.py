@@ -0,0 +1,70 @@
+"""Location history readers, on small samples of each Google Takeout layout."""
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intervals import month_index  # noqa: E402
+from location_import import read_json_points  # noqa: E402
+
+def points(document):
+    text = json.dumps(document, indent=1)
+    return [(round(lat, 4), round(lon, 4), month) for lat, lon, month in read_json_points(io.BytesIO(text.encode()))]
+
+def test_records():
+    # Records.json (and the older Location History.json): one object per point
+    assert points({"locations": [
+        {"latitudeE7": 488566000, "longitudeE7": 23522000, "accuracy": 20, "timestamp": "2015-03-02T10:00:00.000Z",
+         "activity": [{"activity": [{"type": "STILL", "confidence": 100}], "timestamp": "2015-03-02T10:00:01.000Z"}]},
+        {"latitudeE7": 525200000, "longitudeE7": 134050000, "timestampMs": "1436918400000"},
+    ]}) == [(48.8566, 2.3522, month_index(2015, 3)), (52.52, 13.405, month_index(2015, 7))]
+
+def test_semantic_history():
+    # Semantic Location History/2019/2019_APRIL.json: times are in each object's "duration"
+    assert points({"timelineObjects": [
+        {"placeVisit": {
+            "location": {"latitudeE7": 356812000, "longitudeE7": 1397671000, "placeId": "ChIJ", "address": "Tokyo"},
+            "duration": {"startTimestampMs": "1554076800000", "endTimestampMs": "1554080400000"},
+            "placeConfidence": "HIGH_CONFIDENCE",
+        }},
+        {"activitySegment": {
+            "duration": {"startTimestamp": "2019-05-01T08:00:00Z", "endTimestamp": "2019-05-01T09:00:00Z"},
+            "startLocation": {"latitudeE7": 356812000, "longitudeE7": 1397671000},
+            "endLocation": {"latitudeE7": 374436000, "longitudeE7": 1271386000},
+            "waypointPath": {"waypoints": [{"latE7": 365000000, "lngE7": 1300000000}]},
+            "activityType": "FLYING",
+        }},
+    ]}) == [
+        (35.6812, 139.7671, month_index(2019, 4)),
+        (35.6812, 139.7671, month_index(2019, 5)),
+        (37.4436, 127.1386, month_index(2019, 5)),
+        (36.5, 130.0, month_index(2019, 5)),
+    ]
+
+def test_on_device_timeline():
+    # Timeline.json exported from an Android phone
+    assert points({"semanticSegments": [
+        {"startTime": "2023-01-05T10:00:00.000+01:00", "endTime": "2023-01-05T12:00:00.000+01:00",
+         "visit": {"topCandidate": {"placeId": "ChIJ", "placeLocation": {"latLng": "48.1351°, 11.582°"}}}},
+        {"startTime": "2023-02-01T10:00:00.000+01:00", "endTime": "2023-02-01T11:00:00.000+01:00",
+         "timelinePath": [{"point": "47.3769°, 8.5417°", "time": "2023-03-01T10:05:00.000+01:00"}]},
+    ]}) == [(48.1351, 11.582, month_index(2023, 1)), (47.3769, 8.5417, month_index(2023, 3))]
+
+def test_ios_timeline():
+    # location-history.json exported from an iPhone: places are "geo:" strings
+    assert points([
+        {"startTime": "2022-06-10T09:00:00.000+02:00", "endTime": "2022-06-10T18:00:00.000+02:00",
+         "visit": {"probability": "0.9", "topCandidate": {"placeID": "ChIJ", "placeLocation": "geo:41.902800,12.496400"}}},
+        {"startTime": "2022-07-01T00:00:00.000Z", "endTime": "2022-07-01T02:00:00.000Z",
+         "timelinePath": [{"point": "geo:40.416800,-3.703800", "durationMinutesOffsetFromStartTime": "5"}]},
+    ]) == [(41.9028, 12.4964, month_index(2022, 6)), (40.4168, -3.7038, month_index(2022, 7))]
+
+def test_time_stays_with_its_object():
+    # A visit without a time doesn't take one from another visit
+    assert points({"timelineObjects": [
+        {"placeVisit": {"location": {"latitudeE7": 10000000, "longitudeE7": 10000000},
+                        "duration": {"startTimestamp": "2020-01-01T00:00:00Z"}}},
+        {"placeVisit": {"location": {"latitudeE7": 20000000, "longitudeE7": 20000000}}},
+    ]}) == [(1.0, 1.0, month_index(2020, 1))]
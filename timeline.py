@@ -0,0 +1,79 @@
+import numpy as np
+
+from intervals import month_index
+
+# --- Timeline: one person's visits and residence periods as NumPy arrays ---
+# Dates are month indices (see intervals.month_index) and countries are positions in the
+# registry, so a timeline with thousands of entries is a handful of small integer arrays.
+# Visits are kept in chart order: the most recent first visit first (top of the chart).
+
+class Timeline:
+    """Visits and residence periods of one person, with ages computed from the arrays."""
+
+    __slots__ = ("registry", "dob", "today", "countries", "visits", "res_countries", "res_from", "res_until")
+
+    def __init__(self, registry, dob, today, countries, visits, res_countries=(), res_from=(), res_until=()):
+        self.registry = registry
+        self.dob = dob
+        self.today = today
+        countries = np.asarray(countries, dtype=np.int16)
+        visits = np.asarray(visits, dtype=np.int32)
+        # Stable sort, then reversed: countries first visited in the same month stay in input order, bottom-up
+        order = np.argsort(visits, kind="stable")[::-1]
+        self.countries = countries[order]
+        self.visits = visits[order]
+        self.res_countries = np.asarray(res_countries, dtype=np.int16)
+        self.res_from = np.asarray(res_from, dtype=np.int32)
+        self.res_until = np.asarray(res_until, dtype=np.int32)
+
+    @classmethod
+    def from_inputs(cls, inputs, registry):
+        # inputs as made by engine.make_inputs
+        visits = inputs["visits"]
+        residences = inputs["residences"]
+        return cls(
+            registry,
+            month_index(*inputs["dob"]),
+            month_index(*inputs["today"]),
+            [registry.index_of(code) for code, _, _ in visits],
+            [month_index(year, month) for _, year, month in visits],
+            [registry.index_of(r[0]) for r in residences],
+            [month_index(r[1], r[2]) for r in residences],
+            [month_index(r[3], r[4]) for r in residences],
+        )
+
+    def __len__(self):
+        return len(self.visits)
+
+    def ages_at(self, months):
+        # Same arithmetic as (year - dob_year) + (month - dob_month) / 12, element-wise
+        years, months_0 = np.divmod(months, 12)
+        dob_year, dob_month_0 = divmod(self.dob, 12)
+        return (years - dob_year) + (months_0 - dob_month_0) / 12
+
+    @property
+    def ages(self):
+        return self.ages_at(self.visits)
+
+    @property
+    def current_age(self):
+        return float(self.ages_at(self.today))
+
+    def country(self, row):
+        return self.registry.countries[self.countries[row]]
+
+    def residence_segments(self):
+        # Residence periods clipped to their country's bar (first visit to now), as
+        # (row, start age, end age) arrays ordered by row, then by period
+        ages = self.ages
+        row_of = np.full(len(self.registry), -1, dtype=np.int32)
+        row_of[self.countries] = np.arange(len(self), dtype=np.int32)
+        rows = row_of[self.res_countries]
+        visited = rows >= 0
+        rows = rows[visited]
+        starts = np.maximum(self.ages_at(self.res_from[visited]), ages[rows])
+        ends = np.minimum(self.ages_at(self.res_until[visited]), self.current_age)
+        shown = ends > starts
+        rows, starts, ends = rows[shown], starts[shown], ends[shown]
+        order = np.argsort(rows, kind="stable")
+        return rows[order], starts[order], ends[order]